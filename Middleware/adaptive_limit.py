@@ -0,0 +1,160 @@
+"""
+Adaptive GPU slot limit (AIMD on upstream TTFT and error rate).
+
+The slot budget used to be the sum of the nodes' hand-tuned limits. When a
+node slows down (long prompts, audio synthesis backlog) that number either
+overloads it or, once tuned down, leaves capacity idle. AdaptiveLimiter
+instead moves SlotScheduler.capacity between ADAPTIVE_MIN_LIMIT and
+ADAPTIVE_MAX_LIMIT (default: the pool's capacity) once per window:
+
+  * decrease (limit *= ADAPTIVE_BACKOFF) when the window's upstream error
+    rate exceeds ADAPTIVE_MAX_ERROR_RATE, or its median TTFT exceeds
+    ADAPTIVE_TTFT_TOLERANCE x the baseline (or ADAPTIVE_TTFT_TARGET seconds,
+    if set);
+  * increase (limit += ADAPTIVE_STEP) when the window was healthy and the
+    limit was actually binding (all slots busy or requests waiting);
+  * otherwise hold.
+
+TTFT here is slot grant -> first upstream byte, so queue wait never feeds
+back into the limit. The baseline is the lowest healthy median seen,
+drifting slowly upwards so a permanently slower backend becomes the new
+normal. Nodes leaving the pool still cap the limit (set_ceiling).
+
+ADAPTIVE_CONCURRENCY=0 keeps the fixed limit.
+"""
+import logging
+import os
+import threading
+import time
+
+from metrics import LIMIT_CHANGES
+
+logger = logging.getLogger(__name__)
+
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "1") == "1"
+ADAPTIVE_MIN_LIMIT = int(os.getenv("ADAPTIVE_MIN_LIMIT", 2))
+ADAPTIVE_MAX_LIMIT = int(os.getenv("ADAPTIVE_MAX_LIMIT", 0)) # 0 = pool capacity
+ADAPTIVE_WINDOW = float(os.getenv("ADAPTIVE_WINDOW", 5)) # Seconds per decision
+ADAPTIVE_MIN_SAMPLES = int(os.getenv("ADAPTIVE_MIN_SAMPLES", 10))
+ADAPTIVE_TTFT_TOLERANCE = float(os.getenv("ADAPTIVE_TTFT_TOLERANCE", 2.0))
+ADAPTIVE_TTFT_TARGET = float(os.getenv("ADAPTIVE_TTFT_TARGET", 0)) # 0 = relative to baseline only
+ADAPTIVE_MAX_ERROR_RATE = float(os.getenv("ADAPTIVE_MAX_ERROR_RATE", 0.1))
+ADAPTIVE_BACKOFF = float(os.getenv("ADAPTIVE_BACKOFF", 0.75))
+ADAPTIVE_STEP = int(os.getenv("ADAPTIVE_STEP", 1))
+BASELINE_DRIFT = 0.05 # Share of the gap a healthy window's median pulls the baseline up
+
+class AdaptiveLimiter:
+    def __init__(self, scheduler, ceiling, min_limit=ADAPTIVE_MIN_LIMIT, max_limit=ADAPTIVE_MAX_LIMIT,
+                 window=ADAPTIVE_WINDOW, min_samples=ADAPTIVE_MIN_SAMPLES):
+        self.scheduler = scheduler
+        self.max_limit = max_limit or ceiling
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.ceiling = ceiling
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self.limit = float(self._bound(self.max_limit))
+        self.baseline = None
+        self.last_decision = None
+        self.increases = 0
+        self.decreases = 0
+        self._reset_window(time.time())
+        scheduler.set_capacity(int(self.limit))
+
+    def _bound(self, limit):
+        if self.ceiling <= 0: # Every node is out of rotation
+            return 0
+        upper = max(1, min(self.max_limit, self.ceiling))
+        return max(min(self.min_limit, upper), min(upper, limit))
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._ttfts = []
+        self._errors = 0
+        self._saturated = False
+
+    # --- SAMPLES ---
+    def record(self, ttft=None, error=False):
+        """
+        One upstream outcome: ttft (slot grant -> first byte, seconds) for a
+        stream that started, error=True for a connect or stream failure.
+        """
+        active, capacity, waiting = self.scheduler.occupancy()
+        now = time.time()
+        with self._lock:
+            if error:
+                self._errors += 1
+            elif ttft is not None:
+                self._ttfts.append(ttft)
+            if waiting or active >= capacity:
+                self._saturated = True
+            if now - self._window_start < self.window or len(self._ttfts) + self._errors < self.min_samples:
+                return
+            new_limit = self._decide()
+            self._reset_window(now)
+        if new_limit is not None:
+            self.scheduler.set_capacity(new_limit)
+
+    def _decide(self):
+        """Called with the lock held at the end of a window. Returns the new int limit, if changed."""
+        total = len(self._ttfts) + self._errors
+        error_rate = self._errors / total
+        median = sorted(self._ttfts)[len(self._ttfts) // 2] if self._ttfts else None
+        threshold = ADAPTIVE_TTFT_TARGET or (self.baseline * ADAPTIVE_TTFT_TOLERANCE if self.baseline else None)
+        old = int(self.limit)
+
+        if error_rate > ADAPTIVE_MAX_ERROR_RATE or (median is not None and threshold and median > threshold):
+            self.limit = self._bound(self.limit * ADAPTIVE_BACKOFF)
+            self.decreases += 1
+            self.last_decision = {"action": "decrease", "error_rate": round(error_rate, 3), "ttft_p50": median}
+        else:
+            if median is not None:
+                if self.baseline is None or median < self.baseline:
+                    self.baseline = median
+                else:
+                    self.baseline += BASELINE_DRIFT * (median - self.baseline)
+            if not self._saturated:
+                self.last_decision = {"action": "hold", "error_rate": round(error_rate, 3), "ttft_p50": median}
+                return None
+            self.limit = self._bound(self.limit + ADAPTIVE_STEP)
+            self.increases += 1
+            self.last_decision = {"action": "increase", "error_rate": round(error_rate, 3), "ttft_p50": median}
+
+        new = int(self.limit)
+        if new == old:
+            return None
+        LIMIT_CHANGES.inc(self.last_decision["action"])
+        logger.info(f"🎚️ Slot limit {old} -> {new} ({self.last_decision['action']}, "
+                    f"ttft p50 {median}, errors {error_rate:.0%})")
+        return new
+
+    # --- POOL CAPACITY ---
+    def set_ceiling(self, ceiling):
+        """
+        GPUPool.on_capacity_change hook: a node left (or rejoined) the pool.
+        The limit is scaled by the same ratio and clamped to the new ceiling.
+        """
+        with self._lock:
+            old_ceiling, self.ceiling = self.ceiling, ceiling
+            if old_ceiling:
+                self.limit = self.limit * ceiling / old_ceiling
+            else:
+                self.limit = self.max_limit
+            self.limit = self._bound(self.limit)
+            new = int(self.limit)
+        self.scheduler.set_capacity(new)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": True,
+                "limit": int(self.limit),
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "ceiling": self.ceiling,
+                "baseline_ttft": round(self.baseline, 4) if self.baseline is not None else None,
+                "window_samples": len(self._ttfts) + self._errors,
+                "increases": self.increases,
+                "decreases": self.decreases,
+                "last_decision": self.last_decision
+            }
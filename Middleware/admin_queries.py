@@ -0,0 +1,67 @@
+"""
+Aggregation pipelines behind the admin dashboard.
+
+Everything here runs server-side in Mongo and returns only the fields the
+dashboard renders, so admin pages never pull whole user documents
+(password hashes included) into the middleware.
+"""
+import re
+
+ADMIN_USER_FIELDS = ["id", "username", "role", "coins", "subscription", "affiliate_balance",
+                     "referred_by", "commission_start_date", "payout_status"]
+SORTABLE_USER_FIELDS = {"username", "coins", "subscription", "affiliate_balance", "role", "id"}
+DEFAULT_USERS_LIMIT = 50
+MAX_USERS_LIMIT = 500
+
+def users_filter(q=None, tier=None, role=None):
+    """
+    q: case-insensitive username substring; tier/role: exact match.
+    """
+    match = {}
+    if q:
+        match["username"] = {"$regex": re.escape(q), "$options": "i"}
+    if tier:
+        match["subscription"] = tier
+    if role:
+        match["role"] = role
+    return match
+
+def users_page_pipeline(match, sort="username", order=1, skip=0, limit=DEFAULT_USERS_LIMIT):
+    """
+    One page of users, one output document per user (the total comes from
+    count_documents). $sort/$skip/$limit run first, straight after $match,
+    so the sort can use an index and the result never has to fit in a
+    single document; limit=None streams every matching user (legacy
+    unpaginated listing).
+    Referral counts (all / paid) come from a $lookup over `referred_by`
+    (referral code == referrer username), evaluated for the page only.
+    localField/foreignField + pipeline lets Mongo (5.0+) use the
+    referred_by index.
+    """
+    if sort not in SORTABLE_USER_FIELDS:
+        sort = "username"
+    rows = [{"$match": match}, {"$sort": {sort: order, "id": 1}}]
+    if limit is not None:
+        rows += [{"$skip": skip}, {"$limit": limit}]
+    rows += [
+        {"$lookup": {
+            "from": "users",
+            "localField": "username",
+            "foreignField": "referred_by",
+            "pipeline": [
+                {"$group": {
+                    "_id": None,
+                    "all": {"$sum": 1},
+                    "paid": {"$sum": {"$cond": [{"$ne": [{"$ifNull": ["$subscription", "free"]}, "free"]}, 1, 0]}}
+                }}
+            ],
+            "as": "referrals"
+        }},
+        {"$project": dict(
+            {f: 1 for f in ADMIN_USER_FIELDS},
+            _id=0,
+            referrals_count={"$ifNull": [{"$first": "$referrals.all"}, 0]},
+            paid_referrals_count={"$ifNull": [{"$first": "$referrals.paid"}, 0]}
+        )}
+    ]
+    return rows
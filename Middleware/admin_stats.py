@@ -0,0 +1,138 @@
+"""
+Materialized admin dashboard statistics.
+
+Counters live in a single document ({"id": "global"} in the `stats`
+collection) and are maintained at the write sites (signup, subscribe,
+webhook credit, chat debit/refund, user delete), so /api/admin/stats is one
+indexed read instead of several collection scans.
+
+Deltas are accumulated in-process and flushed as one $inc every
+STATS_FLUSH_INTERVAL seconds, which keeps the hot chat path from hammering a
+single document. reconcile() recomputes everything from `users` in one
+$facet pipeline; run it after deploys or if counters ever drift:
+
+    python admin_stats.py --reconcile
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STATS_DOC_ID = "global"
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", 1.0))
+TIERS = ("free", "infantry", "commander")
+FIELDS = ("total_users", "total_coins", "referred_users") + tuple(f"subs_{t}" for t in TIERS)
+
+def is_referred(user):
+    return user.get('referred_by') not in (None, "", "null")
+
+RECONCILE_PIPELINE = [{"$facet": {
+    "totals": [{"$group": {"_id": None, "users": {"$sum": 1}, "coins": {"$sum": "$coins"}}}],
+    "subs": [{"$group": {"_id": {"$ifNull": ["$subscription", "free"]}, "n": {"$sum": 1}}}],
+    "referred": [{"$match": {"referred_by": {"$nin": [None, "", "null"]}}}, {"$count": "n"}]
+}}]
+
+class StatsCounters:
+    def __init__(self, collection, flush_interval=STATS_FLUSH_INTERVAL):
+        self.collection = collection
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = threading.Thread(target=self._run, args=(flush_interval,), daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    # --- WRITE SITES ---
+    def add(self, **deltas):
+        with self._lock:
+            for k, v in deltas.items():
+                if v: self._pending[k] = self._pending.get(k, 0) + v
+
+    def user_added(self, user):
+        self.add(total_users=1, total_coins=user.get('coins', 0), referred_users=int(is_referred(user)),
+                 **{f"subs_{user.get('subscription', 'free')}": 1})
+
+    def user_removed(self, user):
+        self.add(total_users=-1, total_coins=-user.get('coins', 0), referred_users=-int(is_referred(user)),
+                 **{f"subs_{user.get('subscription', 'free')}": -1})
+
+    def tier_changed(self, old, new):
+        old = old or 'free'
+        if old != new:
+            self.add(**{f"subs_{old}": -1, f"subs_{new}": 1})
+
+    def coins_changed(self, delta):
+        self.add(total_coins=delta)
+
+    # --- FLUSH ---
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            self.collection.update_one({"id": STATS_DOC_ID}, {"$inc": pending}, upsert=True)
+        except Exception as e:
+            logger.error(f"❌ Stats flush failed, will retry: {e}")
+            self.add(**pending)
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    # --- READ ---
+    def snapshot(self):
+        """Dashboard payload: stored counters plus not-yet-flushed deltas."""
+        doc = self.collection.find_one({"id": STATS_DOC_ID}) or {}
+        with self._lock:
+            values = {f: doc.get(f, 0) + self._pending.get(f, 0) for f in FIELDS}
+        return {
+            "total_users": values["total_users"],
+            "total_coins": values["total_coins"],
+            "subs": {t: values[f"subs_{t}"] for t in TIERS},
+            "referral_stats": {
+                "referred": values["referred_users"],
+                "independent": values["total_users"] - values["referred_users"]
+            }
+        }
+
+    def exists(self):
+        return self.collection.find_one({"id": STATS_DOC_ID}) is not None
+
+    # --- RECONCILE ---
+    def reconcile(self, users_collection):
+        """
+        Recomputes all counters from scratch in one aggregation. Writes that
+        land while it runs may be counted twice; run it in quiet periods.
+        """
+        with self._lock:
+            self._pending = {}
+        rows = list(users_collection.aggregate(RECONCILE_PIPELINE))
+        facets = rows[0] if rows else {"totals": [], "subs": [], "referred": []}
+        totals = facets["totals"][0] if facets["totals"] else {"users": 0, "coins": 0}
+        values = {
+            "total_users": totals["users"],
+            "total_coins": totals["coins"],
+            "referred_users": facets["referred"][0]["n"] if facets["referred"] else 0
+        }
+        values.update({f"subs_{t}": 0 for t in TIERS})
+        for row in facets["subs"]:
+            values[f"subs_{row['_id']}"] = row["n"]
+        self.store(values)
+        return values
+
+    def store(self, values):
+        self.collection.update_one({"id": STATS_DOC_ID}, {"$set": values}, upsert=True)
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Admin statistics maintenance")
+    parser.add_argument("--reconcile", action="store_true", help="Recompute counters from the users collection")
+    args = parser.parse_args()
+    if args.reconcile:
+        import server
+        print(f"[OK] Reconciled: {server.reconcile_stats()}")
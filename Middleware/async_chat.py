@@ -0,0 +1,319 @@
+"""
+ASGI entrypoint for the Middleware.
+
+/chat runs natively on asyncio: a queued or streaming client costs one coroutine
+instead of a whole WSGI worker thread. Every other route falls through to the
+Flask app in server.py.
+
+Run with:
+    gunicorn async_chat:app -k uvicorn.workers.UvicornWorker
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+import server
+from metrics import CHATS, QUEUE_WAIT, UPSTREAM_ERRORS
+from scheduler import GRANTED
+from sse_relay import SSERelay, SSE_FLUSH_INTERVAL, SSE_FLUSH_BYTES
+
+logger = logging.getLogger(__name__)
+
+# --- UPSTREAM CLIENT (Pooled, Keep-Alive) ---
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", server.MAX_WORKERS * 2))
+UPSTREAM_KEEPALIVE = int(os.getenv("UPSTREAM_KEEPALIVE", server.MAX_WORKERS))
+
+flask_app = WsgiToAsgi(server.app)
+_upstream_client = None
+
+def get_upstream_client():
+    """
+    One shared AsyncClient per process so GPU node connections are reused
+    instead of paying a new TCP handshake per chat.
+    """
+    global _upstream_client
+    if _upstream_client is None:
+        _upstream_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(120, connect=10),
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_KEEPALIVE
+            )
+        )
+    return _upstream_client
+
+class ClientDisconnected(Exception):
+    """send() failed: the browser is gone. Not an upstream error."""
+
+class AsyncTurnEvent:
+    """
+    Stands in for threading.Event inside a scheduler ticket.
+    set() may be called from any thread releasing a slot; the wake-up hops
+    back onto the event loop.
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._future = loop.create_future()
+
+    def set(self):
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        if not self._future.done():
+            self._future.set_result(True)
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+# --- SCHEDULER CALLS ---
+# With SLOT_COORDINATOR every scheduler call (and the limiter samples) is a
+# blocking socket RPC, so it runs in a thread; the local scheduler is just a
+# lock and stays inline.
+async def off_loop(fn, *args):
+    if server.SLOT_COORDINATOR:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+def abandon_ticket(ticket):
+    """Drops a queued ticket, or releases the slot if it was granted meanwhile."""
+    if not server.slot_scheduler.cancel(ticket):
+        server.slot_scheduler.release(ticket)
+
+# --- RAW ASGI HELPERS ---
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+SSE_HEADERS = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")] + CORS_HEADERS
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def send_json(send, status, obj, headers=()):
+    body = json.dumps(obj).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json")] + CORS_HEADERS + list(headers)
+    })
+    await send({"type": "http.response.body", "body": body})
+
+# --- ASYNC CHAT ROUTE ---
+async def chat(scope, receive, send):
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+    current_user, error = await asyncio.to_thread(server.authenticate, headers.get("authorization"))
+    if error:
+        return await send_json(send, 401, {'error': error})
+
+    arrived = time.time()
+    data = json.loads(await read_body(receive) or b"{}")
+    tier = current_user.get('subscription', 'free')
+    logger.info(f"💬 Chat Request from {current_user['username']} ({tier}) [async]")
+
+    # 1. Prompt (+ response cache: identical prompts replay without a GPU slot)
+    payload, sessionId, user_input, current_user_role = await asyncio.to_thread(
+        server.build_chat_request, data, tier
+    )
+    cached, status = await asyncio.to_thread(
+        server.cached_chat_reply, current_user, payload, sessionId, user_input, current_user_role
+    )
+    if status:
+        CHATS.inc("insufficient_funds")
+        return await send_json(send, status, {"error": "MUNITIONS_DEPLETED"})
+    if cached is not None:
+        await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+        return await send({"type": "http.response.body", "body": cached})
+
+    # 2. Admission: turned away before paying if no slot is expected in time
+    priority = server.chat_priority(tier)
+    retry_after = await off_loop(server.admission_retry_after, priority, current_user['username'])
+    if retry_after is not None:
+        return await send_json(send, 503, {"error": "SERVER_BUSY", "retry_after": retry_after},
+                               [(b"retry-after", str(retry_after).encode())])
+
+    # 3. Billing: atomic debit (balance >= cost), refunded on failure
+    debit = await asyncio.to_thread(
+        server.billing.debit, current_user['id'], server.CHAT_COST, "chat", sessionId
+    )
+    if debit is None:
+        CHATS.inc("insufficient_funds")
+        return await send_json(send, 402, {"error": "MUNITIONS_DEPLETED"})
+
+    # 4. THE QUEUE SYSTEM (Shared with the Flask route, same scheduler)
+    my_turn_event = AsyncTurnEvent(asyncio.get_running_loop())
+    req_id = next(server.unique_counter)
+    ticket = await off_loop(
+        server.slot_scheduler.submit, priority, my_turn_event, req_id, server.SLOT_WAIT_TIMEOUT, current_user['id']
+    )
+    logger.info(f"📥 Queued Request {req_id} (Priority: {priority})")
+
+    try:
+        granted = await my_turn_event.wait(server.SLOT_WAIT_TIMEOUT)
+    except asyncio.CancelledError:
+        # Task torn down while queued: never leave a granted slot behind
+        loop = asyncio.get_running_loop()
+        if server.SLOT_COORDINATOR:
+            loop.run_in_executor(None, abandon_ticket, ticket)
+        else:
+            abandon_ticket(ticket)
+        loop.run_in_executor(None, server.billing.refund, debit, "CLIENT_GONE")
+        CHATS.inc("client_gone")
+        raise
+    # A remote scheduler that lost its coordinator wakes waiters with an expired ticket
+    if (not granted or ticket.state != GRANTED) and await off_loop(server.slot_scheduler.cancel, ticket):
+        logger.warning(f"⏰ Timeout waiting for slot. Request {req_id}")
+        await asyncio.to_thread(server.billing.refund, debit, "SERVER_BUSY_TIMEOUT")
+        CHATS.inc("queue_timeout")
+        return await send_json(send, 503, {"error": "SERVER_BUSY_TIMEOUT"})
+
+    # 5. WE HAVE A SLOT!
+    logger.info(f"🟢 Slot Acquired for Request {req_id}")
+    QUEUE_WAIT.observe(ticket.granted_at - ticket.ts, tier)
+    try:
+        # Fails over to another node before refunding
+        if server.upstream_batcher:
+            node, upstream_response = await server.upstream_batcher.open_stream_async(payload)
+        else:
+            node, upstream_response = await server.gpu_pool.open_stream_async(get_upstream_client(), payload)
+        logger.info(f"✅ Connected to GPU Node {node.base_url} for Request {req_id}")
+    except Exception as e:
+        logger.error(f"❌ Backend Error in Request {req_id}: {e}")
+        await asyncio.to_thread(server.billing.refund, debit, "BACKEND_FAILURE")
+        await off_loop(server.slot_scheduler.release, ticket) # Release slot on error
+        CHATS.inc("backend_failure")
+        await off_loop(server.record_upstream, ticket.granted_at, None, True)
+        return await send_json(send, 502, {"error": "BACKEND_FAILURE"})
+
+    # 6. RELAY (Async SSE)
+    relay = SSERelay()
+    first_byte_at = []
+    outcome = "client_gone" # Until the stream completes or fails
+    started = False
+
+    async def timed_send(message):
+        if not first_byte_at and message.get("body"):
+            first_byte_at.append(time.time())
+        try:
+            await send(message)
+        except Exception as e: # send raises once the socket is gone
+            raise ClientDisconnected(e) from e
+
+    try:
+        await timed_send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": SSE_HEADERS
+        })
+        started = True
+        await relay_upstream(upstream_response, relay, timed_send)
+        await timed_send({"type": "http.response.body", "body": b""})
+        outcome = "streamed"
+    except ClientDisconnected as e:
+        # Same as the WSGI path: a closed tab must not shrink the adaptive slot limit
+        logger.info(f"👋 Client left Request {req_id}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Streaming Error in Request {req_id}: {e}")
+        UPSTREAM_ERRORS.inc(node.base_url, "stream")
+        outcome = "stream_error"
+        if started:
+            # End the chunked reply cleanly, like the WSGI generator does
+            try:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+            except Exception:
+                pass # Client already gone
+    finally:
+        await upstream_response.aclose()
+        server.gpu_pool.release(node)
+        await off_loop(server.slot_scheduler.release, ticket)
+        logger.info(f"🏁 Request {req_id} Finished. Slot Released.")
+        await off_loop(server.record_stream, tier, arrived, first_byte_at[0] if first_byte_at else None,
+                       relay, outcome, ticket.granted_at)
+
+        # --- SAVE TO DB ---
+        text = relay.text()
+        await asyncio.to_thread(
+            server.save_chat_turn, sessionId, user_input, current_user_role, text, relay.audio_url
+        )
+        if outcome == "streamed":
+            server.response_cache.put(server.response_cache.key(payload), text, relay.audio_url)
+
+async def relay_upstream(upstream_response, relay, send, flush_interval=SSE_FLUSH_INTERVAL):
+    """
+    Forwards upstream bytes through the SSERelay. With flush_interval > 0,
+    output is held until the interval passes (or SSE_FLUSH_BYTES pile up) so
+    bursts of tokens go out in one send; a stalled upstream never holds
+    data past the deadline.
+    """
+    async def write(body):
+        await send({"type": "http.response.body", "body": body, "more_body": True})
+
+    chunks = upstream_response.aiter_bytes()
+    if flush_interval <= 0:
+        async for chunk in chunks:
+            out = relay.feed(chunk)
+            if out: await write(out)
+    else:
+        loop = asyncio.get_running_loop()
+        pending = bytearray()
+        deadline = None
+        next_chunk = asyncio.ensure_future(chunks.__anext__())
+        try:
+            while True:
+                timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+                if done:
+                    try:
+                        chunk = next_chunk.result()
+                    except StopAsyncIteration:
+                        break
+                    next_chunk = asyncio.ensure_future(chunks.__anext__())
+                    pending += relay.feed(chunk)
+                    if pending and deadline is None:
+                        deadline = loop.time() + flush_interval
+                if pending and (deadline is not None and loop.time() >= deadline or len(pending) >= SSE_FLUSH_BYTES):
+                    await write(bytes(pending))
+                    pending.clear()
+                    deadline = None
+        finally:
+            if not next_chunk.done():
+                next_chunk.cancel()
+        if pending: await write(bytes(pending))
+    out = relay.finish()
+    if out: await write(out)
+
+# --- LIFESPAN ---
+async def lifespan(receive, send):
+    global _upstream_client
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _upstream_client is not None:
+                await _upstream_client.aclose()
+                _upstream_client = None
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http" and scope["path"] == "/chat" and scope["method"] == "POST":
+        return await chat(scope, receive, send)
+    # Everything else (incl. CORS preflight for /chat) is served by Flask
+    return await flask_app(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, port=5000)
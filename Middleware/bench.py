@@ -0,0 +1,213 @@
+"""
+Self-contained load test for the chat path.
+
+Starts a stub GPU node (stub_gpu_node.py), runs the middleware in-process on
+the in-memory store (MONGO_URI=mock, see memory_store.py) seeded with users across
+tiers, and drives /chat with closed-loop virtual users for a fixed time:
+
+    python bench.py --users 60 --slots 20 --duration 30 --tiers commander:1,infantry:2,free:5
+    python bench.py --server asgi --ttft 0.3 --delay 0.02 --fail-rate 0.05 --out results/asgi.json
+
+Reports throughput, time to first byte and latency per tier, scheduler
+queue wait p50/p99 per tier, slot utilization, refund rate and status
+counts, and writes them as JSON (with the git commit) so runs can be
+diffed between versions.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import requests
+
+from stub_gpu_node import start_stub
+
+def parse_weights(spec):
+    weights = {}
+    for item in spec.split(','):
+        tier, _, w = item.strip().partition(':')
+        weights[tier] = float(w or 1)
+    return weights
+
+def pct(values, p):
+    from scheduler import percentile
+    return round(percentile(sorted(values), p), 4)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+# --- SETUP ---
+def seed_db(server, users, weights, coins):
+    """Creates `users` accounts split across tiers by weight, each with one session."""
+    total = sum(weights.values())
+    tiers = []
+    for tier, w in weights.items():
+        tiers += [tier] * round(users * w / total)
+    tiers = (tiers + [list(weights)[-1]] * users)[:users]
+    seeded = []
+    for i, tier in enumerate(tiers):
+        uid = f"bench-{i}"
+        user = {"id": uid, "username": f"bench_user_{i}", "password": "-", "role": "user",
+                "coins": coins, "subscription": tier}
+        server.users_collection.insert_one(user)
+        server.sessions_collection.insert_one({"id": f"bench-s{i}", "userId": uid, "title": "BENCH",
+                                               "timestamp": datetime.utcnow().isoformat(), "message_count": 0})
+        server.stats_counters.user_added(user)
+        token = server.jwt.encode({'id': uid, 'exp': datetime.utcnow() + server.timedelta(hours=2)},
+                                  server.SECRET_KEY, algorithm="HS256")
+        seeded.append({"id": uid, "tier": tier, "session": f"bench-s{i}", "token": token})
+    return seeded
+
+def start_app(mode, port):
+    import server
+    if mode == "asgi":
+        import uvicorn
+        import async_chat
+        config = uvicorn.Config(async_chat.app, host="127.0.0.1", port=port, log_level="warning")
+        threading.Thread(target=uvicorn.Server(config).run, daemon=True).start()
+    else:
+        from werkzeug.serving import make_server
+        httpd = make_server("127.0.0.1", port, server.app, threaded=True)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(base + "/api/admin/scheduler", timeout=1)
+            return base
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    raise RuntimeError("Middleware did not start")
+
+# --- LOAD ---
+def virtual_user(base, user, stop_at, results, think):
+    session = requests.Session()
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    n = 0
+    while time.time() < stop_at:
+        n += 1
+        body = {"sessionId": user["session"], "messages": [{"role": "user", "content": f"{user['id']} message {n}"}]}
+        started = time.time()
+        ttfb = None
+        status = None
+        retry_after = None
+        try:
+            with session.post(base + "/chat", json=body, headers=headers, stream=True, timeout=120) as r:
+                status = r.status_code
+                retry_after = r.headers.get("Retry-After")
+                for chunk in r.iter_content(chunk_size=None):
+                    if ttfb is None and chunk:
+                        ttfb = time.time() - started
+        except Exception:
+            status = status or "error"
+        results.append({"tier": user["tier"], "status": status, "ttfb": ttfb, "latency": time.time() - started})
+        if retry_after: # Rejected up front by admission control; back off like a real client
+            time.sleep(max(0.0, min(float(retry_after), stop_at - time.time())))
+        elif think:
+            time.sleep(random.uniform(0, think))
+
+def sample_slots(scheduler, stop, samples, interval=0.05):
+    while not stop.is_set():
+        stats = scheduler.stats()
+        samples.append((stats["active"], stats["capacity"], stats["waiting"]))
+        time.sleep(interval)
+
+# --- REPORT ---
+def summarize(results, elapsed, server, stub_config, samples, args):
+    ok = [r for r in results if r["status"] == 200]
+    by_tier = defaultdict(list)
+    for r in ok:
+        by_tier[r["tier"]].append(r)
+    server.billing.ledger_buffer.close()
+    ledger = Counter(e.get("type") for e in server.ledger_collection.find({"userId": {"$regex": "^bench-"}}, {"type": 1}))
+    utilization = [a / c for a, c, _ in samples if c]
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat(),
+            "config": vars(args)
+        },
+        "requests": len(results),
+        "completed": len(ok),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "status_counts": {str(k): v for k, v in Counter(r["status"] for r in results).items()},
+        "ttfb": {t: {"p50": pct([r["ttfb"] for r in rs if r["ttfb"] is not None], 50),
+                     "p99": pct([r["ttfb"] for r in rs if r["ttfb"] is not None], 99)} for t, rs in by_tier.items()},
+        "latency": {t: {"p50": pct([r["latency"] for r in rs], 50),
+                        "p99": pct([r["latency"] for r in rs], 99)} for t, rs in by_tier.items()},
+        "queue_wait": {t: {"p50": w["p50"], "p99": w["p99"], "count": w["count"]}
+                       for t, w in server.slot_scheduler.queue_wait_percentiles().items()},
+        "slot_utilization": {
+            "mean": round(sum(utilization) / len(utilization), 4) if utilization else 0.0,
+            "max": round(max(utilization), 4) if utilization else 0.0,
+            "max_waiting": max((w for _, _, w in samples), default=0)
+        },
+        "slot_limit": server.slot_limiter.stats() if server.slot_limiter else {"enabled": False},
+        "refund_rate": round(ledger["refund"] / ledger["debit"], 4) if ledger["debit"] else 0.0,
+        "ledger": dict(ledger),
+        "stub": {"requests": stub_config.requests, "failed": stub_config.failed, "dropped": stub_config.dropped}
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Middleware load test")
+    parser.add_argument("--server", choices=["wsgi", "asgi"], default="wsgi")
+    parser.add_argument("--users", type=int, default=40, help="Concurrent virtual users")
+    parser.add_argument("--slots", type=int, default=10, help="GPU node concurrency limit")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--tiers", default="commander:1,infantry:2,free:5", help="Tier mix by weight")
+    parser.add_argument("--think", type=float, default=0.0, help="Max random pause between a user's requests")
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--delay", type=float, default=0.02, help="Seconds between tokens")
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="Write the JSON report here")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    stub, stub_config = start_stub(tokens=args.tokens, delay=args.delay, ttft=args.ttft,
+                                   fail_rate=args.fail_rate, drop_rate=args.drop_rate, seed=args.seed)
+    # Must be set before server is imported (pool, DB and limits are built at import)
+    os.environ["GPU_NODE_URLS"] = f"http://127.0.0.1:{stub.server_address[1]}|{args.slots}"
+    os.environ.setdefault("MONGO_URI", "mock")
+    import logging
+    logging.disable(logging.WARNING)
+    import server
+
+    users = seed_db(server, args.users, parse_weights(args.tiers), coins=1_000_000)
+    base = start_app(args.server, args.port)
+    results = []
+    samples = []
+    stop = threading.Event()
+    threading.Thread(target=sample_slots, args=(server.slot_scheduler, stop, samples), daemon=True).start()
+
+    started = time.time()
+    stop_at = started + args.duration
+    workers = [threading.Thread(target=virtual_user, args=(base, u, stop_at, results, args.think), daemon=True)
+               for u in users]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    elapsed = time.time() - started
+    stop.set()
+
+    report = summarize(results, elapsed, server, stub_config, samples, args)
+    print(json.dumps(report, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[OK] Report written to {args.out}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Coin billing with an append-only ledger.
+
+debit() is a single conditional find_one_and_update (balance >= cost), so a
+chat costs one round trip and concurrent requests can never overdraw.
+Every debit and refund is recorded in the `ledger` collection; a refund
+references the debit it reverses. Ledger entries are written behind the
+request through a WriteBehindBuffer.
+"""
+import uuid
+from datetime import datetime
+
+from pymongo import ReturnDocument, UpdateOne
+
+from metrics import REFUNDS
+from write_behind import WriteBehindBuffer
+
+class Billing:
+    def __init__(self, users_collection, ledger_collection, on_balance_change=None):
+        """
+        on_balance_change(user_id, delta) runs after every balance write
+        (auth user cache invalidation, admin stats counters).
+        """
+        self.users = users_collection
+        self.ledger = ledger_collection
+        self.on_balance_change = on_balance_change
+        self.ledger_buffer = WriteBehindBuffer("ledger", self._write_ledger)
+
+    def _write_ledger(self, entries):
+        # Upserts on the entry id: a retried batch never duplicates entries
+        self.ledger.bulk_write(
+            [UpdateOne({"id": e["id"]}, {"$setOnInsert": e}, upsert=True) for e in entries], ordered=False
+        )
+
+    def _record(self, user_id, kind, amount, reason, **extra):
+        entry = {
+            "id": str(uuid.uuid4()),
+            "userId": user_id,
+            "type": kind,
+            "amount": amount,
+            "reason": reason,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        entry.update(extra)
+        self.ledger_buffer.put(entry)
+        return entry
+
+    def debit(self, user_id, cost, reason, ref=None):
+        """
+        Atomically takes `cost` coins if the balance covers it.
+        Returns the ledger entry (keep it to refund later) or None if the
+        balance is too low.
+        """
+        user = self.users.find_one_and_update(
+            {"id": user_id, "coins": {"$gte": cost}},
+            {"$inc": {"coins": -cost}},
+            projection={"_id": 0, "coins": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if user is None:
+            return None
+        if self.on_balance_change:
+            self.on_balance_change(user_id, -cost)
+        return self._record(user_id, "debit", -cost, reason, ref=ref, balance=user.get("coins"))
+
+    def refund(self, debit_entry, reason):
+        """
+        Reverses a debit. The refund entry points at the debit it undoes.
+        """
+        user_id = debit_entry["userId"]
+        amount = -debit_entry["amount"]
+        self.users.update_one({"id": user_id}, {"$inc": {"coins": amount}})
+        REFUNDS.inc(reason)
+        if self.on_balance_change:
+            self.on_balance_change(user_id, amount)
+        return self._record(user_id, "refund", amount, reason, refundOf=debit_entry["id"], ref=debit_entry.get("ref"))
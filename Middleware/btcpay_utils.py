@@ -1,49 +1,271 @@
-import requests
-import hmac
+"""
+BTCPay Server client.
+
+BTCPayClient keeps one pooled keep-alive session, so a checkout no longer
+pays a fresh TCP+TLS handshake. Transient failures are retried:
+
+  * retried: connection errors, timeouts and 429/502/503/504, at most
+    BTCPAY_RETRIES more times, with full-jitter exponential backoff;
+  * invoice creation (a POST) is only retried when BTCPay cannot have created
+    the invoice: the connection was never established, or the answer was
+    429/503. A reset on a reused connection, a read timeout or a 502/504
+    from a gateway fail instead, so a retry never creates a duplicate
+    invoice.
+
+After BTCPAY_BREAKER_THRESHOLD failed calls in a row, the circuit breaker
+opens. For BTCPAY_BREAKER_COOLDOWN seconds calls raise BTCPayUnavailable
+without touching the network. After that, one trial call decides whether it
+closes again.
+
+get_or_create_invoice() hands back the same unpaid invoice for repeated
+clicks on one (userId, plan). It is reused while it has more than
+BTCPAY_REUSE_MARGIN seconds left before expiry. With BTCPAY_VERIFY_REUSE=1
+(the default), reuse also requires that BTCPay still reports the invoice as
+"New". Webhook events drop an invoice from the cache (forget_invoice).
+
+    python stub_btcpay.py --port 23000   # local fake BTCPay for tests
+    BTCPAY_URL=http://127.0.0.1:23000 python server.py
+"""
 import hashlib
-import json
+import hmac
 import logging
 import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from metrics import BTCPAY_CALLS
+
+logger = logging.getLogger(__name__)
 
 # In production, load these from os.environ
-BTCPAY_URL = "https://btcpay0.voltageapp.io"
-STORE_ID = "9CGb7hPHHRhRDWGfxtRVTigGr1LHRWBVuG8NiTJ3EzzP"
-API_KEY = "31baae7cc4b0445b28546a195b35ccec759dd62a"
+BTCPAY_URL = os.getenv("BTCPAY_URL", "https://btcpay0.voltageapp.io")
+STORE_ID = os.getenv("BTCPAY_STORE_ID", "9CGb7hPHHRhRDWGfxtRVTigGr1LHRWBVuG8NiTJ3EzzP")
+API_KEY = os.getenv("BTCPAY_API_KEY", "31baae7cc4b0445b28546a195b35ccec759dd62a")
 # Load secret from env (Production) or leave None (Insecure/Test)
 WEBHOOK_SECRET = os.getenv("BTCPAY_WEBHOOK_SECRET", None)
 
-def create_invoice(amount, currency, metadata=None):
-    """
-    Creates an invoice on BTCPay Server.
-    metadata: dict containing custom fields (e.g. {'userId': '123', 'plan': 'commander'})
-    """
-    url = f"{BTCPAY_URL}/api/v1/stores/{STORE_ID}/invoices"
-    headers = {
-        "Authorization": f"token {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "amount": str(amount),
-        "currency": currency,
-        "metadata": metadata or {},
-        "checkout": {
-            "speedPolicy": "HighSpeed", # Recommend for digital goods
-            "redirectAutomatically": True,
-           # "redirectAutomatically": True,
-            "redirectURL": os.getenv("FRONTEND_URL", "https://frontend-4ok4.vercel.app/")
+BTCPAY_TIMEOUT = float(os.getenv("BTCPAY_TIMEOUT", 10))
+BTCPAY_POOL_SIZE = int(os.getenv("BTCPAY_POOL_SIZE", 10))
+BTCPAY_RETRIES = int(os.getenv("BTCPAY_RETRIES", 2))
+BTCPAY_BACKOFF = float(os.getenv("BTCPAY_BACKOFF", 0.2))
+BTCPAY_BACKOFF_MAX = float(os.getenv("BTCPAY_BACKOFF_MAX", 2.0))
+BTCPAY_BREAKER_THRESHOLD = int(os.getenv("BTCPAY_BREAKER_THRESHOLD", 5))
+BTCPAY_BREAKER_COOLDOWN = float(os.getenv("BTCPAY_BREAKER_COOLDOWN", 30))
+BTCPAY_REUSE_MARGIN = float(os.getenv("BTCPAY_REUSE_MARGIN", 120))
+BTCPAY_VERIFY_REUSE = os.getenv("BTCPAY_VERIFY_REUSE", "1") == "1"
+BTCPAY_INVOICE_CACHE_SIZE = int(os.getenv("BTCPAY_INVOICE_CACHE_SIZE", 10000))
+RETRY_STATUSES = {429, 502, 503, 504}
+NOT_PROCESSED_STATUSES = {429, 503} # Refused before handling; a 502/504 gateway may have forwarded it
+LOCK_STRIPES = 64
+
+def _never_sent(error):
+    """True if no connection was made, so the request cannot have reached BTCPay."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+
+class BTCPayUnavailable(Exception):
+    """Circuit open (or every retry failed); retry_after is a hint in seconds."""
+    def __init__(self, message, retry_after=BTCPAY_BREAKER_COOLDOWN):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class BTCPayClient:
+    def __init__(self, base_url=BTCPAY_URL, store_id=STORE_ID, api_key=API_KEY, timeout=BTCPAY_TIMEOUT,
+                 retries=BTCPAY_RETRIES, breaker_threshold=BTCPAY_BREAKER_THRESHOLD,
+                 breaker_cooldown=BTCPAY_BREAKER_COOLDOWN, reuse_margin=BTCPAY_REUSE_MARGIN,
+                 verify_reuse=BTCPAY_VERIFY_REUSE, max_cached=BTCPAY_INVOICE_CACHE_SIZE):
+        self.invoices_url = f"{base_url.rstrip('/')}/api/v1/stores/{store_id}/invoices"
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.reuse_margin = reuse_margin
+        self.verify_reuse = verify_reuse
+        self.max_cached = max_cached
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=BTCPAY_POOL_SIZE)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update({"Authorization": f"token {api_key}", "Content-Type": "application/json"})
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._trial_in_flight = False
+        self._invoices = OrderedDict() # (userId, plan) -> (amount, invoice)
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)] # One creation per (userId, plan) at a time
+        self.created = 0
+        self.reused = 0
+        self.retried = 0
+        self.rejected = 0
+        self.breaker_opens = 0
+
+    # --- CIRCUIT BREAKER ---
+    def _before_call(self):
+        now = time.time()
+        with self._lock:
+            if now < self._open_until:
+                self.rejected += 1
+                BTCPAY_CALLS.inc("rejected")
+                raise BTCPayUnavailable("BTCPay circuit open", retry_after=self._open_until - now)
+            if self._consecutive_failures >= self.breaker_threshold:
+                # Half-open: a single trial call, everyone else waits for its verdict
+                if self._trial_in_flight:
+                    self.rejected += 1
+                    BTCPAY_CALLS.inc("rejected")
+                    raise BTCPayUnavailable("BTCPay circuit half-open", retry_after=1)
+                self._trial_in_flight = True
+
+    def _after_call(self, ok):
+        with self._lock:
+            self._trial_in_flight = False
+            if ok:
+                self._consecutive_failures = 0
+                return
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.breaker_threshold:
+                self._open_until = time.time() + self.breaker_cooldown
+                self.breaker_opens += 1
+                logger.error(f"🔌 BTCPay circuit open for {self.breaker_cooldown:.0f}s "
+                             f"after {self._consecutive_failures} failures")
+
+    # --- TRANSPORT ---
+    def _request(self, method, url, idempotent, **kwargs):
+        """
+        One API call with retries, counted once by the breaker. HTTP errors
+        outside RETRY_STATUSES (bad key, bad request) raise without tripping it.
+        Non-idempotent calls (invoice creation) are only retried when BTCPay
+        cannot have acted on them: no connection was made, or it answered
+        429/503.
+        """
+        self._before_call()
+        delay = BTCPAY_BACKOFF
+        attempt = 0
+        while True:
+            try:
+                response = self._session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error, retryable = e, idempotent or _never_sent(e)
+            except requests.RequestException:
+                self._after_call(ok=False)
+                BTCPAY_CALLS.inc("error")
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self._after_call(ok=True)
+                    response.raise_for_status()
+                    BTCPAY_CALLS.inc("ok")
+                    return response.json()
+                error = requests.HTTPError(f"{response.status_code} from BTCPay", response=response)
+                retryable = idempotent or response.status_code in NOT_PROCESSED_STATUSES
+            attempt += 1
+            if not retryable or attempt > self.retries:
+                self._after_call(ok=False)
+                BTCPAY_CALLS.inc("error")
+                logger.error(f"BTCPay {method} failed after {attempt} attempts: {error}")
+                raise BTCPayUnavailable(f"BTCPay unavailable: {error}", retry_after=delay)
+            with self._lock:
+                self.retried += 1
+            BTCPAY_CALLS.inc("retry")
+            time.sleep(random.uniform(0, delay)) # Full jitter
+            delay = min(delay * 2, BTCPAY_BACKOFF_MAX)
+
+    # --- INVOICES ---
+    def create_invoice(self, amount, currency, metadata=None):
+        """
+        Creates an invoice on BTCPay Server.
+        metadata: dict containing custom fields (e.g. {'userId': '123', 'plan': 'commander'})
+        """
+        payload = {
+            "amount": str(amount),
+            "currency": currency,
+            "metadata": metadata or {},
+            "checkout": {
+                "speedPolicy": "HighSpeed", # Recommend for digital goods
+                "redirectAutomatically": True,
+                "redirectURL": os.getenv("FRONTEND_URL", "https://frontend-4ok4.vercel.app/")
+            }
         }
-    }
-    
-    try:
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        logging.error(f"BTCPay Invoice Creation Failed: {e}")
-        if hasattr(e, 'response') and e.response:
-            logging.error(f"Response: {e.response.text}")
-        raise e
+        try:
+            invoice = self._request("POST", self.invoices_url, idempotent=False, json=payload)
+        except Exception as e:
+            logger.error(f"BTCPay Invoice Creation Failed: {e}")
+            if getattr(e, 'response', None) is not None:
+                logger.error(f"Response: {e.response.text}")
+            raise
+        with self._lock:
+            self.created += 1
+        return invoice
+
+    def get_invoice(self, invoice_id):
+        return self._request("GET", f"{self.invoices_url}/{invoice_id}", idempotent=True)
+
+    def _reusable(self, invoice):
+        expires_at = invoice.get("expirationTime") or 0
+        return invoice.get("status", "New") == "New" and expires_at - time.time() > self.reuse_margin
+
+    def get_or_create_invoice(self, user_id, plan, amount, currency, metadata=None):
+        """
+        The user's pending invoice for this plan if it is still payable,
+        otherwise a new one.
+        """
+        key = (user_id, plan)
+        with self._stripes[hash(key) % LOCK_STRIPES]:
+            with self._lock:
+                cached_amount, cached = self._invoices.get(key, (None, None))
+            if cached is not None and cached_amount == amount and self._reusable(cached):
+                try:
+                    current = self.get_invoice(cached["id"]) if self.verify_reuse else cached
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not check invoice {cached['id']}, creating a new one: {e}")
+                    current = None
+                if current is not None and self._reusable(current):
+                    with self._lock:
+                        self._invoices.move_to_end(key)
+                        self.reused += 1
+                    BTCPAY_CALLS.inc("reused")
+                    return cached
+
+            invoice = self.create_invoice(amount, currency, metadata)
+            with self._lock:
+                self._invoices[key] = (amount, invoice)
+                self._invoices.move_to_end(key)
+                while len(self._invoices) > self.max_cached:
+                    self._invoices.popitem(last=False)
+            return invoice
+
+    def forget_invoice(self, invoice_id):
+        """Webhook hook: the invoice was paid, expired or invalidated; never hand it out again."""
+        with self._lock:
+            for key, (_, invoice) in list(self._invoices.items()):
+                if invoice.get("id") == invoice_id:
+                    del self._invoices[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "circuit": "open" if time.time() < self._open_until else
+                           "half_open" if self._consecutive_failures >= self.breaker_threshold else "closed",
+                "consecutive_failures": self._consecutive_failures,
+                "breaker_opens": self.breaker_opens,
+                "created": self.created,
+                "reused": self.reused,
+                "retried": self.retried,
+                "rejected": self.rejected,
+                "cached_invoices": len(self._invoices)
+            }
+
+client = BTCPayClient()
+
+def create_invoice(amount, currency, metadata=None):
+    """Module-level shortcut on the shared client."""
+    return client.create_invoice(amount, currency, metadata)
 
 def verify_webhook_signature(payload_body, sig_header, secret):
     """
@@ -53,12 +275,12 @@ def verify_webhook_signature(payload_body, sig_header, secret):
     """
     if not secret:
         logging.warning("Webhook received but no secret configured. Skipping signature verification (INSECURE).")
-        return True 
-        
+        return True
+
     computed_sig = "sha256=" + hmac.new(
         key=secret.encode('utf-8'),
         msg=payload_body,
         digestmod=hashlib.sha256
     ).hexdigest()
-    
+
     return hmac.compare_digest(computed_sig, sig_header)
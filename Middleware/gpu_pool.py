@@ -0,0 +1,273 @@
+"""
+Pool of GPU nodes serving /generate_stream.
+
+Nodes come from GPU_NODE_URLS ("http://a:41216|20,http://b:41216|10" where the
+optional |N is that node's concurrency limit) and fall back to the single
+GPU_NODE_URL. Each node is probed in the background; a node that fails
+FAIL_THRESHOLD times in a row is taken out until a probe succeeds again.
+Routing picks the node with the fewest outstanding requests relative to its
+limit ("least_outstanding") or weights that by observed connect latency
+("latency").
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from metrics import UPSTREAM_ERRORS, error_kind
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NODE_LIMIT = int(os.getenv("GPU_NODE_LIMIT", 20))
+ROUTING_STRATEGY = os.getenv("GPU_ROUTING", "least_outstanding") # or "latency"
+HEALTH_PATH = os.getenv("GPU_HEALTH_PATH", "/health")
+HEALTH_INTERVAL = float(os.getenv("GPU_HEALTH_INTERVAL", 10))
+FAIL_THRESHOLD = int(os.getenv("GPU_FAIL_THRESHOLD", 3))
+CONNECT_ATTEMPTS = int(os.getenv("GPU_CONNECT_ATTEMPTS", 2)) # Distinct nodes tried before refunding
+STREAM_PATH = "/generate_stream"
+BATCH_PATH = "/generate_batch"
+EWMA_ALPHA = 0.2
+
+class NoNodeAvailable(Exception):
+    pass
+
+class GPUNode:
+    def __init__(self, base_url, limit=DEFAULT_NODE_LIMIT):
+        self.base_url = base_url.rstrip('/')
+        self.stream_url = self.base_url + STREAM_PATH
+        self.batch_url = self.base_url + BATCH_PATH
+        self.limit = limit
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.latency_ewma = None # Seconds until upstream headers
+        self.served = 0
+        self.failures = 0
+
+    def score(self, strategy):
+        load = (self.outstanding + 1) / self.limit
+        if strategy == "latency" and self.latency_ewma is not None:
+            return load * self.latency_ewma
+        return load
+
+    def snapshot(self):
+        return {
+            "url": self.base_url,
+            "limit": self.limit,
+            "outstanding": self.outstanding,
+            "healthy": self.healthy,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "served": self.served,
+            "failures": self.failures
+        }
+
+def nodes_from_env():
+    """
+    Parses GPU_NODE_URLS, falling back to GPU_NODE_URL (one node).
+    """
+    spec = os.getenv("GPU_NODE_URLS") or os.getenv("GPU_NODE_URL", "http://27.65.48.179:41216")
+    nodes = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item: continue
+        url, _, limit = item.partition('|')
+        if url.endswith(STREAM_PATH): url = url[:-len(STREAM_PATH)]
+        nodes.append(GPUNode(url, int(limit) if limit else DEFAULT_NODE_LIMIT))
+    return nodes
+
+class GPUPool:
+    def __init__(self, nodes, strategy=ROUTING_STRATEGY, on_capacity_change=None):
+        self.nodes = nodes
+        self.strategy = strategy
+        self.on_capacity_change = on_capacity_change
+        self._lock = threading.Lock()
+        # Keep-alive for the threaded path, sized so no stream waits on a socket
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max([n.limit for n in nodes] + [10]))
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._probe_thread = None
+
+    @property
+    def capacity(self):
+        """Sum of limits over healthy nodes."""
+        return sum(n.limit for n in self.nodes if n.healthy)
+
+    # --- ROUTING ---
+    def pick(self, exclude=()):
+        """
+        Reserves the best healthy node with spare capacity. Caller must
+        release() it. Raises NoNodeAvailable.
+        """
+        with self._lock:
+            candidates = [n for n in self.nodes
+                          if n.healthy and n.outstanding < n.limit and n not in exclude]
+            if not candidates:
+                raise NoNodeAvailable("No healthy GPU node with free capacity")
+            node = min(candidates, key=lambda n: n.score(self.strategy))
+            node.outstanding += 1
+            return node
+
+    def pick_batch(self, count, exclude=()):
+        """
+        Reserves up to `count` requests on the single best node (batched
+        upstream). Returns (node, reserved); release(node) once per request.
+        """
+        with self._lock:
+            candidates = [n for n in self.nodes
+                          if n.healthy and n.outstanding < n.limit and n not in exclude]
+            if not candidates:
+                raise NoNodeAvailable("No healthy GPU node with free capacity")
+            node = min(candidates, key=lambda n: (n.outstanding + count) / n.limit)
+            reserved = min(count, node.limit - node.outstanding)
+            node.outstanding += reserved
+            return node, reserved
+
+    def release(self, node):
+        with self._lock:
+            node.outstanding -= 1
+
+    def record_success(self, node, latency):
+        with self._lock:
+            node.consecutive_failures = 0
+            node.served += 1
+            node.latency_ewma = latency if node.latency_ewma is None else \
+                (1 - EWMA_ALPHA) * node.latency_ewma + EWMA_ALPHA * latency
+        self._set_health(node, True)
+
+    def record_failure(self, node):
+        with self._lock:
+            node.consecutive_failures += 1
+            node.failures += 1
+            down = node.consecutive_failures >= FAIL_THRESHOLD
+        if down:
+            self._set_health(node, False)
+
+    def _set_health(self, node, healthy):
+        with self._lock:
+            if node.healthy == healthy:
+                return
+            node.healthy = healthy
+            capacity = self.capacity
+        if healthy:
+            logger.info(f"🟢 GPU Node {node.base_url} back in rotation")
+        else:
+            logger.warning(f"🔴 GPU Node {node.base_url} taken out of rotation")
+        if self.on_capacity_change:
+            self.on_capacity_change(capacity)
+
+    # --- CONNECT WITH FAILOVER ---
+    def open_stream(self, payload, timeout=120):
+        """
+        Threaded path: POSTs to /generate_stream, failing over to another node
+        on connect errors. Returns (node, response); release(node) when done.
+        """
+        tried = []
+        last_error = None
+        for _ in range(CONNECT_ATTEMPTS):
+            node = self.pick(exclude=tried)
+            tried.append(node)
+            started = time.time()
+            response = None
+            try:
+                response = self._session.post(node.stream_url, json=payload, stream=True, timeout=timeout)
+                response.raise_for_status()
+                self.record_success(node, time.time() - started)
+                return node, response
+            except Exception as e:
+                logger.warning(f"⚠️ GPU Node {node.base_url} failed: {e}")
+                UPSTREAM_ERRORS.inc(node.base_url, error_kind(e))
+                last_error = e
+                if response is not None:
+                    response.close() # Unread error body: give the pooled connection back
+                self.record_failure(node)
+                self.release(node)
+                if len(tried) >= len(self.nodes): break
+        raise last_error
+
+    def post_batch(self, node, items, timeout=120):
+        """
+        Batched path (see upstream_batch.py): one streaming POST carrying
+        several requests to a node reserved with pick_batch(). Records
+        success/failure; the caller releases the node on failure.
+        """
+        started = time.time()
+        response = None
+        try:
+            response = self._session.post(node.batch_url, json={"requests": items}, stream=True, timeout=timeout)
+            response.raise_for_status()
+        except Exception as e:
+            if response is not None:
+                response.close()
+            UPSTREAM_ERRORS.inc(node.base_url, error_kind(e))
+            self.record_failure(node)
+            raise
+        self.record_success(node, time.time() - started)
+        return response
+
+    async def open_stream_async(self, client, payload):
+        """
+        ASGI path: same failover as open_stream() over a shared httpx.AsyncClient.
+        """
+        tried = []
+        last_error = None
+        for _ in range(CONNECT_ATTEMPTS):
+            node = self.pick(exclude=tried)
+            tried.append(node)
+            started = time.time()
+            response = None
+            try:
+                response = await client.send(client.build_request("POST", node.stream_url, json=payload), stream=True)
+                response.raise_for_status()
+                self.record_success(node, time.time() - started)
+                return node, response
+            except Exception as e:
+                logger.warning(f"⚠️ GPU Node {node.base_url} failed: {e}")
+                UPSTREAM_ERRORS.inc(node.base_url, error_kind(e))
+                last_error = e
+                if response is not None:
+                    await response.aclose()
+                self.record_failure(node)
+                self.release(node)
+                if len(tried) >= len(self.nodes): break
+        raise last_error
+
+    # --- ACTIVE HEALTH PROBES ---
+    def probe(self, node):
+        """
+        Any HTTP answer below 500 counts as alive (the node may not expose
+        a dedicated health route).
+        """
+        try:
+            r = self._session.get(node.base_url + HEALTH_PATH, timeout=3)
+            ok = r.status_code < 500
+        except Exception:
+            ok = False
+        if ok:
+            with self._lock:
+                node.consecutive_failures = 0
+            self._set_health(node, True)
+        else:
+            self.record_failure(node)
+        return ok
+
+    def start_probes(self, interval=HEALTH_INTERVAL):
+        def loop():
+            while True:
+                for node in self.nodes:
+                    self.probe(node)
+                time.sleep(interval)
+        if self._probe_thread is None and interval > 0:
+            self._probe_thread = threading.Thread(target=loop, daemon=True)
+            self._probe_thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "strategy": self.strategy,
+                "capacity": self.capacity,
+                "nodes": [n.snapshot() for n in self.nodes]
+            }
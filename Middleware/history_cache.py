@@ -0,0 +1,99 @@
+"""
+In-process LRU of the last few messages per chat session.
+
+Prompt construction only ever looks at the tail of a conversation, so /chat
+keeps that tail here and the database is only asked for a $slice of it on a
+miss. save_chat_turn() appends new messages to a cached tail; anything that
+rewrites a session wholesale invalidates it.
+
+Nothing tells this process about turns another worker appended, so a tail
+is only trusted for HISTORY_CACHE_TTL seconds after it was read from the
+database. Appends made here don't extend that.
+"""
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+HISTORY_CACHE_SESSIONS = int(os.getenv("HISTORY_CACHE_SESSIONS", 5000))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", 10))
+
+class _Loading:
+    """Placeholder for a session whose tail is being read from the DB."""
+    __slots__ = ("token",)
+
+    def __init__(self, token):
+        self.token = token
+
+class _Tail:
+    """A cached tail and the time it stops being trusted."""
+    __slots__ = ("messages", "expires_at")
+
+    def __init__(self, messages, turns, expires_at):
+        self.messages = deque(messages, maxlen=turns)
+        self.expires_at = expires_at
+
+class RecentTurnsCache:
+    def __init__(self, turns, max_sessions=HISTORY_CACHE_SESSIONS, ttl=HISTORY_CACHE_TTL):
+        self.turns = turns
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tokens = itertools.count()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id):
+        """Cached tail (oldest first) or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if isinstance(entry, _Tail):
+                if entry.expires_at > time.time():
+                    self._entries.move_to_end(session_id)
+                    self.hits += 1
+                    return list(entry.messages)
+                del self._entries[session_id]
+            self.misses += 1
+            return None
+
+    def begin_load(self, session_id):
+        """
+        Marks a DB read in flight. Writes that land before finish_load()
+        discard the marker so a stale read can't be cached.
+        """
+        token = next(self._tokens)
+        with self._lock:
+            if not isinstance(self._entries.get(session_id), _Tail):
+                self._entries[session_id] = _Loading(token)
+                self._evict()
+        return token
+
+    def finish_load(self, session_id, messages, token):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if isinstance(entry, _Loading) and entry.token == token:
+                self._entries[session_id] = _Tail(messages, self.turns, time.time() + self.ttl)
+
+    def append(self, session_id, messages):
+        """Called after new messages are persisted."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if isinstance(entry, _Tail):
+                entry.messages.extend(messages)
+                self._entries.move_to_end(session_id)
+            elif entry is not None:
+                del self._entries[session_id]
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def _evict(self):
+        while len(self._entries) > self.max_sessions:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._entries), "hits": self.hits, "misses": self.misses}
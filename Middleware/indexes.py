@@ -0,0 +1,178 @@
+"""
+Index registry: every index the middleware's queries rely on, declared in
+one place instead of made by hand in Atlas.
+
+ensure_indexes() runs at startup (INDEX_MODE=create, the default) and builds
+whatever is missing; INDEX_MODE=verify only reports missing indexes, for
+deployments where the app user cannot build indexes. check_query_plans()
+explains the hot route queries against a live database and reports any
+plan that falls back to a COLLSCAN:
+
+    python indexes.py --uri mongodb://... --ensure
+    python indexes.py --uri mongodb://... --check-plans   # exits 1 on a COLLSCAN (post-deploy)
+    INDEX_TEST_MONGO_URI=mongodb://localhost:27017 python -m pytest -q test_indexes.py   # CI
+
+The CLI takes --uri (default $MONGO_URI) and never falls back to the
+server's built-in URI. The test runs in a throwaway database.
+
+A new query on the request path should add both its index here and its
+shape to ROUTE_QUERIES.
+"""
+import logging
+import os
+
+from pymongo.errors import OperationFailure
+
+from payment_queue import claimable
+
+logger = logging.getLogger(__name__)
+
+INDEX_MODE = os.getenv("INDEX_MODE", "create")
+
+# collection -> [(keys, options)]
+INDEXES = {
+    "users": [
+        ([("id", 1)], {"unique": True}),
+        ([("username", 1)], {"unique": True}),
+        ([("referred_by", 1)], {}), # admin referral counts ($lookup)
+    ],
+    "sessions": [
+        ([("id", 1)], {"unique": True}),
+        ([("userId", 1)], {}),
+    ],
+    "messages": [
+        ([("sessionId", 1), ("seq", 1)], {"unique": True}),
+        ([("userId", 1)], {}),
+    ],
+    "ledger": [
+        ([("id", 1)], {"unique": True}), # idempotent write-behind upserts
+        ([("userId", 1)], {}),
+    ],
+    "payments": [
+        ([("invoiceId", 1)], {"unique": True}), # idempotent payment_queue upserts
+    ],
+    "payment_events": [
+        ([("invoiceId", 1)], {"unique": True}), # webhook deduplication
+        ([("status", 1), ("claimed_at", 1)], {}), # payment_queue claims
+    ],
+    "payouts": [
+        ([("id", 1)], {"unique": True}),
+        ([("userId", 1), ("status", 1)], {}),
+        ([("timestamp", 1)], {}), # admin export sort / date range
+    ],
+    "stats": [
+        ([("id", 1)], {"unique": True}),
+    ],
+}
+
+# Representative query shape of each route: (route, collection, filter, sort)
+ROUTE_QUERIES = [
+    ("auth: load user", "users", {"id": "x"}, None),
+    ("login / signup", "users", {"username": "x"}, None),
+    ("payment queue buyers", "users", {"id": {"$in": ["x", "y"]}}, None),
+    ("payment queue credit", "users", {"id": "x", "payments_applied": {"$ne": "inv"}}, None),
+    ("payment queue commission", "users", {"username": "x", "commissions_applied": {"$ne": "inv"}}, None),
+    ("sessions list", "sessions", {"userId": "x"}, None),
+    ("session by id", "sessions", {"id": "x"}, None),
+    ("session messages page", "messages", {"sessionId": "x", "seq": {"$lt": 0}}, [("seq", -1)]),
+    ("sessions list history", "messages", {"sessionId": {"$in": ["x", "y"]}}, [("sessionId", 1), ("seq", 1)]),
+    ("delete user messages", "messages", {"userId": "x"}, None),
+    ("message feedback", "messages", {"sessionId": "x", "id": "m"}, None),
+    ("message store migration", "messages", {"sessionId": "x", "migrated": {"$exists": False}}, [("seq", -1)]),
+    ("webhook dedup / payment record", "payments", {"invoiceId": "x"}, None),
+    ("payment queue claim", "payment_events", claimable(0), None),
+    ("payment queue claimed batch", "payment_events", {"claim": "x", "status": "processing"}, None),
+    ("payment queue done", "payment_events", {"invoiceId": {"$in": ["x", "y"]}, "claim": "x", "status": "processing"}, None),
+    ("payment queue backlog", "payment_events", {"status": {"$in": ["pending", "processing"]}}, None),
+    ("pending payout", "payouts", {"userId": "x", "status": "pending"}, None),
+    ("payout by id", "payouts", {"id": "x"}, None),
+    ("payout export", "payouts", {"timestamp": {"$gte": "2000-01-01"}}, [("timestamp", 1)]),
+    ("admin stats", "stats", {"id": "global"}, None),
+]
+
+def index_key(keys):
+    return tuple((k, int(d)) for k, d in keys)
+
+def ensure_indexes(db, create=None):
+    """
+    Creates (or, with create=False, only checks for) every registered index.
+    Returns the list of "collection: keys" that are missing afterwards;
+    failures (e.g. duplicates blocking a unique index) are logged, never raised,
+    so a bad index never keeps the server from starting.
+    """
+    if create is None:
+        create = INDEX_MODE != "verify"
+    missing = []
+    for name, specs in INDEXES.items():
+        coll = db[name]
+        existing = {index_key(info["key"]): info for info in coll.index_information().values()} if not create else {}
+        for keys, options in specs:
+            label = f"{name}: {', '.join(k for k, _ in keys)}"
+            if create:
+                try:
+                    coll.create_index(keys, **options)
+                except OperationFailure as e:
+                    logger.error(f"❌ Index {label} could not be built: {e}")
+                    missing.append(label)
+                continue
+            info = existing.get(index_key(keys))
+            if info is None or bool(info.get("unique")) != bool(options.get("unique")):
+                logger.warning(f"⚠️ Index {label} missing or has different options")
+                missing.append(label)
+    if not missing:
+        logger.info(f"✅ {sum(len(s) for s in INDEXES.values())} indexes in place")
+    return missing
+
+# --- QUERY PLANS ---
+def plan_stages(plan):
+    """All stage names in an explain() plan tree (classic and SBE layouts)."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for v in plan.values():
+            yield from plan_stages(v)
+    elif isinstance(plan, list):
+        for v in plan:
+            yield from plan_stages(v)
+
+def check_query_plans(db):
+    """
+    Explains every ROUTE_QUERIES entry. Returns [(route, stages)] for the
+    plans that scan a whole collection.
+    """
+    failures = []
+    for route, name, query, sort in ROUTE_QUERIES:
+        cursor = db[name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = list(plan_stages(winning))
+        if "COLLSCAN" in stages:
+            failures.append((route, stages))
+    return failures
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Index registry maintenance")
+    parser.add_argument("--ensure", action="store_true", help="Create missing indexes")
+    parser.add_argument("--verify", action="store_true", help="Only report missing indexes")
+    parser.add_argument("--check-plans", action="store_true", help="Fail if any route query plan is a COLLSCAN")
+    parser.add_argument("--uri", default=os.getenv("MONGO_URI"), help="MongoDB URI (default: $MONGO_URI)")
+    parser.add_argument("--db", default=os.getenv("DB_NAME", "dictator_ai_db"))
+    args = parser.parse_args()
+    if not args.uri:
+        sys.exit("[ERR] Pass --uri or set MONGO_URI")
+    from pymongo import MongoClient
+    db = MongoClient(args.uri, serverSelectionTimeoutMS=5000)[args.db]
+    failed = False
+    if args.ensure or args.verify:
+        failed |= bool(ensure_indexes(db, create=args.ensure))
+    if args.check_plans:
+        for route, stages in check_query_plans(db):
+            print(f"[FAIL] {route}: {' <- '.join(stages)}")
+            failed = True
+        if not failed:
+            print(f"[OK] {len(ROUTE_QUERIES)} route queries use indexes")
+    sys.exit(1 if failed else 0)
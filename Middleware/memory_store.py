@@ -0,0 +1,1065 @@
+"""
+In-memory document store mirroring the pymongo subset this server uses.
+
+Replaces the old list-scanning MockCollection for MONGO_URI=mock (local dev,
+bench.py, tests). MemoryDatabase()["name"] returns a MemoryCollection with
+the same call signatures and result types as pymongo:
+
+  * find / find_one / count_documents / distinct with the query operators
+    the routes use ($eq $ne $gt $gte $lt $lte $in $nin $exists $regex $size
+    $elemMatch $not $and $or $nor, dotted paths, array fields); find returns
+    a cursor with sort / skip / limit / batch_size / explain;
+  * insert / update / replace / delete (one and many), find_one_and_update
+    / _delete, bulk_write, with $set $unset $inc $min $max $push ($each,
+    $slice) $addToSet $pull $setOnInsert and upserts;
+  * aggregate: $match $project $addFields/$set $unset $group $sort $skip
+    $limit $count $unwind $lookup $facet $replaceRoot, with the expression
+    operators the admin pipelines need;
+  * create_index: hash indexes on equality fields (compound included) that
+    point lookups use instead of a scan, with unique enforcement
+    (DuplicateKeyError), so indexes.py applies here unchanged.
+
+Every call holds the collection's lock, so find_one_and_update is as atomic
+as in Mongo. Documents are copied in and out; callers never share state
+with the store.
+
+MEMORY_SNAPSHOT=<path> loads the store from that pickle at start and writes
+it back at exit (and every MEMORY_SNAPSHOT_INTERVAL seconds, if set).
+"""
+import atexit
+import itertools
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ReturnDocument, InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+logger = logging.getLogger(__name__)
+
+MEMORY_SNAPSHOT = os.getenv("MEMORY_SNAPSHOT") # Unset = nothing persisted
+MEMORY_SNAPSHOT_INTERVAL = float(os.getenv("MEMORY_SNAPSHOT_INTERVAL", 0)) # 0 = only at exit
+
+_MISSING = object()
+
+# --- VALUES ---
+def _clone(v):
+    if isinstance(v, dict):
+        return {k: _clone(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_clone(x) for x in v]
+    return v
+
+def _hashable(v):
+    if isinstance(v, dict):
+        return ("d", tuple((k, _hashable(x)) for k, x in v.items()))
+    if isinstance(v, list):
+        return ("l", tuple(_hashable(x) for x in v))
+    return v
+
+# Cross-type order, roughly BSON's: null < numbers < strings < objects < arrays < ObjectId < bool < dates
+def _type_rank(v):
+    if v is None or v is _MISSING: return 0
+    if isinstance(v, bool): return 6
+    if isinstance(v, (int, float)): return 1
+    if isinstance(v, str): return 2
+    if isinstance(v, dict): return 3
+    if isinstance(v, list): return 4
+    if isinstance(v, ObjectId): return 5
+    if isinstance(v, datetime): return 7
+    return 8
+
+def _sort_key(v):
+    rank = _type_rank(v)
+    if rank == 0: return (0, 0)
+    if rank in (3, 4, 8): return (rank, repr(v))
+    return (rank, v)
+
+def _compare(a, b):
+    ka, kb = _sort_key(a), _sort_key(b)
+    return (ka > kb) - (ka < kb)
+
+# --- PATHS ---
+def _values(doc, parts):
+    """Every value a dotted path reaches, traversing arrays like Mongo does."""
+    if not parts:
+        yield doc
+        return
+    head, rest = parts[0], parts[1:]
+    if isinstance(doc, dict):
+        if head in doc:
+            yield from _values(doc[head], rest)
+    elif isinstance(doc, list):
+        if head.isdigit():
+            if int(head) < len(doc):
+                yield from _values(doc[int(head)], rest)
+        else:
+            for item in doc:
+                if isinstance(item, dict):
+                    yield from _values(item, parts)
+
+def _get(doc, path, default=None):
+    """Plain (non-array-traversing) lookup of a dotted path."""
+    for part in path.split('.'):
+        if isinstance(doc, dict) and part in doc:
+            doc = doc[part]
+        elif isinstance(doc, list) and part.isdigit() and int(part) < len(doc):
+            doc = doc[int(part)]
+        else:
+            return default
+    return doc
+
+def _parent(doc, path, create):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(doc, list) and part.isdigit():
+            doc = doc[int(part)]
+            continue
+        nxt = doc.get(part)
+        if not isinstance(nxt, (dict, list)):
+            if not create:
+                return None, parts[-1]
+            nxt = doc[part] = {}
+        doc = nxt
+    return doc, parts[-1]
+
+def _set(doc, path, value):
+    parent, key = _parent(doc, path, create=True)
+    if isinstance(parent, list):
+        parent[int(key)] = value
+    else:
+        parent[key] = value
+
+def _unset(doc, path):
+    parent, key = _parent(doc, path, create=False)
+    if isinstance(parent, dict):
+        parent.pop(key, None)
+
+# --- QUERIES ---
+def _eq(value, target):
+    if value == target and _type_rank(value) == _type_rank(target):
+        return True
+    return isinstance(value, list) and not isinstance(target, list) and any(_eq(v, target) for v in value)
+
+def _flat(values):
+    for v in values:
+        if isinstance(v, list):
+            yield from v
+        yield v
+
+def _cmp_any(values, target, test):
+    rank = _type_rank(target)
+    return any(_type_rank(v) == rank and test(_compare(v, target)) for v in _flat(values))
+
+def _is_operator_dict(v):
+    return isinstance(v, dict) and v and all(k.startswith('$') for k in v)
+
+def _match_condition(values, cond):
+    """values: everything the field path reached (empty = missing)."""
+    if not _is_operator_dict(cond):
+        if cond is None:
+            return not values or any(v is None for v in values)
+        return any(_eq(v, cond) for v in values)
+    for op, arg in cond.items():
+        if op == "$eq":
+            ok = _match_condition(values, arg)
+        elif op == "$ne":
+            ok = not _match_condition(values, arg)
+        elif op == "$gt":
+            ok = _cmp_any(values, arg, lambda c: c > 0)
+        elif op == "$gte":
+            ok = _cmp_any(values, arg, lambda c: c >= 0)
+        elif op == "$lt":
+            ok = _cmp_any(values, arg, lambda c: c < 0)
+        elif op == "$lte":
+            ok = _cmp_any(values, arg, lambda c: c <= 0)
+        elif op == "$in":
+            ok = any(_match_condition(values, a) for a in arg)
+        elif op == "$nin":
+            ok = not any(_match_condition(values, a) for a in arg)
+        elif op == "$exists":
+            ok = bool(values) == bool(arg)
+        elif op == "$regex":
+            pattern = arg if hasattr(arg, "search") else re.compile(arg, _regex_flags(cond.get("$options", "")))
+            ok = any(isinstance(v, str) and pattern.search(v) for v in _flat(values))
+        elif op == "$options":
+            continue
+        elif op == "$size":
+            ok = any(isinstance(v, list) and len(v) == arg for v in values)
+        elif op == "$elemMatch":
+            ok = any(isinstance(v, list) and any(
+                _matches(e, arg) if isinstance(e, dict) and not _is_operator_dict(arg) else _match_condition([e], arg)
+                for e in v) for v in values)
+        elif op == "$not":
+            ok = not _match_condition(values, arg)
+        else:
+            raise OperationFailure(f"Unsupported query operator {op} in the in-memory store")
+        if not ok:
+            return False
+    return True
+
+def _regex_flags(options):
+    flags = 0
+    if "i" in options: flags |= re.I
+    if "m" in options: flags |= re.M
+    if "s" in options: flags |= re.S
+    if "x" in options: flags |= re.X
+    return flags
+
+def _matches(doc, query):
+    for key, cond in (query or {}).items():
+        if key == "$and":
+            if not all(_matches(doc, q) for q in cond): return False
+        elif key == "$or":
+            if not any(_matches(doc, q) for q in cond): return False
+        elif key == "$nor":
+            if any(_matches(doc, q) for q in cond): return False
+        elif key == "$comment":
+            continue
+        elif not _match_condition(list(_values(doc, key.split('.'))), cond):
+            return False
+    return True
+
+def _equality_fields(query):
+    """Top-level scalar equality conditions (the ones a hash index can serve)."""
+    eq = {}
+    for key, cond in (query or {}).items():
+        if key.startswith('$'):
+            continue
+        if _is_operator_dict(cond):
+            if set(cond) == {"$eq"} and not isinstance(cond["$eq"], (dict, list)):
+                eq[key] = cond["$eq"]
+        elif not isinstance(cond, (dict, list)) and cond is not None:
+            eq[key] = cond
+    return eq
+
+# --- PROJECTION ---
+def _project(doc, projection):
+    if not projection:
+        return _clone(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {f: 1 for f in projection}
+    slices = {k: v["$slice"] for k, v in projection.items() if isinstance(v, dict) and "$slice" in v}
+    flags = {k: v for k, v in projection.items() if k not in slices}
+    include = [k for k, v in flags.items() if v and k != "_id"]
+    if include:
+        out = {}
+        if flags.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        for k in include + list(slices):
+            value = _get(doc, k, _MISSING)
+            if value is not _MISSING:
+                _set(out, k, _clone(value))
+    else:
+        out = _clone(doc)
+        for k, v in flags.items():
+            if not v: _unset(out, k)
+    for k, n in slices.items():
+        value = _get(out, k)
+        if isinstance(value, list):
+            if isinstance(n, list):
+                _set(out, k, value[n[0]:n[0] + n[1]] if n[0] >= 0 else value[n[0]:][:n[1]])
+            else:
+                _set(out, k, value[n:] if n < 0 else value[:n])
+    return out
+
+def _sort_docs(docs, sort):
+    if isinstance(sort, dict):
+        sort = list(sort.items())
+    for key, direction in reversed(sort or []):
+        docs.sort(key=lambda d: _sort_key(_get(d, key)), reverse=direction < 0)
+    return docs
+
+# --- UPDATES ---
+def _apply_update(doc, update, inserting=False):
+    """Applies update operators to doc in place."""
+    for op, fields in update.items():
+        if op == "$setOnInsert":
+            if inserting:
+                for k, v in fields.items(): _set(doc, k, _clone(v))
+        elif op == "$set":
+            for k, v in fields.items(): _set(doc, k, _clone(v))
+        elif op == "$unset":
+            for k in fields: _unset(doc, k)
+        elif op == "$inc":
+            for k, v in fields.items(): _set(doc, k, _get(doc, k, 0) + v)
+        elif op == "$mul":
+            for k, v in fields.items(): _set(doc, k, _get(doc, k, 0) * v)
+        elif op in ("$min", "$max"):
+            for k, v in fields.items():
+                current = _get(doc, k, _MISSING)
+                if current is _MISSING or (_compare(v, current) < 0 if op == "$min" else _compare(v, current) > 0):
+                    _set(doc, k, _clone(v))
+        elif op in ("$push", "$addToSet"):
+            for k, v in fields.items():
+                items = v["$each"] if isinstance(v, dict) and "$each" in v else [v]
+                array = _get(doc, k)
+                if array is None:
+                    array = []
+                    _set(doc, k, array)
+                elif not isinstance(array, list):
+                    raise OperationFailure(f"The field '{k}' must be an array")
+                for item in items:
+                    if op == "$push" or not any(_eq(e, item) and _type_rank(e) == _type_rank(item) for e in array):
+                        array.append(_clone(item))
+                if op == "$push" and isinstance(v, dict) and "$slice" in v:
+                    n = v["$slice"]
+                    _set(doc, k, array[n:] if n < 0 else array[:n])
+        elif op == "$pull":
+            for k, cond in fields.items():
+                array = _get(doc, k)
+                if isinstance(array, list):
+                    _set(doc, k, [e for e in array if not (
+                        _matches(e, cond) if isinstance(e, dict) and isinstance(cond, dict) and not _is_operator_dict(cond)
+                        else _match_condition([e], cond))])
+        elif op == "$rename":
+            for k, new in fields.items():
+                value = _get(doc, k, _MISSING)
+                if value is not _MISSING:
+                    _unset(doc, k)
+                    _set(doc, new, value)
+        else:
+            raise OperationFailure(f"Unsupported update operator {op} in the in-memory store")
+
+def _upsert_seed(query):
+    """The equality fields of an upsert's filter become the new document."""
+    doc = {}
+    for key, cond in (query or {}).items():
+        if key == "$and":
+            for q in cond: doc.update(_upsert_seed(q))
+        elif key.startswith('$'):
+            continue
+        elif not _is_operator_dict(cond):
+            _set(doc, key, _clone(cond))
+        elif "$eq" in cond:
+            _set(doc, key, _clone(cond["$eq"]))
+    return doc
+
+def _is_update(update):
+    return bool(update) and all(k.startswith('$') for k in update)
+
+# --- AGGREGATION EXPRESSIONS ---
+def _field(doc, path):
+    """$path value; arrays of subdocuments map to arrays (like "$items.price")."""
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list):
+            value = [x[part] for x in value if isinstance(x, dict) and part in x]
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+def _v(x):
+    return None if x is _MISSING else x
+
+def _numbers(values):
+    return [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+
+def _args(doc, arg, variables):
+    return [_v(_eval(a, doc, variables)) for a in (arg if isinstance(arg, list) else [arg])]
+
+def _op_cond(doc, arg, variables):
+    if isinstance(arg, dict):
+        arg = [arg["if"], arg["then"], arg["else"]]
+    test = _v(_eval(arg[0], doc, variables))
+    return _eval(arg[1] if test not in (None, False, 0) else arg[2], doc, variables)
+
+def _op_if_null(doc, arg, variables):
+    for a in arg[:-1]:
+        value = _v(_eval(a, doc, variables))
+        if value is not None:
+            return value
+    return _eval(arg[-1], doc, variables)
+
+def _sum(values):
+    if len(values) == 1 and isinstance(values[0], list):
+        values = values[0]
+    return sum(_numbers(values))
+
+def _first_last(index):
+    def op(doc, arg, variables):
+        value = _args(doc, arg, variables)[0]
+        return value[index] if isinstance(value, list) and value else _MISSING
+    return op
+
+_EXPRESSIONS = {
+    "$literal": lambda doc, arg, variables: arg,
+    "$cond": _op_cond,
+    "$ifNull": _op_if_null,
+    "$eq": lambda doc, arg, variables: _compare(*_args(doc, arg, variables)) == 0,
+    "$ne": lambda doc, arg, variables: _compare(*_args(doc, arg, variables)) != 0,
+    "$gt": lambda doc, arg, variables: _compare(*_args(doc, arg, variables)) > 0,
+    "$gte": lambda doc, arg, variables: _compare(*_args(doc, arg, variables)) >= 0,
+    "$lt": lambda doc, arg, variables: _compare(*_args(doc, arg, variables)) < 0,
+    "$lte": lambda doc, arg, variables: _compare(*_args(doc, arg, variables)) <= 0,
+    "$and": lambda doc, arg, variables: all(v not in (None, False, 0) for v in _args(doc, arg, variables)),
+    "$or": lambda doc, arg, variables: any(v not in (None, False, 0) for v in _args(doc, arg, variables)),
+    "$not": lambda doc, arg, variables: _args(doc, arg, variables)[0] in (None, False, 0),
+    "$in": lambda doc, arg, variables: (lambda a: a[0] in (a[1] or []))(_args(doc, arg, variables)),
+    "$add": lambda doc, arg, variables: sum(_numbers(_args(doc, arg, variables))),
+    "$subtract": lambda doc, arg, variables: (lambda a: a[0] - a[1])(_args(doc, arg, variables)),
+    "$multiply": lambda doc, arg, variables: (lambda a: a[0] * a[1])(_args(doc, arg, variables)),
+    "$divide": lambda doc, arg, variables: (lambda a: a[0] / a[1])(_args(doc, arg, variables)),
+    "$sum": lambda doc, arg, variables: _sum(_args(doc, arg, variables)),
+    "$max": lambda doc, arg, variables: max(_flat_args(_args(doc, arg, variables)), key=_sort_key, default=None),
+    "$min": lambda doc, arg, variables: min(_flat_args(_args(doc, arg, variables)), key=_sort_key, default=None),
+    "$first": _first_last(0),
+    "$last": _first_last(-1),
+    "$arrayElemAt": lambda doc, arg, variables: (lambda a: a[0][a[1]] if isinstance(a[0], list) and -len(a[0]) <= a[1] < len(a[0]) else _MISSING)(_args(doc, arg, variables)),
+    "$size": lambda doc, arg, variables: len(_args(doc, arg, variables)[0]),
+    "$concat": lambda doc, arg, variables: (lambda a: None if None in a else "".join(a))(_args(doc, arg, variables)),
+    "$toLower": lambda doc, arg, variables: str(_args(doc, arg, variables)[0] or "").lower(),
+    "$toUpper": lambda doc, arg, variables: str(_args(doc, arg, variables)[0] or "").upper(),
+    "$toString": lambda doc, arg, variables: (lambda v: None if v is None else str(v))(_args(doc, arg, variables)[0]),
+}
+
+def _flat_args(values):
+    return [x for v in values for x in (v if isinstance(v, list) else [v]) if x is not None]
+
+def _eval(expr, doc, variables=None):
+    if isinstance(expr, str) and expr.startswith('$'):
+        if expr.startswith('$$'):
+            name, _, path = expr[2:].partition('.')
+            base = doc if name in ("ROOT", "CURRENT") else (variables or {}).get(name, _MISSING)
+            return _field(base, path) if path else base
+        return _field(doc, expr[1:])
+    if isinstance(expr, list):
+        return [_v(_eval(e, doc, variables)) for e in expr]
+    if isinstance(expr, dict):
+        if len(expr) == 1:
+            op, arg = next(iter(expr.items()))
+            if op.startswith('$'):
+                fn = _EXPRESSIONS.get(op)
+                if fn is None:
+                    raise OperationFailure(f"Unsupported expression {op} in the in-memory store")
+                return fn(doc, arg, variables)
+        return {k: _v(_eval(v, doc, variables)) for k, v in expr.items()}
+    return expr
+
+# --- AGGREGATION STAGES ---
+def _stage_project(docs, spec, db):
+    out = []
+    flags = {k: v for k, v in spec.items() if v in (0, 1, True, False)}
+    exprs = {k: v for k, v in spec.items() if k not in flags}
+    inclusion = exprs or any(v and k != "_id" for k, v in flags.items())
+    for doc in docs:
+        if inclusion:
+            new = {}
+            if flags.get("_id", 1) and "_id" in doc:
+                new["_id"] = doc["_id"]
+            for k, v in flags.items():
+                if v and k != "_id":
+                    value = _get(doc, k, _MISSING)
+                    if value is not _MISSING: _set(new, k, value)
+            for k, e in exprs.items():
+                value = _eval(e, doc)
+                if value is not _MISSING: _set(new, k, value)
+        else:
+            new = dict(doc)
+            for k in flags: _unset(new, k)
+        out.append(new)
+    return out
+
+def _stage_add_fields(docs, spec, db):
+    out = []
+    for doc in docs:
+        new = dict(doc)
+        for k, e in spec.items():
+            value = _eval(e, doc)
+            if value is _MISSING: _unset(new, k)
+            else: _set(new, k, value)
+        out.append(new)
+    return out
+
+def _stage_unset(docs, spec, db):
+    fields = [spec] if isinstance(spec, str) else spec
+    out = []
+    for doc in docs:
+        new = dict(doc)
+        for k in fields: _unset(new, k)
+        out.append(new)
+    return out
+
+def _accumulate(op, arg, rows):
+    if op == "$sum":
+        return sum(_numbers([_v(_eval(arg, d)) for d in rows]))
+    if op == "$count":
+        return len(rows)
+    values = [_eval(arg, d) for d in rows]
+    present = [v for v in values if v is not _MISSING]
+    if op == "$avg":
+        nums = _numbers(present)
+        return sum(nums) / len(nums) if nums else None
+    if op == "$min":
+        return min((v for v in present if v is not None), key=_sort_key, default=None)
+    if op == "$max":
+        return max((v for v in present if v is not None), key=_sort_key, default=None)
+    if op == "$first":
+        return _v(values[0]) if values else None
+    if op == "$last":
+        return _v(values[-1]) if values else None
+    if op == "$push":
+        return present
+    if op == "$addToSet":
+        seen, out = set(), []
+        for v in present:
+            if _hashable(v) not in seen:
+                seen.add(_hashable(v))
+                out.append(v)
+        return out
+    raise OperationFailure(f"Unsupported accumulator {op} in the in-memory store")
+
+def _stage_group(docs, spec, db):
+    groups = {}
+    for doc in docs:
+        key = _v(_eval(spec["_id"], doc))
+        groups.setdefault(_hashable(key), (key, []))[1].append(doc)
+    out = []
+    for key, rows in groups.values():
+        row = {"_id": key}
+        for field, acc in spec.items():
+            if field == "_id": continue
+            (op, arg), = acc.items()
+            row[field] = _accumulate(op, arg, rows)
+        out.append(row)
+    return out
+
+def _stage_unwind(docs, spec, db):
+    if isinstance(spec, str):
+        spec = {"path": spec}
+    path = spec["path"][1:]
+    keep = spec.get("preserveNullAndEmptyArrays", False)
+    index_field = spec.get("includeArrayIndex")
+    out = []
+    for doc in docs:
+        value = _get(doc, path, _MISSING)
+        if isinstance(value, list) and value:
+            for i, item in enumerate(value):
+                new = dict(doc)
+                _set(new, path, item)
+                if index_field: new[index_field] = i
+                out.append(new)
+        elif isinstance(value, list) or value is _MISSING or value is None:
+            if keep:
+                new = dict(doc)
+                if index_field: new[index_field] = None
+                out.append(new)
+        else:
+            new = dict(doc)
+            if index_field: new[index_field] = None
+            out.append(new)
+    return out
+
+def _stage_lookup(docs, spec, db):
+    if db is None:
+        raise OperationFailure("$lookup needs a database")
+    foreign = db[spec["from"]]
+    sub = spec.get("pipeline")
+    out = []
+    for doc in docs:
+        if "localField" in spec:
+            local = _field(doc, spec["localField"])
+            local = _v(local)
+            targets = local if isinstance(local, list) else [local]
+            query = {spec["foreignField"]: {"$in": targets}} if len(targets) != 1 else {spec["foreignField"]: targets[0]}
+            matched = list(foreign.find(query))
+        else:
+            matched = list(foreign.find({}))
+        if sub:
+            matched = _run_pipeline(matched, sub, db)
+        new = dict(doc)
+        new[spec["as"]] = matched
+        out.append(new)
+    return out
+
+def _stage_facet(docs, spec, db):
+    return [{name: _run_pipeline(list(docs), pipeline, db) for name, pipeline in spec.items()}]
+
+def _stage_count(docs, spec, db):
+    return [{spec: len(docs)}] if docs else []
+
+def _stage_replace_root(docs, spec, db):
+    return [_eval(spec["newRoot"], doc) for doc in docs]
+
+_STAGES = {
+    "$match": lambda docs, spec, db: [d for d in docs if _matches(d, spec)],
+    "$project": _stage_project,
+    "$addFields": _stage_add_fields,
+    "$set": _stage_add_fields,
+    "$unset": _stage_unset,
+    "$group": _stage_group,
+    "$sort": lambda docs, spec, db: _sort_docs(list(docs), spec),
+    "$skip": lambda docs, spec, db: docs[spec:],
+    "$limit": lambda docs, spec, db: docs[:spec],
+    "$count": _stage_count,
+    "$unwind": _stage_unwind,
+    "$lookup": _stage_lookup,
+    "$facet": _stage_facet,
+    "$replaceRoot": _stage_replace_root,
+}
+
+def _run_pipeline(docs, pipeline, db):
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        fn = _STAGES.get(name)
+        if fn is None:
+            raise OperationFailure(f"Unsupported aggregation stage {name} in the in-memory store")
+        docs = fn(docs, spec, db)
+    return docs
+
+# --- CURSOR ---
+class MemoryCursor:
+    """Lazy like a pymongo Cursor: sort/skip/limit may be chained until iteration starts."""
+    def __init__(self, collection, query, projection=None, sort=None, skip=0, limit=0):
+        self._collection = collection
+        self._query = query or {}
+        self._projection = projection
+        self._sort = sort
+        self._skip = skip
+        self._limit = limit
+        self._results = None
+
+    def sort(self, key_or_list, direction=1):
+        self._sort = key_or_list if isinstance(key_or_list, (list, dict)) else [(key_or_list, direction)]
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def close(self):
+        pass
+
+    def _evaluate(self):
+        if self._results is None:
+            self._results = iter(self._collection._query(self._query, self._projection, self._sort, self._skip, self._limit))
+        return self._results
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._evaluate())
+
+    next = __next__
+
+    def explain(self):
+        index = self._collection._plan(self._query)
+        if index is None:
+            plan = {"stage": "COLLSCAN"}
+        else:
+            plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": index}}
+        return {"queryPlanner": {"winningPlan": plan}}
+
+# --- COLLECTION ---
+class MemoryCollection:
+    def __init__(self, name="", database=None):
+        self.name = name
+        self.database = database
+        self._lock = threading.RLock()
+        self._docs = {} # internal key -> document, insertion ordered
+        self._keys = itertools.count()
+        self._indexes = {} # name -> {"key": [(field, dir)], "unique": bool, "map": {values: {keys}}}
+        self.create_index([("_id", 1)], name="_id_", unique=True)
+
+    # --- INDEXES ---
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = list(keys)
+        name = name or "_".join(f"{f}_{d}" for f, d in keys)
+        with self._lock:
+            existing = self._indexes.get(name)
+            if existing is not None:
+                return name
+            index = {"key": keys, "unique": bool(unique), "map": {}}
+            for k, doc in self._docs.items():
+                entry = self._index_value(index, doc)
+                bucket = index["map"].setdefault(entry, set())
+                if unique and bucket:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name} dup key: {entry}", 11000)
+                bucket.add(k)
+            self._indexes[name] = index
+        return name
+
+    def create_indexes(self, indexes):
+        return [self.create_index(i.document["key"].items(), **{k: v for k, v in i.document.items() if k != "key"})
+                for i in indexes]
+
+    def drop_index(self, name):
+        with self._lock:
+            self._indexes.pop(name, None)
+
+    def index_information(self):
+        with self._lock:
+            return {name: dict({"key": list(i["key"])}, **({"unique": True} if i["unique"] else {}))
+                    for name, i in self._indexes.items()}
+
+    def list_indexes(self):
+        return iter([dict(info, name=name) for name, info in self.index_information().items()])
+
+    @staticmethod
+    def _index_value(index, doc):
+        return tuple(_hashable(_get(doc, field)) for field, _ in index["key"])
+
+    def _index_add(self, k, doc):
+        for name, index in self._indexes.items():
+            entry = self._index_value(index, doc)
+            bucket = index["map"].get(entry)
+            if index["unique"] and bucket and bucket != {k}:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name} dup key: {entry}", 11000)
+        for index in self._indexes.values():
+            index["map"].setdefault(self._index_value(index, doc), set()).add(k)
+
+    def _index_remove(self, k, doc):
+        for index in self._indexes.values():
+            entry = self._index_value(index, doc)
+            bucket = index["map"].get(entry)
+            if bucket is not None:
+                bucket.discard(k)
+                if not bucket:
+                    del index["map"][entry]
+
+    def _plan(self, query):
+        """Name of the index serving the query's equality fields (None = full scan)."""
+        eq = _equality_fields(query)
+        best = None
+        for name, index in self._indexes.items():
+            fields = [f for f, _ in index["key"]]
+            if all(f in eq for f in fields):
+                rank = (index["unique"], len(fields))
+                if best is None or rank > best[0]:
+                    best = (rank, name)
+        return best[1] if best else None
+
+    # --- READ (Lock held) ---
+    def _candidates(self, query):
+        name = self._plan(query)
+        if name is None:
+            return list(self._docs.items())
+        index = self._indexes[name]
+        eq = _equality_fields(query)
+        keys = index["map"].get(tuple(_hashable(eq[f]) for f, _ in index["key"]), ())
+        return [(k, self._docs[k]) for k in sorted(keys)]
+
+    def _select(self, query, sort=None, limit=0):
+        """[(key, stored doc)] matching query, sorted; stored docs are live."""
+        hits = []
+        for k, doc in self._candidates(query):
+            if _matches(doc, query):
+                hits.append((k, doc))
+                if limit and not sort and len(hits) >= limit:
+                    break
+        if sort:
+            if isinstance(sort, dict):
+                sort = list(sort.items())
+            for key, direction in reversed(sort):
+                hits.sort(key=lambda kd: _sort_key(_get(kd[1], key)), reverse=direction < 0)
+        return hits
+
+    def _query(self, query, projection=None, sort=None, skip=0, limit=0):
+        with self._lock:
+            hits = self._select(query, sort, (skip + limit) if limit else 0)
+            hits = hits[skip:skip + limit] if limit else hits[skip:]
+            return [_project(doc, projection) for _, doc in hits]
+
+    # --- READ API ---
+    def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, **kwargs):
+        return MemoryCursor(self, filter, projection, sort, skip, limit)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        results = self._query(filter, projection, sort, 0, 1)
+        return results[0] if results else None
+
+    def count_documents(self, filter, **kwargs):
+        with self._lock:
+            return len(self._select(filter))
+
+    def estimated_document_count(self, **kwargs):
+        return len(self._docs)
+
+    def distinct(self, key, filter=None):
+        with self._lock:
+            seen, out = set(), []
+            for _, doc in self._select(filter):
+                for v in _flat(list(_values(doc, key.split('.')))):
+                    if isinstance(v, list) or _hashable(v) in seen:
+                        continue
+                    seen.add(_hashable(v))
+                    out.append(_clone(v))
+            return out
+
+    def aggregate(self, pipeline, **kwargs):
+        with self._lock: # Snapshot, then run unlocked ($lookup locks other collections)
+            if pipeline and "$match" in pipeline[0]:
+                docs = [_clone(d) for _, d in self._select(pipeline[0]["$match"])]
+                pipeline = pipeline[1:]
+            else:
+                docs = [_clone(d) for d in self._docs.values()]
+        return iter(_run_pipeline(docs, pipeline, self.database))
+
+    @property
+    def data(self):
+        """Copies of every document (the old MockCollection attribute, for scripts)."""
+        with self._lock:
+            return [_clone(d) for d in self._docs.values()]
+
+    # --- WRITE (Lock held) ---
+    def _insert(self, doc):
+        if "_id" not in doc:
+            doc["_id"] = ObjectId()
+        stored = _clone(doc)
+        k = next(self._keys)
+        self._index_add(k, stored)
+        self._docs[k] = stored
+        return doc["_id"]
+
+    def _replace_doc(self, k, old, new):
+        """Swaps a stored document, keeping indexes consistent (old one restored on a unique violation)."""
+        self._index_remove(k, old)
+        try:
+            self._index_add(k, new)
+        except DuplicateKeyError:
+            self._index_add(k, old)
+            raise
+        self._docs[k] = new
+
+    def _update(self, query, update, upsert, multi, sort=None):
+        """Returns (matched, modified, upserted_id, [(before, after)])."""
+        replace = not _is_update(update)
+        hits = self._select(query, sort, 0 if multi else 1)
+        if not multi:
+            hits = hits[:1]
+        changes = []
+        modified = 0
+        for k, doc in hits:
+            new = _clone(doc)
+            if replace:
+                new = dict(_clone(update), _id=doc["_id"])
+            else:
+                _apply_update(new, update)
+            if new.get("_id") != doc.get("_id"):
+                raise OperationFailure("Performing an update on the path '_id' would modify the immutable field '_id'")
+            if new != doc:
+                self._replace_doc(k, doc, new)
+                modified += 1
+            changes.append((doc, new))
+        if hits or not upsert:
+            return len(hits), modified, None, changes
+        new = _upsert_seed(query)
+        if replace:
+            new.update(_clone(update))
+        else:
+            _apply_update(new, update, inserting=True)
+        upserted_id = self._insert(new)
+        return 0, 0, upserted_id, [(None, new)]
+
+    def _delete(self, query, multi):
+        hits = self._select(query, None, 0 if multi else 1)
+        for k, doc in hits:
+            self._index_remove(k, doc)
+            del self._docs[k]
+        return hits
+
+    # --- WRITE API ---
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        ids, errors = [], []
+        with self._lock:
+            for i, doc in enumerate(documents):
+                try:
+                    ids.append(self._insert(doc))
+                except DuplicateKeyError as e:
+                    errors.append({"index": i, "code": 11000, "errmsg": str(e), "op": doc})
+                    if ordered: break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], "nInserted": len(ids),
+                                  "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []})
+        return InsertManyResult(ids, True)
+
+    def _update_result(self, matched, modified, upserted_id):
+        raw = {"n": matched + (1 if upserted_id is not None else 0), "nModified": modified, "ok": 1.0,
+               "updatedExisting": bool(matched)}
+        if upserted_id is not None:
+            raw["upserted"] = upserted_id
+        return UpdateResult(raw, True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        with self._lock:
+            return self._update_result(*self._update(filter, update, upsert, multi=False)[:3])
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        with self._lock:
+            return self._update_result(*self._update(filter, update, upsert, multi=True)[:3])
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        if _is_update(replacement):
+            raise ValueError("replacement can not include $ operators")
+        with self._lock:
+            return self._update_result(*self._update(filter, replacement, upsert, multi=False)[:3])
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        with self._lock:
+            _, _, _, changes = self._update(filter, update, upsert, multi=False, sort=sort)
+            if not changes:
+                return None
+            before, after = changes[0]
+            doc = after if return_document == ReturnDocument.AFTER else before
+            return _project(doc, projection) if doc is not None else None
+
+    def find_one_and_replace(self, filter, replacement, projection=None, sort=None, upsert=False,
+                             return_document=ReturnDocument.BEFORE, **kwargs):
+        if _is_update(replacement):
+            raise ValueError("replacement can not include $ operators")
+        return self.find_one_and_update(filter, replacement, projection, sort, upsert, return_document)
+
+    def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        with self._lock:
+            hits = self._select(filter, sort, 1)[:1]
+            for k, doc in hits:
+                self._index_remove(k, doc)
+                del self._docs[k]
+            return _project(hits[0][1], projection) if hits else None
+
+    def delete_one(self, filter, **kwargs):
+        with self._lock:
+            return DeleteResult({"n": len(self._delete(filter, multi=False)), "ok": 1.0}, True)
+
+    def delete_many(self, filter, **kwargs):
+        with self._lock:
+            return DeleteResult({"n": len(self._delete(filter, multi=True)), "ok": 1.0}, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        result = {"writeErrors": [], "writeConcernErrors": [], "nInserted": 0, "nUpserted": 0,
+                  "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+        with self._lock:
+            for i, op in enumerate(requests):
+                try:
+                    if isinstance(op, InsertOne):
+                        self._insert(op._doc)
+                        result["nInserted"] += 1
+                    elif isinstance(op, (UpdateOne, UpdateMany, ReplaceOne)):
+                        matched, modified, upserted_id, _ = self._update(
+                            op._filter, op._doc, bool(op._upsert), multi=isinstance(op, UpdateMany))
+                        result["nMatched"] += matched
+                        result["nModified"] += modified
+                        if upserted_id is not None:
+                            result["nUpserted"] += 1
+                            result["upserted"].append({"index": i, "_id": upserted_id})
+                    elif isinstance(op, (DeleteOne, DeleteMany)):
+                        result["nRemoved"] += len(self._delete(op._filter, multi=isinstance(op, DeleteMany)))
+                    else:
+                        raise TypeError(f"{op!r} is not a valid request")
+                except DuplicateKeyError as e:
+                    result["writeErrors"].append({"index": i, "code": 11000, "errmsg": str(e)})
+                    if ordered: break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def drop(self):
+        with self._lock:
+            self._docs.clear()
+            for index in self._indexes.values():
+                index["map"].clear()
+
+    # --- SNAPSHOT ---
+    def _dump(self):
+        with self._lock:
+            return {
+                "docs": [_clone(d) for d in self._docs.values()],
+                "indexes": [(name, i["key"], i["unique"]) for name, i in self._indexes.items()]
+            }
+
+    def _restore(self, state):
+        with self._lock:
+            for name, keys, unique in state["indexes"]:
+                self.create_index(keys, unique=unique, name=name)
+            for doc in state["docs"]:
+                self._insert(doc)
+
+class MemoryDatabase:
+    """Collections are created on first access, like a pymongo Database."""
+    def __init__(self, name="memory", snapshot=MEMORY_SNAPSHOT, snapshot_interval=MEMORY_SNAPSHOT_INTERVAL):
+        self.name = name
+        self.snapshot = snapshot
+        self._collections = {}
+        self._lock = threading.Lock()
+        if snapshot:
+            self.load(snapshot)
+            atexit.register(self.save)
+            if snapshot_interval > 0:
+                threading.Thread(target=self._autosave, args=(snapshot_interval,), name="memory-snapshot",
+                                 daemon=True).start()
+
+    def __getitem__(self, name):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = MemoryCollection(name, self)
+            return collection
+
+    def get_collection(self, name):
+        return self[name]
+
+    def list_collection_names(self):
+        with self._lock:
+            return list(self._collections)
+
+    def drop_collection(self, name):
+        with self._lock:
+            self._collections.pop(name, None)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return False
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        for name, collection_state in state.items():
+            self[name]._restore(collection_state)
+        logger.info(f"📂 Loaded in-memory store snapshot {path} ({len(state)} collections)")
+        return True
+
+    def save(self, path=None):
+        """Atomic write (temp file + rename), so a crash never leaves half a snapshot."""
+        path = path or self.snapshot
+        if not path:
+            return
+        with self._lock:
+            collections = dict(self._collections)
+        state = {name: c._dump() for name, c in collections.items()}
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def _autosave(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save()
+            except Exception as e:
+                logger.error(f"❌ In-memory store snapshot failed: {e}")
@@ -0,0 +1,229 @@
+"""
+Chat messages stored one document per message, outside the session document.
+
+    messages: {sessionId, userId, seq, id, role, parts, audioUrl, ...}
+    unique index (sessionId, seq)
+
+The session document only keeps metadata plus `message_count`, which doubles
+as the seq allocator, so sessions stay small no matter how long they run and
+history pages are read through the index in constant time.
+
+Sessions written before this store existed keep an embedded `messages`
+array until migrated, either right before their next message is stored or
+in bulk:
+
+    python message_store.py --migrate
+
+Reads never migrate. Until then history pages are served from the embedded
+array under the seqs the migration will give it (0..n-1, in array order),
+so cursors stay valid across the migration.
+"""
+import logging
+import os
+
+from pymongo import ReturnDocument, UpdateOne
+
+from write_behind import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+TURN_FLUSH_INTERVAL = float(os.getenv("TURN_FLUSH_INTERVAL", 0.2))
+
+class MessageStore:
+    def __init__(self, messages_collection, sessions_collection):
+        self.messages = messages_collection
+        self.sessions = sessions_collection
+        # Chat turns are persisted behind the stream (see append_later)
+        self.turn_buffer = WriteBehindBuffer("chat_turns", self.write_turns, max_batch=200, interval=TURN_FLUSH_INTERVAL)
+
+    # --- WRITES ---
+    def _allocate(self, session_id, count, extra_set=None):
+        """
+        Reserves `count` seqs on the session (one round trip).
+        Returns (first_seq, userId) or None if the session does not exist.
+        """
+        update = {"$inc": {"message_count": count}}
+        if extra_set:
+            update["$set"] = extra_set
+        while True:
+            session = self.sessions.find_one_and_update(
+                {"id": session_id, "messages.0": {"$exists": False}}, update,
+                projection={"_id": 0, "userId": 1, "message_count": 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if session:
+                return session["message_count"] - count, session.get("userId")
+            legacy = self.sessions.find_one({"id": session_id}, {"_id": 0, "id": 1, "userId": 1, "messages": 1})
+            if not legacy:
+                return None
+            # Still embedded: migrate first, so the old history keeps seqs 0..n-1 ahead of the new messages
+            self.migrate_session(legacy)
+
+    def append(self, session_id, msgs, extra_set=None):
+        """
+        Allocates seqs and inserts the messages synchronously.
+        Returns False if the session does not exist.
+        """
+        allocated = self._allocate(session_id, len(msgs), extra_set)
+        if not allocated:
+            return False
+        first_seq, user_id = allocated
+        self.messages.insert_many([
+            self._doc(session_id, user_id, first_seq + i, m) for i, m in enumerate(msgs)
+        ])
+        return True
+
+    def append_later(self, session_id, msgs, extra_set=None):
+        """
+        Queues the messages for the turn writer and returns immediately.
+        """
+        self.turn_buffer.put({"sessionId": session_id, "msgs": msgs, "extra_set": extra_set})
+
+    def write_turns(self, turns):
+        """
+        Write-behind flush. Seqs are allocated once per turn and remembered on
+        the turn, and messages are upserted on (sessionId, seq), so a retried
+        batch never allocates twice or inserts duplicates.
+        """
+        ops = []
+        for turn in turns:
+            if "first_seq" not in turn:
+                allocated = self._allocate(turn["sessionId"], len(turn["msgs"]), turn["extra_set"])
+                if not allocated:
+                    logger.warning(f"⚠️ Session {turn['sessionId']} not found, chat turn discarded")
+                turn["first_seq"], turn["userId"] = allocated or (None, None)
+            if turn["first_seq"] is None:
+                continue
+            for i, m in enumerate(turn["msgs"]):
+                doc = self._doc(turn["sessionId"], turn["userId"], turn["first_seq"] + i, m)
+                ops.append(UpdateOne({"sessionId": doc["sessionId"], "seq": doc["seq"]}, {"$setOnInsert": doc}, upsert=True))
+        if ops:
+            self.messages.bulk_write(ops, ordered=False)
+
+    def replace(self, session_id, user_id, msgs):
+        """
+        Used by the session upsert route: the client sent the full message list.
+        """
+        self.messages.delete_many({"sessionId": session_id})
+        if msgs:
+            self.messages.insert_many([self._doc(session_id, user_id, i, m) for i, m in enumerate(msgs)])
+        self.sessions.update_one({"id": session_id}, {"$set": {"message_count": len(msgs)}})
+
+    def set_feedback(self, session_id, message_id, fields):
+        """
+        Sets the given feedback fields (feedback, feedbackText) on one message.
+        Returns False if the message is not in the store (e.g. still embedded).
+        """
+        result = self.messages.update_one({"sessionId": session_id, "id": message_id}, {"$set": fields})
+        return result.matched_count > 0
+
+    def migrate_session(self, session):
+        """
+        Moves one session's embedded `messages` into the store with seqs
+        0..n-1, in array order. `session` needs id, userId and messages.
+
+        Anything already stored for the session moves up by n first, one
+        document at a time from the highest seq down so every target is
+        free. Moved and inserted documents are marked `migrated`, inserts
+        are upserts and the array is only removed if it is unchanged, so an
+        interrupted migration can be re-run.
+        """
+        msgs = session.get("messages") or []
+        n = len(msgs)
+        if not n:
+            return False
+        sid = session["id"]
+        for doc in self.messages.find({"sessionId": sid, "migrated": {"$exists": False}}, {"_id": 1},
+                                      sort=[("seq", -1)]):
+            self.messages.update_one({"_id": doc["_id"]}, {"$inc": {"seq": n}, "$set": {"migrated": True}})
+        ops = []
+        for i, m in enumerate(msgs):
+            doc = dict(self._doc(sid, session.get("userId"), i, m), migrated=True)
+            ops.append(UpdateOne({"sessionId": sid, "seq": i}, {"$setOnInsert": doc}, upsert=True))
+        self.messages.bulk_write(ops, ordered=False)
+        self.sessions.update_one(
+            {"id": sid, "messages": {"$size": n}},
+            {"$unset": {"messages": ""}, "$inc": {"message_count": n}}
+        )
+        return True
+
+    def delete_session(self, session_id):
+        self.messages.delete_many({"sessionId": session_id})
+
+    def delete_user(self, user_id):
+        self.messages.delete_many({"userId": user_id})
+
+    @staticmethod
+    def _doc(session_id, user_id, seq, msg):
+        doc = {k: v for k, v in msg.items() if k != "_id"}
+        doc.update({"sessionId": session_id, "userId": user_id, "seq": seq})
+        return doc
+
+    # --- READS ---
+    def page(self, session_id, before=None, limit=PAGE_SIZE):
+        """
+        Newest-first cursor pagination. Returns (messages oldest-first,
+        next_cursor); pass next_cursor as `before` to load older messages.
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        query = {"sessionId": session_id}
+        if before is not None:
+            query["seq"] = {"$lt": int(before)}
+        docs = list(self.messages.find(query, {"_id": 0}, sort=[("seq", -1)], limit=limit))
+        docs.reverse()
+        next_cursor = docs[0]["seq"] if len(docs) == limit else None
+        return docs, next_cursor
+
+    @staticmethod
+    def page_embedded(msgs, before=None, limit=PAGE_SIZE):
+        """page() over a not-yet-migrated session's embedded array."""
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        end = len(msgs) if before is None else max(0, min(int(before), len(msgs)))
+        start = max(0, end - limit)
+        docs = [dict(m, seq=start + i) for i, m in enumerate(msgs[start:end])]
+        next_cursor = start if len(docs) == limit else None
+        return docs, next_cursor
+
+    def tail(self, session_id, n):
+        return self.page(session_id, limit=n)[0]
+
+    def all(self, session_ids):
+        """
+        Full histories of several sessions in one query, for legacy
+        whole-session responses only. Returns {session_id: [messages]}.
+        """
+        histories = {sid: [] for sid in session_ids}
+        if histories:
+            for doc in self.messages.find({"sessionId": {"$in": list(histories)}}, {"_id": 0},
+                                          sort=[("sessionId", 1), ("seq", 1)]):
+                histories[doc["sessionId"]].append(doc)
+        return histories
+
+# --- MIGRATION ---
+def migrate_embedded_messages(store, batch_size=500):
+    """
+    Moves every embedded `messages` array into the message store (see
+    migrate_session). Can be re-run safely.
+    """
+    migrated = 0
+    cursor = store.sessions.find(
+        {"messages.0": {"$exists": True}}, {"_id": 0, "id": 1, "userId": 1, "messages": 1}
+    ).batch_size(batch_size)
+    for session in cursor:
+        store.migrate_session(session)
+        migrated += 1
+        if migrated % 100 == 0:
+            logger.info(f"📦 Migrated {migrated} sessions")
+    return migrated
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Message store maintenance")
+    parser.add_argument("--migrate", action="store_true", help="Move embedded session messages into the message store")
+    args = parser.parse_args()
+    if args.migrate:
+        import server
+        print(f"[OK] Migrated {migrate_embedded_messages(server.message_store)} sessions")
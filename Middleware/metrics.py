@@ -0,0 +1,140 @@
+"""
+In-process metrics, rendered in the Prometheus text format on /metrics.
+
+Deliberately tiny (no prometheus_client dependency): counters and
+histograms are a dict update under a lock, and gauges that mirror existing
+state (queue depth, slot occupancy, buffer depth) are only computed when
+scraped, so instrumentation is cheap enough to leave on in production.
+Every metric lives in this module so the hot paths just import and call.
+
+Each process has its own registry; with several gunicorn workers, scrape
+each worker or aggregate by instance.
+"""
+import bisect
+import threading
+
+from pymongo import monitoring
+
+_registry = []
+
+def _label_str(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for values, v in items:
+            yield f"{self.name}{_label_str(self.labels, values)} {v}"
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self._values = {} # label values -> [per-bucket counts (+Inf last), sum, count]
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self._values.items()]
+        for values, counts, total, n in items:
+            cumulative = 0
+            for le, c in zip(self.buckets + ["+Inf"], counts):
+                cumulative += c
+                yield f"{self.name}_bucket{_label_str(self.labels + ('le',), values + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_label_str(self.labels, values)} {total}"
+            yield f"{self.name}_count{_label_str(self.labels, values)} {n}"
+
+class GaugeFunc:
+    """Gauge computed at scrape time: fn() -> number or {label values tuple: number}."""
+    def __init__(self, name, help, fn, labels=()):
+        self.name, self.help, self.fn, self.labels = name, help, fn, tuple(labels)
+        _registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for values, v in value.items():
+            yield f"{self.name}{_label_str(self.labels, values)} {v}"
+
+def render():
+    lines = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e: # A broken gauge must not take the endpoint down
+            lines.append(f"# {metric.name} unavailable: {e}")
+    return "\n".join(lines) + "\n"
+
+# --- METRICS ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+
+QUEUE_WAIT = Histogram("chat_queue_wait_seconds", "Time from enqueue to slot grant", LATENCY_BUCKETS, ["tier"])
+TTFT = Histogram("chat_time_to_first_token_seconds", "Request arrival to first streamed byte", LATENCY_BUCKETS, ["tier"])
+STREAM_DURATION = Histogram("chat_stream_duration_seconds", "First to last streamed byte", LATENCY_BUCKETS, ["tier"])
+TOKEN_RATE = Histogram("chat_tokens_per_second", "Text frames per second per stream", RATE_BUCKETS, ["tier"])
+TOKENS = Counter("chat_tokens_total", "Text frames relayed", ["tier"])
+CHATS = Counter("chat_requests_total", "Chat requests by outcome", ["outcome"])
+UPSTREAM_ERRORS = Counter("upstream_errors_total", "GPU node connect/stream failures", ["node", "kind"])
+LIMIT_CHANGES = Counter("chat_slot_limit_changes_total", "Adaptive slot limit adjustments", ["direction"])
+BTCPAY_CALLS = Counter("btcpay_calls_total", "BTCPay API calls and invoice reuses by outcome", ["outcome"])
+WEBHOOK_EVENTS = Counter("payment_webhook_events_total", "Settlement webhook events by outcome", ["outcome"])
+REFUNDS = Counter("billing_refunds_total", "Refunded chat debits", ["reason"])
+DB_LATENCY = Histogram("mongo_command_seconds", "Mongo command latency", DB_BUCKETS, ["command", "collection"])
+DB_ERRORS = Counter("mongo_command_errors_total", "Failed Mongo commands", ["command", "collection"])
+
+def error_kind(error):
+    return "timeout" if "Timeout" in type(error).__name__ else "error"
+
+# --- MONGO COMMAND MONITORING ---
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Pass as MongoClient(event_listeners=[...]); times every command per collection."""
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        name = event.command_name
+        collection = event.command.get(name)
+        self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        DB_LATENCY.observe(event.duration_micros / 1e6, event.command_name, collection)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        DB_LATENCY.observe(event.duration_micros / 1e6, event.command_name, collection)
+        DB_ERRORS.inc(event.command_name, collection)
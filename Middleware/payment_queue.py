@@ -0,0 +1,265 @@
+"""
+Durable queue for BTCPay settlement webhooks.
+
+The webhook used to credit inside the request: an idempotency find_one on
+`payments`, the credit, two referral updates and the `payments` insert, five
+round trips before BTCPay got its answer, with duplicate deliveries racing
+between the check and the insert. Now the route only verifies the
+signature and calls enqueue(), one insert into `payment_events` whose
+unique invoiceId index turns a duplicate delivery into a no-op, and
+answers 200.
+
+A background thread in every worker process claims pending events in
+batches and applies them:
+
+    pending --claim--> processing --apply--> done
+                           |  lease expired: claimable again
+                           '- WEBHOOK_MAX_ATTEMPTS failures: failed
+
+Claims are a conditional update_many, so each event goes to one worker, and
+a worker that dies mid-batch leaves its events to be reclaimed after
+WEBHOOK_LEASE seconds. Each batch is:
+
+  * one read of the buyers (previous tier, for the stats counters)
+  * one bulk_write recording that tier on each new credit's event
+  * one bulk_write of credits
+  * one bulk_write of referral commissions
+  * one upsert into `payments`
+  * one update that marks the events done
+
+Exactly-once does not rely on the lease. Every credit is guarded by the
+invoice id it pushes onto the user (payments_applied, and
+commissions_applied on the referrer), so replaying a batch after a crash
+changes nothing that was already applied. Only the last
+APPLIED_INVOICES_KEPT ids are kept. A replay only ever involves events
+still in flight, and those are recent.
+
+on_credit runs once per event, after the batch is marked done, so a
+replayed event whose credit already landed is still reported, using the
+previous tier recorded on the event before the credit.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from metrics import WEBHOOK_EVENTS
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", 100))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", 1.0)) # Picks up other workers' events
+WEBHOOK_LEASE = float(os.getenv("WEBHOOK_LEASE", 60)) # Seconds before a stuck claim is retried
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 10))
+APPLIED_INVOICES_KEPT = 50
+
+PENDING, PROCESSING, DONE, FAILED = "pending", "processing", "done", "failed"
+
+# Referral commission per plan (10% of the price)
+COMMISSIONS = {"infantry": 0.5, "commander": 1.0}
+
+def claimable(cutoff):
+    """Events a worker may claim: pending, or processing under a lease taken before `cutoff`."""
+    return {"$or": [
+        {"status": PENDING},
+        {"status": PROCESSING, "claimed_at": {"$lt": cutoff}}
+    ]}
+
+def _remember(invoice_id):
+    return {"$each": [invoice_id], "$slice": -APPLIED_INVOICES_KEPT}
+
+class PaymentQueue:
+    def __init__(self, events_collection, users_collection, payments_collection, on_credit=None,
+                 batch_size=WEBHOOK_BATCH_SIZE, interval=WEBHOOK_POLL_INTERVAL, lease=WEBHOOK_LEASE):
+        """
+        on_credit(user_id, previous_subscription, plan, coins, referrer) runs
+        once per credited event, including one replayed after a crash (auth
+        user cache invalidation, admin stats counters).
+        """
+        self.events = events_collection
+        self.users = users_collection
+        self.payments = payments_collection
+        self.on_credit = on_credit
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = lease
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.duplicates = 0
+        self.credited = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_lag = 0.0 # Seconds from receipt to credit, oldest event of the last batch
+        self._thread = threading.Thread(target=self._run, name="payment-queue", daemon=True)
+        self._thread.start()
+
+    # --- FAST PATH (webhook request) ---
+    def enqueue(self, invoice_id, event):
+        """
+        Stores a settlement event. Returns False if this invoice was already
+        queued (a redelivery), True otherwise. Either way BTCPay gets its 200.
+        """
+        try:
+            self.events.insert_one({
+                "invoiceId": invoice_id,
+                "status": PENDING,
+                "attempts": 0,
+                "received_at": time.time(),
+                "metadata": event.get('metadata') or {}
+            })
+        except DuplicateKeyError:
+            WEBHOOK_EVENTS.inc("duplicate")
+            with self._lock:
+                self.duplicates += 1
+            return False
+        WEBHOOK_EVENTS.inc("queued")
+        with self._lock:
+            self.queued += 1
+        self._wake.set()
+        return True
+
+    # --- WORKER ---
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                while self.process_batch() >= self.batch_size:
+                    pass
+            except Exception as e:
+                logger.error(f"❌ Payment queue batch failed: {e}")
+                with self._lock:
+                    self.failures += 1
+
+    def _claim(self):
+        """Claims up to batch_size events for this worker. Returns them (possibly [])."""
+        now = time.time()
+        query = claimable(now - self.lease)
+        ids = [e["invoiceId"] for e in self.events.find(query, {"_id": 0, "invoiceId": 1}).limit(self.batch_size)]
+        if not ids:
+            return []
+        token = str(uuid.uuid4())
+        self.events.update_many(
+            {"$and": [{"invoiceId": {"$in": ids}}, query]},
+            {"$set": {"status": PROCESSING, "claim": token, "claimed_at": now}, "$inc": {"attempts": 1}}
+        )
+        return list(self.events.find({"claim": token, "status": PROCESSING}, {"_id": 0}))
+
+    def process_batch(self):
+        """Claims and applies one batch. Returns the number of events claimed."""
+        events = self._claim()
+        if not events:
+            return 0
+        try:
+            self._apply(events)
+        except Exception as err:
+            # Left in PROCESSING: retried once the lease runs out, unless out of attempts
+            exhausted = [e["invoiceId"] for e in events if e.get("attempts", 0) >= WEBHOOK_MAX_ATTEMPTS]
+            if exhausted:
+                self.events.update_many({"invoiceId": {"$in": exhausted}}, {"$set": {"status": FAILED, "error": str(err)}})
+                WEBHOOK_EVENTS.inc("failed", amount=len(exhausted))
+                logger.error(f"❌ Giving up on invoices {exhausted}: {err}")
+            raise
+        return len(events)
+
+    def _apply(self, events):
+        credits = [e for e in events if e["metadata"].get('userId')]
+        buyers = {u["id"]: u for u in self.users.find(
+            {"id": {"$in": list({e["metadata"]["userId"] for e in credits})}},
+            {"_id": 0, "id": 1, "subscription": 1, "payments_applied": 1}
+        )}
+
+        claim = events[0]["claim"]
+        user_ops, referral_ops, payment_ops, event_ops, applied = [], [], [], [], []
+        for e in credits:
+            invoice_id, meta = e["invoiceId"], e["metadata"]
+            user_id, plan, coins = meta['userId'], meta.get('plan'), meta.get('coins', 0)
+            referrer = meta.get('referrer')
+            if referrer == 'null':
+                referrer = None
+            user_ops.append(UpdateOne(
+                {"id": user_id, "payments_applied": {"$ne": invoice_id}},
+                {"$inc": {"coins": coins}, "$set": {"subscription": plan},
+                 "$push": {"payments_applied": _remember(invoice_id)}}
+            ))
+            if referrer:
+                # $min: the 30-day lock starts at the first commission only
+                referral_ops.append(UpdateOne(
+                    {"username": referrer, "commissions_applied": {"$ne": invoice_id}},
+                    {"$inc": {"affiliate_balance": COMMISSIONS.get(plan, 0)},
+                     "$min": {"commission_start_date": datetime.utcnow().isoformat()},
+                     "$push": {"commissions_applied": _remember(invoice_id)}}
+                ))
+            payment_ops.append(UpdateOne({"invoiceId": invoice_id}, {"$setOnInsert": {
+                "invoiceId": invoice_id,
+                "userId": user_id,
+                "plan": plan,
+                "amount": coins,
+                "timestamp": datetime.utcnow()
+            }}, upsert=True))
+
+            buyer = buyers.get(user_id)
+            if buyer is None:
+                continue
+            if invoice_id in buyer.get("payments_applied", ()):
+                # Replay after a crash: credited already, reported not yet (that happens after DONE)
+                previous = e.get("previous_subscription", plan)
+            else:
+                previous = buyer.get('subscription')
+                event_ops.append(UpdateOne({"invoiceId": invoice_id, "claim": claim},
+                                           {"$set": {"previous_subscription": previous}}))
+            buyer['subscription'] = plan # A second invoice in this batch upgrades from here
+            applied.append((invoice_id, (user_id, previous, plan, coins, referrer)))
+
+        if event_ops:
+            self.events.bulk_write(event_ops, ordered=False) # Before the credit, so a replay knows the old tier
+        if user_ops:
+            self.users.bulk_write(user_ops, ordered=True)
+        if referral_ops:
+            self.users.bulk_write(referral_ops, ordered=True)
+        if payment_ops:
+            self.payments.bulk_write(payment_ops, ordered=False)
+        done_at = time.time()
+        done = self.events.update_many(
+            {"invoiceId": {"$in": [e["invoiceId"] for e in events]}, "claim": claim, "status": PROCESSING},
+            {"$set": {"status": DONE, "done_at": done_at}}
+        )
+        if done.matched_count < len(events):
+            # Lease ran out and another worker took some over: whoever marks an event done reports it
+            mine = {e["invoiceId"] for e in self.events.find(
+                {"invoiceId": {"$in": [e["invoiceId"] for e in events]}, "claim": claim, "done_at": done_at},
+                {"_id": 0, "invoiceId": 1}
+            )}
+            applied = [a for a in applied if a[0] in mine]
+        applied = [credit for _, credit in applied]
+
+        for credit in applied:
+            if self.on_credit:
+                self.on_credit(*credit)
+            logger.info(f"💰 Payment settled for {credit[0]}: {credit[2]} (+{credit[3]} coins)")
+        WEBHOOK_EVENTS.inc("credited", amount=len(applied))
+        with self._lock:
+            self.credited += len(applied)
+            self.batches += 1
+            self.last_lag = time.time() - min(e["received_at"] for e in events)
+
+    def stats(self):
+        backlog = self.events.count_documents({"status": {"$in": [PENDING, PROCESSING]}})
+        failed = self.events.count_documents({"status": FAILED})
+        with self._lock:
+            return {
+                "backlog": backlog,
+                "failed": failed,
+                "queued": self.queued,
+                "duplicates": self.duplicates,
+                "credited": self.credited,
+                "batches": self.batches,
+                "batch_failures": self.failures,
+                "last_lag": round(self.last_lag, 3)
+            }
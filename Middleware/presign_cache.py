@@ -0,0 +1,90 @@
+"""
+Cache of presigned Filebase (S3) GET URLs keyed by object key.
+
+A signed link is reused while more than `min_remaining` seconds of its
+validity are left, so reloading a session re-signs nothing. Entries are
+evicted least-recently-used once `max_entries` is reached.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+PRESIGN_EXPIRES_IN = 3600 # 1 Hour
+PRESIGN_MIN_REMAINING = int(os.getenv("PRESIGN_MIN_REMAINING_MINUTES", 10)) * 60
+PRESIGN_CACHE_SIZE = int(os.getenv("PRESIGN_CACHE_SIZE", 10000))
+
+def object_key(url):
+    """
+    Filebase URL -> object key, or None if it is not a Filebase link.
+    E.g. https://hitler-audio.s3.filebase.com/speech_123.wav?... -> speech_123.wav
+    """
+    if not isinstance(url, str) or 'filebase.com' not in url:
+        return None
+    return urlparse(url).path.lstrip('/')
+
+class PresignCache:
+    def __init__(self, sign, expires_in=PRESIGN_EXPIRES_IN,
+                 min_remaining=PRESIGN_MIN_REMAINING, max_entries=PRESIGN_CACHE_SIZE):
+        """
+        sign(key, expires_in) -> signed URL
+        """
+        self.sign = sign
+        self.expires_in = expires_in
+        self.min_remaining = min_remaining
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (url, expires_at)
+        self.hits = 0
+        self.signed = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] - now > self.min_remaining:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        # Sign outside the lock; a concurrent duplicate signing is harmless
+        url = self.sign(key, self.expires_in)
+        with self._lock:
+            self._entries[key] = (url, now + self.expires_in)
+            self._entries.move_to_end(key)
+            self.signed += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return url
+
+    def refresh_url(self, original_url):
+        """Signed link for a Filebase URL; anything else (or a failure) passes through."""
+        key = object_key(original_url)
+        if key is None:
+            return original_url
+        try:
+            return self.get(key)
+        except Exception as e:
+            logger.warning(f"Failed to refresh URL: {e}")
+            return original_url
+
+    def refresh_messages(self, msgs):
+        """
+        Rewrites audioUrl in place for a batch of messages, signing each
+        distinct key at most once.
+        """
+        signed = {}
+        for msg in msgs:
+            url = msg.get('audioUrl')
+            key = object_key(url)
+            if key is None: continue
+            if key not in signed:
+                signed[key] = self.refresh_url(url)
+            msg['audioUrl'] = signed[key]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "signed": self.signed}
@@ -0,0 +1,107 @@
+"""
+Exact-match cache of finished chat replies (opt-in: RESPONSE_CACHE=1).
+
+Many users open with the same line to the same persona in the same scene,
+and each of those used to cost a full generation plus audio synthesis. The
+key is a hash of the final ChatML prompt + style (+ tier, unless
+RESPONSE_CACHE_SHARE_TIERS=1 says tiers get identical output), so only
+byte-identical requests, history included, ever share a reply.
+
+Hits are replayed as an SSE stream (text + audio frame) without taking a GPU
+slot and cost RESPONSE_CACHE_HIT_COST coins (defaults to a normal chat).
+Entries expire after RESPONSE_CACHE_TTL seconds and are evicted
+least-recently-used once RESPONSE_CACHE_MAX_BYTES of reply text is held.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 6 * 3600))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESPONSE_CACHE_SHARE_TIERS = os.getenv("RESPONSE_CACHE_SHARE_TIERS", "0") == "1"
+
+class ResponseCache:
+    def __init__(self, enabled=RESPONSE_CACHE_ENABLED, ttl=RESPONSE_CACHE_TTL,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, share_tiers=RESPONSE_CACHE_SHARE_TIERS):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.share_tiers = share_tiers
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (text, audio_url, size, expires_at)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, payload):
+        parts = [payload.get("prompt", ""), payload.get("style") or ""]
+        if not self.share_tiers:
+            parts.append(payload.get("tier") or "")
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """(text, audio_url) for a live entry, else None."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[3] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], entry[1]
+            if entry:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, text, audio_url):
+        """Stores a complete reply; call only after the stream finished cleanly."""
+        if not (self.enabled and text):
+            return
+        size = len(text.encode("utf-8")) + len(audio_url or "")
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (text, audio_url, size, time.time() + self.ttl)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions
+            }
+
+def replay_sse(text, audio_url):
+    """A cached reply in the same frame format the GPU node streams."""
+    out = b"data: " + json.dumps({"type": "text", "content": text}).encode("utf-8") + b"\n\n"
+    if audio_url:
+        out += b"data: " + json.dumps({"type": "audio", "url": audio_url}).encode("utf-8") + b"\n\n"
+    return out
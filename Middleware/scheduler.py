@@ -0,0 +1,413 @@
+"""
+Event-driven GPU slot scheduler.
+
+Replaces the old PriorityQueue + polling dispatcher thread: a freed slot is
+handed straight to the best waiting ticket inside release(), so there is no
+idle latency and no busy loop. Tickets can be cancelled (timeouts, client
+disconnects) and are dropped from the queue instead of swallowing a slot.
+
+Which ticket is "best" is decided by a policy:
+  - FairSharePolicy (default): weighted fair shares per tier with aging
+  - StrictPriorityPolicy: the original Commander > Infantry > Conscript order
+On top of either, no user may hold more than MAX_INFLIGHT_PER_USER slots.
+
+predict_wait() estimates how long a new ticket would queue, from the
+recent slot hold time (service rate = capacity / mean hold) and the
+policy's share for its tier, so callers can reject up front (admission
+control) instead of letting a doomed request wait out its timeout.
+"""
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+WAITING = "waiting"
+GRANTED = "granted"
+CANCELLED = "cancelled"
+EXPIRED = "expired"
+RELEASED = "released"
+
+# Priority number (see server.chat_priority) -> tier name
+PRIORITY_TIERS = {1: "commander", 2: "infantry", 3: "free"}
+
+SCHEDULER_POLICY = os.getenv("SCHEDULER_POLICY", "fair") # or "strict"
+# Share of slots each tier gets while all tiers are backlogged
+FAIR_WEIGHTS = os.getenv("FAIR_WEIGHTS", "commander:6,infantry:3,free:1")
+# A ticket waiting this long is served next regardless of tier
+AGING_SECONDS = float(os.getenv("AGING_SECONDS", 15))
+MAX_INFLIGHT_PER_USER = int(os.getenv("MAX_INFLIGHT_PER_USER", 3))
+WAIT_SAMPLES = 2048 # Recent queue waits kept per tier for percentiles
+HOLD_EWMA_ALPHA = 0.1 # Weight of the newest slot hold time in the service-rate estimate
+
+class Ticket:
+    """
+    One queued chat request. `event` is anything with a set() method
+    (threading.Event for Flask, AsyncTurnEvent for the ASGI path).
+    """
+    __slots__ = ("priority", "ts", "req_id", "event", "state", "granted_at", "deadline", "user_id")
+
+    def __init__(self, priority, req_id, event, timeout=None, user_id=None):
+        self.priority = priority
+        self.ts = time.time()
+        self.req_id = req_id
+        self.event = event
+        self.state = WAITING
+        self.granted_at = None
+        self.deadline = self.ts + timeout if timeout else None
+        self.user_id = user_id
+
+    def __lt__(self, other):
+        return (self.priority, self.ts, self.req_id) < (other.priority, other.ts, other.req_id)
+
+# --- POLICIES ---
+# A policy only orders tickets. pop() returns the next WAITING ticket for
+# which eligible(ticket) is true, removing it; dead tickets are skipped lazily.
+class StrictPriorityPolicy:
+    def __init__(self):
+        self._heap = []
+
+    def push(self, ticket):
+        heapq.heappush(self._heap, ticket)
+
+    def pop(self, eligible, now):
+        skipped = []
+        found = None
+        while self._heap:
+            ticket = heapq.heappop(self._heap)
+            if ticket.state != WAITING: continue
+            if eligible(ticket):
+                found = ticket
+                break
+            skipped.append(ticket)
+        for ticket in skipped:
+            heapq.heappush(self._heap, ticket)
+        return found
+
+    def tickets(self):
+        return list(self._heap)
+
+    def wait_estimate(self, priority, waiting, free, rate):
+        """Seconds until a new ticket of `priority` is granted; waiting: {priority: live count}."""
+        ahead = sum(n for p, n in waiting.items() if p <= priority)
+        return max(0, ahead + 1 - free) / rate
+
+    def compact(self):
+        self._heap = [t for t in self._heap if t.state == WAITING]
+        heapq.heapify(self._heap)
+
+class FairSharePolicy:
+    """
+    Stride scheduling over tiers: each grant advances the tier's pass by
+    1/weight and the backlogged tier with the lowest pass goes next, so under
+    contention tiers are served in proportion to their weights. A tier that
+    was idle rejoins at the current virtual time instead of cashing in banked
+    credit. Tickets older than `aging` seconds jump the line, oldest first.
+    """
+    def __init__(self, weights=FAIR_WEIGHTS, aging=AGING_SECONDS):
+        if isinstance(weights, str):
+            weights = {name: float(w) for name, _, w in (item.partition(':') for item in weights.split(','))}
+        tier_priority = {name: p for p, name in PRIORITY_TIERS.items()}
+        self.weights = {tier_priority.get(name, name): w for name, w in weights.items()}
+        self.aging = aging
+        self._queues = {}
+        self._passes = {}
+        self._vtime = 0.0
+
+    def push(self, ticket):
+        q = self._queues.setdefault(ticket.priority, deque())
+        while q and q[0].state != WAITING:
+            q.popleft()
+        if not q:
+            self._passes[ticket.priority] = max(self._passes.get(ticket.priority, 0.0), self._vtime)
+        q.append(ticket)
+
+    def pop(self, eligible, now):
+        heads = {}
+        for priority, q in self._queues.items():
+            while q and q[0].state != WAITING:
+                q.popleft()
+            head = next((t for t in q if t.state == WAITING and eligible(t)), None)
+            if head is not None:
+                heads[priority] = head
+        if not heads:
+            return None
+
+        aged = [t for t in heads.values() if now - t.ts >= self.aging]
+        if aged:
+            ticket = min(aged, key=lambda t: t.ts)
+        else:
+            ticket = heads[min(heads, key=lambda p: (self._passes.get(p, 0.0), p))]
+
+        priority = ticket.priority
+        self._vtime = max(self._vtime, self._passes.get(priority, 0.0))
+        self._passes[priority] = self._passes.get(priority, 0.0) + 1.0 / self.weights.get(priority, 1.0)
+        self._queues[priority].remove(ticket)
+        return ticket
+
+    def tickets(self):
+        return [t for q in self._queues.values() for t in q]
+
+    def wait_estimate(self, priority, waiting, free, rate):
+        """
+        The tier drains at its weighted share of the service rate among
+        backlogged tiers; once waits pass `aging` the queue is effectively
+        FIFO, which bounds the estimate for low-weight tiers.
+        """
+        backlogged = {p for p, n in waiting.items() if n} | {priority}
+        share = self.weights.get(priority, 1.0) / sum(self.weights.get(p, 1.0) for p in backlogged)
+        tier_wait = max(0, waiting.get(priority, 0) + 1 - free) / (rate * share)
+        fifo_wait = max(0, sum(waiting.values()) + 1 - free) / rate
+        return min(tier_wait, max(fifo_wait, self.aging))
+
+    def compact(self):
+        for priority, q in self._queues.items():
+            self._queues[priority] = deque(t for t in q if t.state == WAITING)
+
+def make_policy(name=SCHEDULER_POLICY):
+    return StrictPriorityPolicy() if name == "strict" else FairSharePolicy()
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class SlotScheduler:
+    def __init__(self, capacity, policy=None, per_user_cap=MAX_INFLIGHT_PER_USER):
+        self.capacity = capacity
+        self.policy = policy or make_policy()
+        self.per_user_cap = per_user_cap
+        self._lock = threading.Lock()
+        self._queued = 0 # Entries in the policy, dead or alive
+        self._waiting = 0 # Live (non-cancelled) tickets in the policy
+        self._active = set()
+        self._inflight_by_user = {}
+        self._ids = itertools.count()
+        self._waits = {}
+        self._waiting_by_priority = {}
+        self._hold_ewma = None # Seconds a granted slot is held, recent average
+        self.granted_total = 0
+        self.cancelled_total = 0
+        self.expired_total = 0
+        self.released_total = 0
+        self.rejected_total = 0
+
+    # --- CORE API ---
+    def submit(self, priority, event, req_id=None, timeout=None, user_id=None):
+        """
+        Enqueue a ticket. If a slot is free and the policy picks us, it is
+        granted immediately (event.set() is called before returning).
+        A ticket past its timeout is never granted, even if its waiter is slow
+        to notice.
+        """
+        ticket = Ticket(priority, next(self._ids) if req_id is None else req_id, event, timeout, user_id)
+        with self._lock:
+            self.policy.push(ticket)
+            self._queued += 1
+            self._waiting += 1
+            self._waiting_by_priority[priority] = self._waiting_by_priority.get(priority, 0) + 1
+            woken = self._fill()
+        for t in woken:
+            t.event.set()
+        return ticket
+
+    def cancel(self, ticket):
+        """
+        Withdraw a waiting ticket. Returns False if the ticket was already
+        granted (the caller then owns the slot and must release() it).
+        """
+        with self._lock:
+            if ticket.state == EXPIRED:
+                return True
+            if ticket.state != WAITING:
+                return False
+            ticket.state = CANCELLED
+            self._waiting -= 1
+            self._waiting_by_priority[ticket.priority] -= 1
+            self.cancelled_total += 1
+            # Lazy deletion; compact once dead tickets dominate the queue
+            if self._queued > 64 and self._waiting < self._queued // 2:
+                self.policy.compact()
+                self._queued = self._waiting
+            return True
+
+    def release(self, ticket):
+        """
+        Return a granted slot. Idempotent per ticket, so a double release in
+        an error path can never inflate capacity.
+        """
+        with self._lock:
+            if ticket.state != GRANTED:
+                logger.warning(f"⚠️ Ignoring release of ticket {ticket.req_id} in state {ticket.state}")
+                return
+            ticket.state = RELEASED
+            self._active.discard(ticket)
+            hold = time.time() - ticket.granted_at
+            self._hold_ewma = hold if self._hold_ewma is None else \
+                (1 - HOLD_EWMA_ALPHA) * self._hold_ewma + HOLD_EWMA_ALPHA * hold
+            if ticket.user_id is not None:
+                left = self._inflight_by_user.get(ticket.user_id, 1) - 1
+                if left: self._inflight_by_user[ticket.user_id] = left
+                else: self._inflight_by_user.pop(ticket.user_id, None)
+            self.released_total += 1
+            woken = self._fill()
+        for t in woken:
+            t.event.set()
+
+    def set_capacity(self, capacity):
+        """
+        Resize the slot budget (e.g. a GPU node joined or left the pool).
+        Growing wakes waiters at once; shrinking drains as slots are released.
+        """
+        with self._lock:
+            self.capacity = capacity
+            woken = self._fill()
+        for t in woken:
+            t.event.set()
+
+    def acquire(self, priority, timeout, req_id=None, user_id=None):
+        """
+        Blocking helper for the threaded Flask route.
+        Returns the granted ticket, or None on timeout (ticket removed).
+        """
+        ticket = self.submit(priority, threading.Event(), req_id, timeout, user_id)
+        if ticket.event.wait(timeout) or not self.cancel(ticket):
+            return ticket
+        return None
+
+    def predict_wait(self, priority):
+        """
+        Estimated seconds a ticket submitted now would wait for a slot
+        (0.0 while there is no hold-time history yet, inf with no capacity).
+        Ignores the per-user cap.
+        """
+        with self._lock:
+            if self.capacity <= 0:
+                return float("inf")
+            if self._hold_ewma is None:
+                return 0.0
+            free = self.capacity - len(self._active)
+            if free > 0 and not self._waiting:
+                return 0.0
+            rate = self.capacity / max(self._hold_ewma, 1e-3)
+            return self.policy.wait_estimate(priority, dict(self._waiting_by_priority), free, rate)
+
+    def admit(self, priority, budget):
+        """
+        Admission control: (True, predicted) if a ticket of `priority` is
+        expected to be granted within `budget` seconds, else (False, predicted).
+        """
+        predicted = self.predict_wait(priority)
+        if predicted <= budget:
+            return True, predicted
+        with self._lock:
+            self.rejected_total += 1
+        return False, predicted
+
+    # --- INTERNALS (Call with lock held) ---
+    def _eligible(self, ticket):
+        return ticket.user_id is None or self._inflight_by_user.get(ticket.user_id, 0) < self.per_user_cap
+
+    def _fill(self):
+        """Grants slots while any are free and an eligible ticket waits."""
+        woken = []
+        now = time.time()
+        while len(self._active) < self.capacity:
+            ticket = self.policy.pop(self._eligible, now)
+            if ticket is None: break
+            self._queued -= 1
+            self._waiting -= 1
+            self._waiting_by_priority[ticket.priority] -= 1
+            if ticket.deadline is not None and ticket.deadline <= now:
+                ticket.state = EXPIRED
+                self.expired_total += 1
+                continue
+            self._grant(ticket)
+            woken.append(ticket)
+        return woken
+
+    def _grant(self, ticket):
+        ticket.state = GRANTED
+        ticket.granted_at = time.time()
+        self._active.add(ticket)
+        if ticket.user_id is not None:
+            self._inflight_by_user[ticket.user_id] = self._inflight_by_user.get(ticket.user_id, 0) + 1
+        waits = self._waits.get(ticket.priority)
+        if waits is None:
+            waits = self._waits[ticket.priority] = deque(maxlen=WAIT_SAMPLES)
+        waits.append(ticket.granted_at - ticket.ts)
+        self.granted_total += 1
+
+    # --- INTROSPECTION ---
+    def check_invariants(self):
+        """
+        Returns a list of violated invariants (empty list == healthy).
+        """
+        with self._lock:
+            problems = []
+            if any(t.state != GRANTED for t in self._active):
+                problems.append("non-granted ticket holds a slot")
+            live = [t for t in self.policy.tickets() if t.state == WAITING]
+            if len(live) != self._waiting:
+                problems.append(f"waiting counter {self._waiting} != live tickets {len(live)}")
+            if sum(self._waiting_by_priority.values()) != self._waiting:
+                problems.append("per-tier waiting counts do not match waiting counter")
+            if len(self._active) < self.capacity and any(self._eligible(t) for t in live):
+                problems.append("free slot while an eligible ticket is waiting")
+            if sum(self._inflight_by_user.values()) != sum(1 for t in self._active if t.user_id is not None):
+                problems.append("per-user in-flight counts do not match active slots")
+            if self.granted_total - self.released_total != len(self._active):
+                problems.append("granted/released totals do not match active slots")
+            return problems
+
+    def occupancy(self):
+        """(active, capacity, waiting per tier) for metrics scrapes."""
+        with self._lock:
+            waiting = {}
+            for t in self.policy.tickets():
+                if t.state == WAITING:
+                    tier = PRIORITY_TIERS.get(t.priority, str(t.priority))
+                    waiting[tier] = waiting.get(tier, 0) + 1
+            return len(self._active), self.capacity, waiting
+
+    def queue_wait_percentiles(self):
+        """
+        Recent queue-wait p50/p90/p99 (seconds) per tier, for tuning FAIR_WEIGHTS.
+        """
+        with self._lock:
+            snapshot = {p: sorted(w) for p, w in self._waits.items()}
+        return {
+            PRIORITY_TIERS.get(p, str(p)): {
+                "count": len(w),
+                "p50": round(percentile(w, 50), 4),
+                "p90": round(percentile(w, 90), 4),
+                "p99": round(percentile(w, 99), 4)
+            }
+            for p, w in snapshot.items()
+        }
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            oldest_hold = max((now - t.granted_at for t in self._active), default=0.0)
+            stats = {
+                "policy": type(self.policy).__name__,
+                "capacity": self.capacity,
+                "active": len(self._active),
+                "waiting": self._waiting,
+                "per_user_cap": self.per_user_cap,
+                "granted_total": self.granted_total,
+                "released_total": self.released_total,
+                "cancelled_total": self.cancelled_total,
+                "expired_total": self.expired_total,
+                "rejected_total": self.rejected_total,
+                "mean_hold_seconds": round(self._hold_ewma, 3) if self._hold_ewma is not None else None,
+                "oldest_hold_seconds": round(oldest_hold, 3)
+            }
+        stats["queue_wait"] = self.queue_wait_percentiles()
+        return stats
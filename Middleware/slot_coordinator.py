@@ -0,0 +1,513 @@
+"""
+One GPU slot budget and one priority order across worker processes.
+
+SlotScheduler is process-local: under gunicorn with N workers the slot
+budget is N times too large and tiers are only ordered within a worker.
+With SLOT_COORDINATOR set, every worker instead talks to a single
+coordinator process that owns the real SlotScheduler (same policies, same
+per-user cap, now global):
+
+    python slot_coordinator.py --address /tmp/dictator-slots.sock &
+    SLOT_COORDINATOR=/tmp/dictator-slots.sock gunicorn -w 4 server:app
+
+The address is a Unix socket path (mode 0660) or host:port. ":port" binds to
+127.0.0.1. TCP needs SLOT_COORDINATOR_TOKEN, a shared secret that every
+worker sends in its first message ({"op": "hello", "token": ...}); a
+connection that fails the check is closed. On a Unix socket the token is
+optional but checked when set. RemoteSlotScheduler is a drop-in for
+SlotScheduler on the worker side. It uses one persistent connection and a
+newline-delimited JSON protocol:
+
+    -> {"op": "submit", "id": 7, "priority": 2, "timeout": 60, "user": "u1", "req": 41}
+    <- {"op": "granted", "id": 7}
+    -> {"op": "release", "id": 7}
+    -> {"op": "cancel", "id": 8, "rpc": 3}       <- {"op": "reply", "rpc": 3, "result": true}
+    -> {"op": "call", "method": "stats", "args": [], "rpc": 4}
+
+Slots are leases on the connection. When a worker dies, the kernel closes
+its socket, and the coordinator cancels the worker's waiting tickets and
+releases its granted slots. If the coordinator goes away, workers expire
+their waiting tickets and admission rejects new chats until it is back.
+The slot budget is decided in the coordinator alone. It probes the GPU
+nodes itself and runs the AdaptiveLimiter. Workers only send their upstream
+samples ({"op": "sample", "ttft": 0.4} or {"op": "sample", "error": true}).
+Workers cannot set the capacity, so they never overwrite one another's view
+of the global limit.
+"""
+import hmac
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from scheduler import SlotScheduler, WAITING, GRANTED, CANCELLED, EXPIRED, RELEASED
+
+logger = logging.getLogger(__name__)
+
+SLOT_COORDINATOR = os.getenv("SLOT_COORDINATOR") # Unset = process-local scheduler
+SLOT_COORDINATOR_TOKEN = os.getenv("SLOT_COORDINATOR_TOKEN") # Required for TCP
+COORDINATOR_TIMEOUT = float(os.getenv("COORDINATOR_TIMEOUT", 5)) # Seconds per RPC
+RECONNECT_INTERVAL = 1.0 # Min seconds between connection attempts
+
+# Scheduler methods workers may call remotely
+RPC_METHODS = {"occupancy", "stats", "check_invariants", "queue_wait_percentiles",
+               "predict_wait", "admit"}
+
+def parse_address(address):
+    """'/path/to.sock' -> (AF_UNIX, path); 'host:port' -> (AF_INET, (host, port))."""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return socket.AF_UNIX, address
+
+# --- COORDINATOR (SERVER SIDE) ---
+class _Connection:
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.name = name
+        self.tickets = {} # worker ticket id -> Ticket
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        data = json.dumps(msg).encode() + b"\n"
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass # Reader sees the disconnect and reclaims
+
+class _RemoteEvent:
+    """Ticket event whose set() tells the owning worker its slot is granted."""
+    __slots__ = ("conn", "tid")
+
+    def __init__(self, conn, tid):
+        self.conn = conn
+        self.tid = tid
+
+    def set(self):
+        self.conn.send({"op": "granted", "id": self.tid})
+
+class SlotCoordinator:
+    def __init__(self, address, capacity, scheduler=None, limiter=None, token=SLOT_COORDINATOR_TOKEN):
+        """
+        limiter: optional AdaptiveLimiter on the same scheduler, fed by the
+        workers' samples.
+        """
+        if parse_address(address)[0] != socket.AF_UNIX and not token:
+            raise ValueError("A TCP slot coordinator needs SLOT_COORDINATOR_TOKEN")
+        self.address = address
+        self.token = token
+        self.scheduler = scheduler or SlotScheduler(capacity)
+        self.limiter = limiter
+        self.connections = set()
+        self.reclaimed_total = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def serve_forever(self):
+        family, addr = parse_address(self.address)
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                coordinator._serve(self.request, self.rfile, str(self.client_address or "unix"))
+
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.unlink(addr) # Stale socket from a previous run
+            server_cls = type("Server", (socketserver.ThreadingMixIn, socketserver.UnixStreamServer), {})
+        else:
+            server_cls = type("Server", (socketserver.ThreadingMixIn, socketserver.TCPServer), {"allow_reuse_address": True})
+        server_cls.daemon_threads = True
+        self._server = server_cls(addr, Handler)
+        if family == socket.AF_UNIX:
+            os.chmod(addr, 0o660) # Same user/group as the workers only
+        logger.info(f"🛰️ Slot coordinator on {self.address} (capacity {self.scheduler.capacity})")
+        self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _serve(self, sock, rfile, name):
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if not self._authenticate(rfile.readline()):
+            logger.warning(f"🚫 Coordinator: rejected {name} (bad or missing token)")
+            return
+        conn = _Connection(sock, name)
+        with self._lock:
+            self.connections.add(conn)
+        try:
+            for line in rfile:
+                try:
+                    self._dispatch(conn, json.loads(line))
+                except Exception as e:
+                    logger.error(f"❌ Coordinator: bad message from {name}: {e}")
+        finally:
+            self._reclaim(conn)
+
+    def _authenticate(self, line):
+        try:
+            hello = json.loads(line)
+        except ValueError:
+            return False
+        if not isinstance(hello, dict) or hello.get("op") != "hello":
+            return False
+        if not self.token:
+            return True
+        return hmac.compare_digest(str(hello.get("token") or "").encode(), self.token.encode())
+
+    def _dispatch(self, conn, msg):
+        op = msg["op"]
+        if op == "submit":
+            ticket = self.scheduler.submit(msg["priority"], _RemoteEvent(conn, msg["id"]), msg.get("req"),
+                                           msg.get("timeout"), msg.get("user"))
+            conn.tickets[msg["id"]] = ticket
+        elif op == "release":
+            ticket = conn.tickets.pop(msg["id"], None)
+            if ticket is not None:
+                self.scheduler.release(ticket)
+        elif op == "cancel":
+            ticket = conn.tickets.get(msg["id"])
+            ok = ticket is None or self.scheduler.cancel(ticket)
+            if ok:
+                conn.tickets.pop(msg["id"], None)
+            conn.send({"op": "reply", "rpc": msg["rpc"], "result": ok})
+        elif op == "sample":
+            if self.limiter is not None:
+                self.limiter.record(msg.get("ttft"), msg.get("error", False))
+        elif op == "call" and msg["method"] == "adaptive_limit":
+            result = self.limiter.stats() if self.limiter else {"enabled": False}
+            conn.send({"op": "reply", "rpc": msg["rpc"], "result": result})
+        elif op == "call":
+            if msg["method"] not in RPC_METHODS:
+                raise ValueError(f"method {msg['method']} not allowed")
+            result = getattr(self.scheduler, msg["method"])(*msg.get("args", []))
+            if msg["method"] == "stats":
+                result["coordinator"] = self.stats()
+            conn.send({"op": "reply", "rpc": msg["rpc"], "result": result})
+        else:
+            raise ValueError(f"unknown op {op}")
+
+    def _reclaim(self, conn):
+        """The worker is gone: its queued tickets are dropped and its slots come back."""
+        with conn.lock:
+            conn.closed = True
+        reclaimed = 0
+        for ticket in list(conn.tickets.values()):
+            if not self.scheduler.cancel(ticket):
+                self.scheduler.release(ticket)
+                reclaimed += 1
+        conn.tickets.clear()
+        with self._lock:
+            self.connections.discard(conn)
+            self.reclaimed_total += reclaimed
+        if reclaimed:
+            logger.warning(f"♻️ Worker {conn.name} disconnected, reclaimed {reclaimed} slots")
+
+    def stats(self):
+        with self._lock:
+            return {"address": self.address, "workers": len(self.connections), "reclaimed_total": self.reclaimed_total}
+
+# --- WORKER SIDE ---
+class RemoteTicket:
+    __slots__ = ("id", "priority", "ts", "req_id", "event", "state", "granted_at", "user_id")
+
+    def __init__(self, tid, priority, req_id, event, user_id):
+        self.id = tid
+        self.priority = priority
+        self.ts = time.time()
+        self.req_id = req_id
+        self.event = event
+        self.state = WAITING
+        self.granted_at = None
+        self.user_id = user_id
+
+class CoordinatorUnavailable(ConnectionError):
+    pass
+
+class RemoteSlotScheduler:
+    """
+    SlotScheduler interface backed by the coordinator. Grants arrive on a
+    reader thread, which sets the ticket state and calls event.set() just
+    like a local release() would.
+    """
+    def __init__(self, address, timeout=COORDINATOR_TIMEOUT, token=SLOT_COORDINATOR_TOKEN):
+        self.address = address
+        self.timeout = timeout
+        self.token = token
+        self._lock = threading.Lock() # Connection state
+        self._send_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._sock = None
+        self._last_attempt = 0.0
+        self._tickets = {}
+        self._rpcs = {}
+        self._ids = itertools.count(1)
+        self.reconnects = 0
+        self.capacity = None # Last value seen via occupancy()
+
+    # --- CONNECTION ---
+    def _check_fork(self):
+        """A forked worker (gunicorn --preload) must not share its parent's connection or tickets."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._sock, self._tickets, self._rpcs, self._pid = None, {}, {}, os.getpid()
+
+    def _connect(self):
+        """Returns the live socket, (re)connecting lazily."""
+        with self._lock:
+            if self._sock is not None:
+                return self._sock
+            if time.time() - self._last_attempt < RECONNECT_INTERVAL:
+                raise CoordinatorUnavailable(f"Slot coordinator {self.address} unavailable")
+            self._last_attempt = time.time()
+            family, addr = parse_address(self.address)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(addr)
+                sock.sendall(json.dumps({"op": "hello", "token": self.token}).encode() + b"\n")
+                sock.settimeout(None)
+                if family != socket.AF_UNIX:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            except OSError as e:
+                sock.close()
+                raise CoordinatorUnavailable(f"Slot coordinator {self.address} unavailable: {e}")
+            self._sock = sock
+            self.reconnects += 1
+            threading.Thread(target=self._read, args=(sock,), name="slot-coordinator", daemon=True).start()
+            logger.info(f"🛰️ Connected to slot coordinator {self.address}")
+            return sock
+
+    def _send(self, msg):
+        sock = self._connect()
+        try:
+            with self._send_lock:
+                sock.sendall(json.dumps(msg).encode() + b"\n")
+        except OSError as e:
+            self._disconnected(sock)
+            raise CoordinatorUnavailable(str(e))
+
+    def _read(self, sock):
+        buf = b""
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                lines = (buf + chunk).split(b"\n")
+                buf = lines.pop()
+                for line in lines:
+                    self._handle(json.loads(line))
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Slot coordinator connection lost: {e}")
+        self._disconnected(sock)
+
+    def _handle(self, msg):
+        if msg["op"] == "granted":
+            ticket = self._tickets.get(msg["id"])
+            if ticket is not None and ticket.state == WAITING:
+                ticket.state = GRANTED
+                ticket.granted_at = time.time()
+                ticket.event.set()
+        elif msg["op"] == "reply":
+            waiter = self._rpcs.pop(msg["rpc"], None)
+            if waiter is not None:
+                waiter[1] = msg["result"]
+                waiter[0].set()
+
+    def _disconnected(self, sock):
+        """Coordinator gone: it has dropped our leases, so waiting tickets expire now."""
+        with self._lock:
+            if self._sock is not sock:
+                return
+            self._sock = None
+            tickets, self._tickets = self._tickets, {}
+            rpcs, self._rpcs = self._rpcs, {}
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for ticket in tickets.values():
+            if ticket.state == WAITING:
+                ticket.state = EXPIRED
+                ticket.event.set()
+        for waiter in rpcs.values():
+            waiter[0].set() # Result stays the CoordinatorUnavailable marker
+
+    def _call(self, method, *args):
+        self._check_fork()
+        rpc = next(self._ids)
+        waiter = [threading.Event(), CoordinatorUnavailable]
+        self._rpcs[rpc] = waiter
+        try:
+            self._send({"op": "call", "method": method, "args": list(args), "rpc": rpc})
+        except CoordinatorUnavailable:
+            self._rpcs.pop(rpc, None)
+            raise
+        if not waiter[0].wait(self.timeout) or waiter[1] is CoordinatorUnavailable:
+            self._rpcs.pop(rpc, None)
+            raise CoordinatorUnavailable(f"Slot coordinator did not answer {method}")
+        return waiter[1]
+
+    # --- CORE API (same contract as SlotScheduler) ---
+    def submit(self, priority, event, req_id=None, timeout=None, user_id=None):
+        """
+        Queues a ticket with the coordinator. If it can't be reached the
+        ticket comes back EXPIRED with its event set, so waiters fail fast.
+        """
+        self._check_fork()
+        tid = next(self._ids)
+        ticket = RemoteTicket(tid, priority, req_id, event, user_id)
+        self._tickets[tid] = ticket
+        try:
+            self._send({"op": "submit", "id": tid, "priority": priority, "req": req_id,
+                        "timeout": timeout, "user": user_id})
+        except CoordinatorUnavailable as e:
+            logger.error(f"❌ Cannot queue Request {req_id}: {e}")
+            self._tickets.pop(tid, None)
+            ticket.state = EXPIRED
+            event.set()
+        return ticket
+
+    def cancel(self, ticket):
+        if ticket.state == EXPIRED:
+            return True
+        if ticket.state != WAITING:
+            return False
+        rpc = next(self._ids)
+        waiter = [threading.Event(), CoordinatorUnavailable]
+        self._rpcs[rpc] = waiter
+        try:
+            self._send({"op": "cancel", "id": ticket.id, "rpc": rpc})
+            answered = waiter[0].wait(self.timeout)
+        except CoordinatorUnavailable:
+            answered = False
+        if not answered or waiter[1] is CoordinatorUnavailable:
+            self._rpcs.pop(rpc, None)
+            # The coordinator is gone (or hung); it reclaims the lease on disconnect
+            if ticket.state == WAITING:
+                ticket.state = EXPIRED
+            return ticket.state != GRANTED
+        if waiter[1]:
+            ticket.state = CANCELLED
+            self._tickets.pop(ticket.id, None)
+            return True
+        # Granted while the cancel was in flight (the grant message may still
+        # be on its way): the caller owns the slot
+        if ticket.state == WAITING:
+            ticket.state = GRANTED
+            ticket.granted_at = time.time()
+        return False
+
+    def release(self, ticket):
+        if ticket.state != GRANTED:
+            logger.warning(f"⚠️ Ignoring release of ticket {ticket.req_id} in state {ticket.state}")
+            return
+        ticket.state = RELEASED
+        if self._tickets.pop(ticket.id, None) is None:
+            return # Connection was lost meanwhile; the coordinator already reclaimed it
+        try:
+            self._send({"op": "release", "id": ticket.id})
+        except CoordinatorUnavailable:
+            pass
+
+    def acquire(self, priority, timeout, req_id=None, user_id=None):
+        ticket = self.submit(priority, threading.Event(), req_id, timeout, user_id)
+        if ticket.event.wait(timeout) or not self.cancel(ticket):
+            return ticket if ticket.state == GRANTED else None
+        return None
+
+    # --- ADAPTIVE LIMIT (runs in the coordinator) ---
+    def record_sample(self, ttft=None, error=False):
+        """One upstream outcome for the coordinator's AdaptiveLimiter (fire and forget)."""
+        self._check_fork()
+        try:
+            self._send({"op": "sample", "ttft": ttft, "error": error})
+        except CoordinatorUnavailable:
+            pass
+
+    def adaptive_limit_stats(self):
+        try:
+            return self._call("adaptive_limit")
+        except CoordinatorUnavailable as e:
+            return {"error": str(e)}
+
+    # --- INTROSPECTION / ADMISSION ---
+    def occupancy(self):
+        try:
+            active, capacity, waiting = self._call("occupancy")
+        except CoordinatorUnavailable:
+            return 0, 0, {}
+        self.capacity = capacity
+        return active, capacity, waiting
+
+    def predict_wait(self, priority):
+        try:
+            return self._call("predict_wait", priority)
+        except CoordinatorUnavailable:
+            return float("inf")
+
+    def admit(self, priority, budget):
+        try:
+            return tuple(self._call("admit", priority, budget))
+        except CoordinatorUnavailable:
+            return False, float("inf")
+
+    def check_invariants(self):
+        try:
+            return self._call("check_invariants")
+        except CoordinatorUnavailable as e:
+            return [str(e)]
+
+    def queue_wait_percentiles(self):
+        try:
+            return self._call("queue_wait_percentiles")
+        except CoordinatorUnavailable:
+            return {}
+
+    def stats(self):
+        local = {"address": self.address, "connected": self._sock is not None and self._pid == os.getpid(),
+                 "local_tickets": len(self._tickets), "connects": self.reconnects}
+        try:
+            stats = self._call("stats")
+        except CoordinatorUnavailable as e:
+            return {"error": str(e), "worker": local}
+        stats["worker"] = local
+        return stats
+
+if __name__ == '__main__':
+    import argparse
+    from adaptive_limit import AdaptiveLimiter, ADAPTIVE_CONCURRENCY
+    from gpu_pool import GPUPool, nodes_from_env
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Global GPU slot coordinator")
+    parser.add_argument("--address", default=SLOT_COORDINATOR or "/tmp/dictator-slots.sock",
+                        help="Unix socket path or host:port")
+    parser.add_argument("--capacity", type=int, help="Fixed slot budget (default: healthy GPU node limits, probed)")
+    args = parser.parse_args()
+    scheduler = SlotScheduler(args.capacity or 0)
+    pool = None
+    if args.capacity is None:
+        pool = GPUPool(nodes_from_env())
+        scheduler.set_capacity(pool.capacity)
+    ceiling = scheduler.capacity
+    limiter = AdaptiveLimiter(scheduler, ceiling) if ADAPTIVE_CONCURRENCY else None
+    if pool is not None:
+        # Node health decides the ceiling here, once, for every worker
+        pool.on_capacity_change = limiter.set_ceiling if limiter else scheduler.set_capacity
+        pool.start_probes()
+    SlotCoordinator(args.address, ceiling, scheduler, limiter).serve_forever()
@@ -0,0 +1,176 @@
+"""
+Local stand-in for BTCPay Server's Greenfield invoice API.
+
+Serves POST/GET /api/v1/stores/<store>/invoices[/<id>] the way btcpay_utils
+uses them, with keep-alive (HTTP/1.1), so the pooled client, retries, the
+circuit breaker and invoice reuse can be exercised without a BTCPay
+instance. fail_next answers the next N requests 503, fail_rate a share of
+them, delay adds latency. settle() marks an invoice paid and, with a
+webhook_url, delivers a signed InvoiceSettled webhook like BTCPay does.
+connections counts accepted TCP connections (1 per client when pooling
+works).
+
+    python stub_btcpay.py --port 23000 --webhook-url http://127.0.0.1:5000/api/webhooks/btcpay
+    BTCPAY_URL=http://127.0.0.1:23000 python server.py
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+INVOICE_PATH = re.compile(r"^/api/v1/stores/([^/]+)/invoices(?:/([^/?]+))?$")
+
+class StubConfig:
+    def __init__(self, api_key=None, delay=0.0, fail_rate=0.0, fail_next=0, expiry=900,
+                 webhook_url=None, webhook_secret=None, seed=None):
+        self.api_key = api_key
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.fail_next = fail_next
+        self.expiry = expiry # Seconds an invoice stays payable
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.random = random.Random(seed)
+        self.base_url = None # Set by start_stub once the port is known
+        self.lock = threading.Lock()
+        self.invoices = {}
+        self.requests = 0
+        self.created = 0
+        self.failed = 0
+        self.connections = 0
+
+def settle(config, invoice_id):
+    """Marks the invoice Settled and, if configured, sends the signed webhook. Returns the webhook status."""
+    with config.lock:
+        invoice = config.invoices[invoice_id]
+        invoice["status"] = "Settled"
+    if not config.webhook_url:
+        return None
+    body = json.dumps({"type": "InvoiceSettled", "invoiceId": invoice_id, "storeId": invoice["storeId"],
+                       "metadata": invoice["metadata"], "timestamp": int(time.time())}).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if config.webhook_secret:
+        headers["BTCPay-Sig"] = "sha256=" + hmac.new(config.webhook_secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return requests.post(config.webhook_url, data=body, headers=headers, timeout=10).status_code
+
+def make_handler(config):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            with config.lock:
+                config.connections += 1
+
+        def _send(self, status, payload=None):
+            body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self):
+            """Common checks. Returns the path match, or None once an error was sent."""
+            with config.lock:
+                config.requests += 1
+                fail = config.fail_next > 0 or (config.fail_rate and config.random.random() < config.fail_rate)
+                if fail:
+                    config.fail_next = max(0, config.fail_next - 1)
+                    config.failed += 1
+            time.sleep(config.delay)
+            if fail:
+                self._send(503, {"code": "service-unavailable"})
+                return None
+            if config.api_key and self.headers.get("Authorization") != f"token {config.api_key}":
+                self._send(401, {"code": "unauthenticated"})
+                return None
+            match = INVOICE_PATH.match(self.path)
+            if not match:
+                self._send(404, {"code": "not-found"})
+            return match
+
+        def do_GET(self):
+            match = self._route()
+            if not match:
+                return
+            with config.lock:
+                invoice = config.invoices.get(match.group(2))
+                if invoice is not None and invoice["status"] == "New" and time.time() > invoice["expirationTime"]:
+                    invoice["status"] = "Expired"
+                invoice = dict(invoice) if invoice else None
+            if invoice is None:
+                return self._send(404, {"code": "invoice-not-found"})
+            self._send(200, invoice)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            match = self._route()
+            if not match:
+                return
+            if match.group(2):
+                return self._send(405, {"code": "method-not-allowed"})
+            data = json.loads(body or b"{}")
+            now = int(time.time())
+            invoice_id = uuid.uuid4().hex[:22]
+            invoice = {
+                "id": invoice_id,
+                "storeId": match.group(1),
+                "amount": data.get("amount"),
+                "currency": data.get("currency"),
+                "metadata": data.get("metadata") or {},
+                "checkout": data.get("checkout") or {},
+                "status": "New",
+                "createdTime": now,
+                "expirationTime": now + config.expiry,
+                "checkoutLink": f"{config.base_url}/i/{invoice_id}"
+            }
+            with config.lock:
+                config.invoices[invoice_id] = invoice
+                config.created += 1
+            self._send(200, invoice)
+
+    return StubHandler
+
+def start_stub(port=0, **kwargs):
+    """
+    Starts a fake BTCPay on a background thread.
+    Returns (server, config); server.server_address has the bound port.
+    """
+    config = StubConfig(**kwargs)
+    httpd = ThreadingHTTPServer(("127.0.0.1", port), make_handler(config))
+    httpd.daemon_threads = True
+    config.base_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, config
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake BTCPay Server")
+    parser.add_argument("--port", type=int, default=23000)
+    parser.add_argument("--api-key", help="Require 'Authorization: token <key>'")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of requests answered 503")
+    parser.add_argument("--expiry", type=int, default=900, help="Invoice lifetime in seconds")
+    parser.add_argument("--webhook-url", help="Where settle sends InvoiceSettled")
+    parser.add_argument("--webhook-secret")
+    args = parser.parse_args()
+    httpd, config = start_stub(args.port, api_key=args.api_key, delay=args.delay, fail_rate=args.fail_rate,
+                               expiry=args.expiry, webhook_url=args.webhook_url, webhook_secret=args.webhook_secret)
+    print(f"[INFO] Fake BTCPay on {config.base_url} (type an invoice id + Enter to settle it)")
+    try:
+        for line in iter(input, None):
+            if line.strip():
+                print(f"[INFO] Settled {line.strip()}: webhook -> {settle(config, line.strip())}")
+    except (EOFError, KeyboardInterrupt):
+        pass
@@ -0,0 +1,139 @@
+"""
+Local stand-in for a GPU node's /generate_stream endpoint.
+
+Streams newline-delimited JSON frames ({"type": "text"} ... {"type": "audio"})
+like the real backend so the middleware, the GPU pool and failover can be
+exercised without a GPU. /generate_batch speaks the multiplexed batch
+protocol from upstream_batch.py (id-prefixed, interleaved frames).
+
+Timing and faults are configurable for load tests (bench.py): ttft is the
+delay before the first frame, delay the gap between tokens, fail_rate the
+share of requests answered 503 and drop_rate the share of streams cut off
+halfway.
+
+    python stub_gpu_node.py --port 41216 --tokens 40 --delay 0.02 --ttft 0.3 --fail-rate 0.05
+    GPU_NODE_URLS="http://127.0.0.1:41216,http://127.0.0.1:41217" python server.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubConfig:
+    def __init__(self, tokens=40, delay=0.02, healthy=True, ttft=0.0, fail_rate=0.0, drop_rate=0.0, seed=None):
+        self.tokens = tokens
+        self.delay = delay
+        self.healthy = healthy
+        self.ttft = ttft
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failed = 0
+        self.dropped = 0
+        self.batches = [] # Size of every /generate_batch call
+
+def make_handler(config):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            status = 200 if config.healthy else 503
+            body = json.dumps({"status": "ok" if config.healthy else "down"}).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            config.requests += 1
+            if not config.healthy or self.path not in ("/generate_stream", "/generate_batch"):
+                self.send_response(503 if not config.healthy else 404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if config.fail_rate and config.random.random() < config.fail_rate:
+                config.failed += 1
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if self.path == "/generate_batch":
+                return self._batch(json.loads(body)["requests"])
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            drop_at = config.tokens // 2 if config.drop_rate and config.random.random() < config.drop_rate else None
+            time.sleep(config.ttft)
+            for i in range(config.tokens):
+                if i == drop_at:
+                    # Simulated crash: connection dies without the terminating chunk
+                    config.dropped += 1
+                    self.close_connection = True
+                    return
+                self._chunk({"type": "text", "content": f"word{i} "})
+                time.sleep(config.delay)
+            self._chunk({"type": "audio", "url": f"https://s3.filebase.com/hitler-audio/stub_{config.requests}.wav"})
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _batch(self, requests):
+            config.batches.append(len(requests))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(config.ttft)
+            # One "forward pass" emits the next token of every request
+            for i in range(config.tokens):
+                self._write(b"".join(self._line(r["id"], {"type": "text", "content": f"word{i} "}) for r in requests))
+                time.sleep(config.delay)
+            for r in requests:
+                self._write(self._line(r["id"], {"type": "audio", "url": f"https://s3.filebase.com/hitler-audio/stub_{r['id']}.wav"})
+                            + self._line(r["id"], {"type": "end"}))
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _line(self, rid, frame):
+            return f"{rid} {json.dumps(frame)}\n".encode("utf-8")
+
+        def _chunk(self, frame):
+            self._write((json.dumps(frame) + "\n").encode("utf-8"))
+
+        def _write(self, data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+    return StubHandler
+
+def start_stub(port=0, **kwargs):
+    """
+    Starts a stub node on a background thread.
+    Returns (server, config); server.server_address has the bound port.
+    """
+    config = StubConfig(**kwargs)
+    httpd = ThreadingHTTPServer(("127.0.0.1", port), make_handler(config))
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, config
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stub GPU node")
+    parser.add_argument("--port", type=int, default=41216)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--delay", type=float, default=0.02, help="Seconds between text frames")
+    parser.add_argument("--ttft", type=float, default=0.0, help="Seconds before the first frame")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of requests answered 503")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Share of streams cut off halfway")
+    args = parser.parse_args()
+    config = StubConfig(args.tokens, args.delay, ttft=args.ttft, fail_rate=args.fail_rate, drop_rate=args.drop_rate)
+    httpd = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(config))
+    print(f"[INFO] Stub GPU node on http://127.0.0.1:{args.port}/generate_stream")
+    httpd.serve_forever()
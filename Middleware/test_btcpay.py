@@ -0,0 +1,123 @@
+"""
+BTCPayClient retries and circuit breaker (btcpay_utils.py) against the fake
+BTCPay in stub_btcpay.py:
+
+    python -m pytest -q test_btcpay.py
+"""
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+import btcpay_utils
+from btcpay_utils import BTCPayClient, BTCPayUnavailable
+from stub_btcpay import start_stub
+
+def free_port():
+    """A local port nothing listens on (connections are refused)."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class BTCPayTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(btcpay_utils, "BTCPAY_BACKOFF", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.httpd, self.stub = start_stub()
+        self.addCleanup(self.httpd.shutdown)
+
+    def client(self, base_url=None, **kwargs):
+        kwargs.setdefault("retries", 2)
+        kwargs.setdefault("verify_reuse", False)
+        return BTCPayClient(base_url=base_url or self.stub.base_url, store_id="store", api_key="key", **kwargs)
+
+class RetryTest(BTCPayTestCase):
+    def test_unavailable_answer_is_retried(self):
+        self.stub.fail_next = 1 # 503: BTCPay refused it before creating anything
+        client = self.client()
+        invoice = client.create_invoice(10, "USD", {"userId": "u1"})
+        self.assertEqual(invoice["status"], "New")
+        self.assertEqual(self.stub.requests, 2)
+        self.assertEqual(self.stub.created, 1)
+        self.assertEqual(client.retried, 1)
+
+    def test_no_retry_once_btcpay_saw_the_request(self):
+        self.stub.delay = 0.5 # Invoice is created, but the answer comes after the read timeout
+        client = self.client(timeout=0.2)
+        with self.assertRaises(BTCPayUnavailable):
+            client.create_invoice(10, "USD", {"userId": "u1"})
+        time.sleep(0.4)
+        self.assertEqual(self.stub.requests, 1)
+        self.assertEqual(self.stub.created, 1) # A retry would have made a duplicate
+        self.assertEqual(client.retried, 0)
+
+    def test_read_timeout_on_get_is_retried(self):
+        client = self.client()
+        invoice = client.create_invoice(10, "USD")
+        self.stub.delay = 0.3
+        client.timeout = 0.1
+        with self.assertRaises(BTCPayUnavailable):
+            client.get_invoice(invoice["id"])
+        self.assertEqual(client.retried, 2)
+
+    def test_refused_connection_is_retried(self):
+        client = self.client(base_url=f"http://127.0.0.1:{free_port()}")
+        with self.assertRaises(BTCPayUnavailable):
+            client.create_invoice(10, "USD")
+        self.assertEqual(client.retried, 2) # Never reached BTCPay, so safe to retry
+
+class CircuitBreakerTest(BTCPayTestCase):
+    def test_opens_then_half_opens_with_one_trial(self):
+        self.stub.fail_rate = 1.0
+        client = self.client(retries=0, breaker_threshold=2, breaker_cooldown=0.3)
+        for _ in range(2):
+            with self.assertRaises(BTCPayUnavailable):
+                client.create_invoice(10, "USD")
+        self.assertEqual(client.stats()["circuit"], "open")
+
+        # Open: fails fast without touching the network
+        seen = self.stub.requests
+        with self.assertRaisesRegex(BTCPayUnavailable, "open"):
+            client.create_invoice(10, "USD")
+        self.assertEqual(self.stub.requests, seen)
+        self.assertEqual(client.rejected, 1)
+
+        # Cooldown over: one trial call goes through, concurrent calls are turned away
+        time.sleep(0.35)
+        self.assertEqual(client.stats()["circuit"], "half_open")
+        self.stub.fail_rate = 0.0
+        self.stub.delay = 0.3
+        trial = threading.Thread(target=client.create_invoice, args=(10, "USD"))
+        trial.start()
+        time.sleep(0.1)
+        with self.assertRaisesRegex(BTCPayUnavailable, "half-open"):
+            client.create_invoice(10, "USD")
+        trial.join()
+        self.assertEqual(self.stub.requests, seen + 1)
+        self.assertEqual(client.stats()["circuit"], "closed")
+        self.assertEqual(client.breaker_opens, 1)
+
+    def test_failed_trial_reopens(self):
+        self.stub.fail_rate = 1.0
+        client = self.client(retries=0, breaker_threshold=1, breaker_cooldown=0.2)
+        with self.assertRaises(BTCPayUnavailable):
+            client.create_invoice(10, "USD")
+        time.sleep(0.25)
+        with self.assertRaises(BTCPayUnavailable): # The trial fails
+            client.create_invoice(10, "USD")
+        self.assertEqual(client.stats()["circuit"], "open")
+        self.assertEqual(client.breaker_opens, 2)
+
+    def test_client_errors_do_not_trip_it(self):
+        client = BTCPayClient(base_url=self.stub.base_url, store_id="store", api_key="wrong", breaker_threshold=1)
+        self.stub.api_key = "key"
+        for _ in range(3):
+            with self.assertRaises(Exception) as raised:
+                client.create_invoice(10, "USD")
+            self.assertNotIsInstance(raised.exception, BTCPayUnavailable) # 401 is ours to fix, not an outage
+        self.assertEqual(client.stats()["circuit"], "closed")
+
+if __name__ == '__main__':
+    unittest.main()
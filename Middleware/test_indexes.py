@@ -0,0 +1,44 @@
+"""
+Query-plan regression test: every ROUTE_QUERIES entry must be served by an
+index. It needs a real MongoDB; the in-memory store has no query planner
+worth testing against.
+
+    INDEX_TEST_MONGO_URI=mongodb://localhost:27017 python -m pytest -q test_indexes.py
+
+The indexes are built in a throwaway database, which is dropped afterwards.
+The test is skipped when INDEX_TEST_MONGO_URI is not set.
+"""
+import os
+import unittest
+import uuid
+
+from pymongo import MongoClient
+
+from indexes import ROUTE_QUERIES, check_query_plans, ensure_indexes
+
+INDEX_TEST_MONGO_URI = os.getenv("INDEX_TEST_MONGO_URI")
+
+@unittest.skipUnless(INDEX_TEST_MONGO_URI, "INDEX_TEST_MONGO_URI not set")
+class QueryPlanTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.client = MongoClient(INDEX_TEST_MONGO_URI, serverSelectionTimeoutMS=5000)
+        cls.db = cls.client[f"index_plans_{uuid.uuid4().hex[:12]}"]
+        cls.missing = ensure_indexes(cls.db, create=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.drop_database(cls.db.name)
+        cls.client.close()
+
+    def test_registry_builds(self):
+        self.assertEqual(self.missing, [])
+        self.assertEqual(ensure_indexes(self.db, create=False), [])
+
+    def test_route_queries_use_indexes(self):
+        failures = check_query_plans(self.db)
+        report = "\n".join(f"{route}: {' <- '.join(stages)}" for route, stages in failures)
+        self.assertEqual(failures, [], f"COLLSCAN in {len(failures)} of {len(ROUTE_QUERIES)} route queries:\n{report}")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+The query, update and aggregation operators the app relies on, against the
+in-memory store (memory_store.py) that stands in for Mongo in dev and tests:
+
+    python -m pytest -q test_memory_store.py
+
+Where possible the pipelines are the app's own (admin_queries.py,
+admin_stats.py), so a change there that the store can't emulate shows up
+here rather than as a dashboard that silently reads zeros.
+"""
+import unittest
+
+from pymongo.errors import DuplicateKeyError
+
+from admin_queries import users_filter, users_page_pipeline
+from admin_stats import StatsCounters
+from memory_store import MemoryDatabase
+
+class MemoryStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = MemoryDatabase("memory_store_test", snapshot=None)
+
+class ProjectionTest(MemoryStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db["sessions"].insert_one({"id": "s1", "title": "t", "messages": [{"n": i} for i in range(5)]})
+
+    def test_negative_slice_keeps_the_tail(self):
+        doc = self.db["sessions"].find_one({"id": "s1"}, {"_id": 0, "id": 1, "messages": {"$slice": -2}})
+        self.assertEqual(doc, {"id": "s1", "messages": [{"n": 3}, {"n": 4}]})
+
+    def test_positive_slice_keeps_the_head(self):
+        doc = self.db["sessions"].find_one({"id": "s1"}, {"messages": {"$slice": 2}})
+        self.assertEqual(doc["messages"], [{"n": 0}, {"n": 1}])
+        self.assertEqual(doc["title"], "t") # $slice alone doesn't make it an inclusion projection
+
+    def test_skip_limit_slice(self):
+        doc = self.db["sessions"].find_one({"id": "s1"}, {"messages": {"$slice": [-3, 2]}})
+        self.assertEqual(doc["messages"], [{"n": 2}, {"n": 3}])
+
+    def test_slice_longer_than_the_array(self):
+        doc = self.db["sessions"].find_one({"id": "s1"}, {"messages": {"$slice": -50}})
+        self.assertEqual(len(doc["messages"]), 5)
+
+class UpdateTest(MemoryStoreTestCase):
+    def test_push_each_with_slice_keeps_the_newest(self):
+        users = self.db["users"]
+        users.insert_one({"id": "u1"})
+        for i in range(5):
+            users.update_one({"id": "u1"}, {"$push": {"applied": {"$each": [f"inv{i}"], "$slice": -3}}})
+        self.assertEqual(users.find_one({"id": "u1"})["applied"], ["inv2", "inv3", "inv4"])
+
+    def test_push_guarded_by_ne_is_applied_once(self):
+        users = self.db["users"]
+        users.insert_one({"id": "u1", "coins": 0})
+        for _ in range(2):
+            users.update_one({"id": "u1", "applied": {"$ne": "inv1"}},
+                             {"$inc": {"coins": 10}, "$push": {"applied": {"$each": ["inv1"], "$slice": -3}}})
+        doc = users.find_one({"id": "u1"})
+        self.assertEqual((doc["coins"], doc["applied"]), (10, ["inv1"]))
+
+    def test_upsert_seeds_equality_fields(self):
+        stats = self.db["stats"]
+        result = stats.update_one({"id": "global", "kind": {"$eq": "counters"}, "n": {"$gt": 1}},
+                                  {"$inc": {"n": 5}, "$setOnInsert": {"created": 1}}, upsert=True)
+        self.assertIsNotNone(result.upserted_id)
+        doc = stats.find_one({"id": "global"}, {"_id": 0})
+        self.assertEqual(doc, {"id": "global", "kind": "counters", "n": 5, "created": 1})
+
+        # The second call matches, so $setOnInsert is left alone
+        result = stats.update_one({"id": "global"}, {"$inc": {"n": 1}, "$setOnInsert": {"created": 2}}, upsert=True)
+        self.assertIsNone(result.upserted_id)
+        self.assertEqual(result.matched_count, 1)
+        self.assertEqual(stats.find_one({"id": "global"})["created"], 1)
+        self.assertEqual(stats.count_documents({}), 1)
+
+    def test_exists_on_array_index(self):
+        sessions = self.db["sessions"]
+        sessions.insert_many([{"id": "a", "messages": []}, {"id": "b", "messages": [{"n": 0}]}, {"id": "c"}])
+        ids = sorted(d["id"] for d in sessions.find({"messages.0": {"$exists": False}}))
+        self.assertEqual(ids, ["a", "c"])
+
+    def test_unique_index_rejects_duplicates(self):
+        users = self.db["users"]
+        users.create_index("username", unique=True)
+        users.insert_one({"id": "u1", "username": "alice"})
+        with self.assertRaises(DuplicateKeyError):
+            users.insert_one({"id": "u2", "username": "alice"})
+        self.assertEqual(users.count_documents({}), 1)
+
+class AggregationTest(MemoryStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db["users"].insert_many([
+            {"id": "1", "username": "alice", "coins": 10, "subscription": "commander", "password": "x"},
+            {"id": "2", "username": "bob", "coins": 5, "referred_by": "alice"},
+            {"id": "3", "username": "carol", "coins": 0, "subscription": "infantry", "referred_by": "alice"},
+            {"id": "4", "username": "dave", "coins": 1, "subscription": "free", "referred_by": ""},
+        ])
+
+    def test_users_page_lookup_counts_referrals(self):
+        rows = list(self.db["users"].aggregate(users_page_pipeline(users_filter(), limit=10)))
+        self.assertEqual([r["username"] for r in rows], ["alice", "bob", "carol", "dave"])
+        alice = rows[0]
+        self.assertEqual((alice["referrals_count"], alice["paid_referrals_count"]), (2, 1))
+        self.assertNotIn("password", alice)
+        self.assertNotIn("_id", alice)
+
+    def test_if_null_of_first_on_an_empty_lookup(self):
+        rows = list(self.db["users"].aggregate(users_page_pipeline(users_filter(q="BO"))))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]["referrals_count"], rows[0]["paid_referrals_count"]), (0, 0))
+
+    def test_users_page_skip_and_sort(self):
+        rows = list(self.db["users"].aggregate(users_page_pipeline({}, sort="coins", order=-1, skip=1, limit=2)))
+        self.assertEqual([r["username"] for r in rows], ["bob", "dave"])
+
+    def test_reconcile_facet(self):
+        counters = StatsCounters(self.db["stats"], flush_interval=3600)
+        values = counters.reconcile(self.db["users"])
+        self.assertEqual(values, {
+            "total_users": 4, "total_coins": 16, "referred_users": 2,
+            "subs_free": 2, "subs_infantry": 1, "subs_commander": 1
+        })
+
+    def test_facet_on_an_empty_collection(self):
+        rows = list(self.db["empty"].aggregate([{"$facet": {
+            "totals": [{"$group": {"_id": None, "n": {"$sum": 1}}}],
+            "counted": [{"$count": "n"}]
+        }}]))
+        self.assertEqual(rows, [{"totals": [], "counted": []}])
+
+if __name__ == '__main__':
+    unittest.main()
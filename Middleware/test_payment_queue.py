@@ -0,0 +1,118 @@
+"""
+Exactly-once crediting of BTCPay settlements (payment_queue.py), and the
+idempotent ledger writes behind billing.py, against the in-memory store:
+
+    python -m pytest -q test_payment_queue.py
+
+A crash is simulated by failing one write after the credit has landed. The
+queue's worker thread retries the batch once the lease runs out, as it
+would after a worker died mid-batch.
+"""
+import threading
+import time
+import unittest
+
+from billing import Billing
+from indexes import ensure_indexes
+from memory_store import MemoryDatabase
+from payment_queue import DONE, PaymentQueue
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+class CrashOnce:
+    """Collection wrapper whose first update_many matching `when(update)` raises."""
+    def __init__(self, collection, when):
+        self._collection = collection
+        self._when = when
+        self.crashed = False
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def update_many(self, filter, update, **kwargs):
+        if not self.crashed and self._when(update):
+            self.crashed = True
+            raise ConnectionError("simulated crash")
+        return self._collection.update_many(filter, update, **kwargs)
+
+def marks_done(update):
+    return update.get("$set", {}).get("status") == DONE
+
+class PaymentQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.db = MemoryDatabase("payment_queue_test", snapshot=None)
+        ensure_indexes(self.db)
+        self.db["users"].insert_many([
+            {"id": "u1", "username": "buyer", "coins": 0, "subscription": "free"},
+            {"id": "r1", "username": "ref", "coins": 0, "affiliate_balance": 0.0}
+        ])
+        self.events = CrashOnce(self.db["payment_events"], marks_done)
+        self.credits = []
+        self._credits_lock = threading.Lock()
+        self.queue = PaymentQueue(self.events, self.db["users"], self.db["payments"], on_credit=self._on_credit,
+                                  interval=0.02, lease=0.0)
+
+    def _on_credit(self, *credit):
+        with self._credits_lock:
+            self.credits.append(credit)
+
+    def settle(self, invoice_id, plan="commander", coins=2000, referrer=None):
+        return self.queue.enqueue(invoice_id, {"metadata": {
+            "userId": "u1", "plan": plan, "coins": coins, "referrer": referrer
+        }})
+
+    def event(self, invoice_id):
+        return self.db["payment_events"].find_one({"invoiceId": invoice_id})
+
+    def test_replay_after_crash_credits_once_and_reports(self):
+        self.settle("inv1", referrer="ref")
+        self.assertTrue(wait_for(lambda: self.event("inv1")["status"] == DONE))
+        self.assertTrue(self.events.crashed)
+        self.assertGreaterEqual(self.event("inv1")["attempts"], 2)
+
+        buyer = self.db["users"].find_one({"id": "u1"})
+        self.assertEqual(buyer["coins"], 2000)
+        self.assertEqual(buyer["subscription"], "commander")
+        self.assertEqual(buyer["payments_applied"], ["inv1"])
+        referrer = self.db["users"].find_one({"id": "r1"})
+        self.assertEqual(referrer["affiliate_balance"], 1.0)
+        self.assertEqual(referrer["commissions_applied"], ["inv1"])
+        self.assertEqual(self.db["payments"].count_documents({"invoiceId": "inv1"}), 1)
+
+        # The credit landed before the crash; the replay still reports it, once, with the old tier
+        self.assertEqual(self.credits, [("u1", "free", "commander", 2000, "ref")])
+        self.assertEqual(self.queue.stats()["credited"], 1)
+
+    def test_duplicate_delivery_is_a_no_op(self):
+        self.events.crashed = True # No crash in this one
+        self.assertTrue(self.settle("inv2", plan="infantry", coins=500))
+        self.assertFalse(self.settle("inv2", plan="infantry", coins=500))
+        self.assertTrue(wait_for(lambda: self.event("inv2")["status"] == DONE))
+        self.assertEqual(self.db["users"].find_one({"id": "u1"})["coins"], 500)
+        self.assertEqual(self.credits, [("u1", "free", "infantry", 500, None)])
+        self.assertEqual(self.queue.stats()["duplicates"], 1)
+
+class LedgerTest(unittest.TestCase):
+    def test_retried_flush_writes_each_entry_once(self):
+        db = MemoryDatabase("ledger_test", snapshot=None)
+        ensure_indexes(db)
+        db["users"].insert_one({"id": "u1", "coins": 1.0})
+        billing = Billing(db["users"], db["ledger"])
+        debit = billing.debit("u1", 0.2, "chat")
+        refund = billing.refund(debit, "BACKEND_FAILURE")
+        self.assertIsNone(billing.debit("u1", 5.0, "chat")) # Can't overdraw
+        # A flush retried after a timeout upserts the same entries again
+        billing._write_ledger([debit, refund])
+        billing._write_ledger([debit, refund])
+        self.assertEqual(db["ledger"].count_documents({}), 2)
+        self.assertEqual(db["ledger"].find_one({"type": "refund"})["refundOf"], debit["id"])
+        self.assertAlmostEqual(db["users"].find_one({"id": "u1"})["coins"], 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
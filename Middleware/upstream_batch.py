@@ -0,0 +1,313 @@
+"""
+Micro-batched, multiplexed upstream to the GPU nodes (opt-in: GPU_BATCHING=1).
+
+Without it every chat opens its own /generate_stream call, so 20 concurrent
+users are 20 sockets and 20 separate prefills. With it, chats that hold a
+slot are gathered for up to GPU_BATCH_WINDOW_MS (or GPU_BATCH_MAX prompts)
+and sent to one node as a single request over a pooled keep-alive
+connection, letting the backend run the prompts as one inference batch:
+
+    POST /generate_batch  {"requests": [{"id": "17", "prompt": ..., "style": ..., "tier": ...}, ...]}
+
+The response interleaves every request's frames, one per line, each
+prefixed by its request id and a space:
+
+    17 {"type": "text", "content": "Ja"}
+    18 {"type": "text", "content": "Nein"}
+    17 {"type": "end"}
+
+Demultiplexing only splits on that first space; frames reach each client's
+SSE stream byte for byte, and {"type": "end"} closes a request's stream.
+A BatchedStream quacks like the single-request responses (iter_content /
+close for the threaded path, aiter_bytes / aclose for ASGI), so the chat
+relay code is the same in both modes. stub_gpu_node.py speaks the protocol.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+
+from gpu_pool import CONNECT_ATTEMPTS, NoNodeAvailable
+
+logger = logging.getLogger(__name__)
+
+GPU_BATCHING = os.getenv("GPU_BATCHING", "0") == "1"
+GPU_BATCH_WINDOW = float(os.getenv("GPU_BATCH_WINDOW_MS", 20)) / 1000
+GPU_BATCH_MAX = int(os.getenv("GPU_BATCH_MAX", 8))
+END_FRAME = b'{"type": "end"}'
+
+class BatchedStream:
+    """
+    One request's share of a batch. Frames are pushed by the batch reader
+    thread; the chat relay consumes them through the response-like methods.
+    """
+    _CLOSED = object()
+
+    def __init__(self, rid, payload, release, loop=None):
+        self.rid = rid
+        self.payload = payload
+        self.release = release # pool.release, for a node handed over after the caller gave up
+        self.node = None
+        self.attempts = 0
+        self.tried = []
+        self.cancelled = False
+        self._loop = loop
+        self._connected = threading.Event()
+        self._handoff = threading.Lock() # Decides between connected() and the caller giving up
+        self._error = None
+        if loop is None:
+            self._queue = queue.Queue()
+        else:
+            self._queue = asyncio.Queue()
+            self._connected_future = loop.create_future()
+
+    # --- READER SIDE (batch threads) ---
+    def _deliver(self, fn, *args):
+        if self._loop is None:
+            fn(*args)
+        else:
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    def push(self, data):
+        self._deliver(self._queue.put_nowait, data)
+
+    def end(self, error=None):
+        self._error = error
+        self._deliver(self._queue.put_nowait, self._CLOSED)
+
+    def connected(self, node, error=None):
+        """
+        Hands the node (or the error) to the caller. Returns False if the
+        caller already gave up; the node is then still the dispatcher's to
+        release.
+        """
+        with self._handoff:
+            if self.cancelled:
+                return False
+            self.node = node
+            self._error = error
+            self._connected.set()
+        if self._loop is not None:
+            def resolve():
+                if not self._connected_future.done():
+                    self._connected_future.set_result(None)
+            self._loop.call_soon_threadsafe(resolve)
+        return True
+
+    def _give_up(self):
+        """Marks the caller gone. Returns the node if connected() won the race (caller must release it)."""
+        with self._handoff:
+            self.cancelled = True
+            return self.node if self._connected.is_set() else None
+
+    # --- CONSUMER SIDE (threaded) ---
+    def wait_connected(self, timeout=120):
+        if not self._connected.wait(timeout):
+            with self._handoff:
+                if not self._connected.is_set():
+                    self.cancelled = True
+                    raise TimeoutError("Batch dispatch timed out")
+        if self._error:
+            raise self._error
+        return self.node
+
+    def iter_content(self, chunk_size=None):
+        while True:
+            data = self._queue.get()
+            if data is self._CLOSED:
+                break
+            yield data
+        if self._error:
+            raise self._error
+
+    def close(self):
+        self.cancelled = True
+
+    # --- CONSUMER SIDE (asyncio) ---
+    async def wait_connected_async(self):
+        try:
+            await self._connected_future
+        except asyncio.CancelledError:
+            node = self._give_up()
+            if node is not None:
+                self.release(node) # Connected while the resolve was in flight
+            raise
+        if self._error:
+            raise self._error
+        return self.node
+
+    async def aiter_bytes(self):
+        while True:
+            data = await self._queue.get()
+            if data is self._CLOSED:
+                break
+            yield data
+        if self._error:
+            raise self._error
+
+    async def aclose(self):
+        self.cancelled = True
+
+class UpstreamBatcher:
+    def __init__(self, pool, window=GPU_BATCH_WINDOW, max_batch=GPU_BATCH_MAX):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._carry = [] # Streams to retry on another node, ahead of new requests
+        self._thread = threading.Thread(target=self._run, name="gpu-batcher", daemon=True)
+        self._thread.start()
+        self.batches = 0
+        self.batched_requests = 0
+        self.max_seen = 0
+
+    # --- SUBMIT ---
+    def open_stream(self, payload, timeout=120):
+        """
+        Threaded path, drop-in for GPUPool.open_stream(): blocks until the
+        request's batch is connected. Returns (node, stream).
+        """
+        stream = BatchedStream(str(next(self._ids)), payload, self.pool.release)
+        self._queue.put(stream)
+        return stream.wait_connected(timeout), stream
+
+    async def open_stream_async(self, payload):
+        """ASGI path, drop-in for GPUPool.open_stream_async()."""
+        stream = BatchedStream(str(next(self._ids)), payload, self.pool.release, loop=asyncio.get_running_loop())
+        self._queue.put(stream)
+        return await stream.wait_connected_async(), stream
+
+    # --- DISPATCH ---
+    # The dispatcher thread only gathers requests and reserves slots; each
+    # batch connects and reads on its own thread, so a slow node holds up
+    # nothing but its own batch.
+    def _requeue(self, streams):
+        """Puts streams back at the head of the next batch."""
+        with self._lock:
+            self._carry.extend(streams)
+        self._queue.put(None) # Wakes the dispatcher if it is waiting for new requests
+
+    def _gather(self):
+        """Blocks for the first request, then fills the batch for one window."""
+        with self._lock:
+            batch, self._carry = self._carry, []
+        if not batch:
+            first = self._queue.get()
+            with self._lock:
+                batch, self._carry = self._carry, []
+            if first is not None:
+                batch.append(first)
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                s = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if s is not None:
+                batch.append(s)
+        return [s for s in batch if not s.cancelled]
+
+    def _run(self):
+        while True:
+            batch = self._gather()
+            if not batch:
+                continue
+            exclude = {n for s in batch for n in s.tried}
+            if len(exclude) >= len(self.pool.nodes):
+                exclude = set(batch[0].tried) # No node is new to all of them: serve the head, defer the rest
+            try:
+                node, reserved = self.pool.pick_batch(len(batch), exclude=exclude)
+            except NoNodeAvailable as e:
+                for s in batch: s.connected(None, e)
+                continue
+            ready = [s for s in batch if node not in s.tried]
+            for _ in range(reserved - min(reserved, len(ready))):
+                self.pool.release(node)
+            batch, carry = ready[:reserved], ready[reserved:] + [s for s in batch if node in s.tried]
+            if carry:
+                with self._lock:
+                    self._carry.extend(carry)
+            threading.Thread(target=self._send, args=(node, batch), name="gpu-batch", daemon=True).start()
+
+    def _send(self, node, batch):
+        """Connects one batch to its reserved node, then demultiplexes the reply."""
+        try:
+            response = self.pool.post_batch(node, [dict(s.payload, id=s.rid) for s in batch])
+        except Exception as e:
+            logger.warning(f"⚠️ GPU Node {node.base_url} failed batch of {len(batch)}: {e}")
+            retry = []
+            for s in batch:
+                self.pool.release(node)
+                s.tried.append(node)
+                s.attempts += 1
+                if s.attempts >= CONNECT_ATTEMPTS or len(s.tried) >= len(self.pool.nodes):
+                    s.connected(None, e)
+                else:
+                    retry.append(s)
+            if retry:
+                self._requeue(retry)
+            return
+        with self._lock:
+            self.batches += 1
+            self.batched_requests += len(batch)
+            self.max_seen = max(self.max_seen, len(batch))
+        for s in batch:
+            if not s.connected(node):
+                self.pool.release(node) # Caller gave up waiting; it won't release
+        self._read(response, batch)
+
+    # --- DEMULTIPLEX ---
+    def _read(self, response, batch):
+        """
+        Splits the interleaved stream back into per-request streams. All
+        lines for one request in a network read are pushed as one chunk.
+        """
+        streams = {s.rid.encode(): s for s in batch}
+        partial = b""
+        error = None
+        try:
+            for chunk in response.iter_content(chunk_size=None):
+                lines = (partial + chunk).split(b"\n")
+                partial = lines.pop()
+                out = {}
+                for line in lines:
+                    rid, _, frame = line.rstrip(b"\r").partition(b" ")
+                    stream = streams.get(rid)
+                    if stream is None:
+                        continue
+                    if frame == END_FRAME:
+                        if rid in out:
+                            stream.push(bytes(out.pop(rid)))
+                        stream.end()
+                        del streams[rid]
+                    elif not stream.cancelled:
+                        out.setdefault(rid, bytearray()).extend(frame + b"\n")
+                for rid, data in out.items():
+                    streams[rid].push(bytes(data))
+        except Exception as e:
+            error = e
+        finally:
+            response.close()
+            for stream in streams.values():
+                stream.end(error or ConnectionError("Batch stream ended early"))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": True,
+                "window_ms": self.window * 1000,
+                "max_batch": self.max_batch,
+                "batches": self.batches,
+                "requests": self.batched_requests,
+                "avg_batch": round(self.batched_requests / self.batches, 2) if self.batches else 0.0,
+                "max_seen": self.max_seen,
+                "queued": self._queue.qsize()
+            }
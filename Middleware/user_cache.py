@@ -0,0 +1,97 @@
+"""
+Short-TTL cache of user documents for token_required.
+
+Every protected route resolves the JWT's user id to a user document; with
+this cache most of those lookups skip Mongo entirely. Entries expire after
+USER_CACHE_TTL seconds as a safety net, but every write to coins,
+subscription, role, affiliate_balance or payout state must call
+invalidate() so balances never lag behind the database.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+
+class UserCache:
+    def __init__(self, ttl=USER_CACHE_TTL, max_entries=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # user id -> (user, expires_at)
+        self._ids_by_username = {}
+        self._loading = {} # user id -> token of the load in flight; invalidate() drops it
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id, load):
+        """
+        Cached copy of the user, or load(user_id) on a miss.
+        A load that races an invalidate() of the same user is returned but not cached.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return dict(entry[0])
+            self.misses += 1
+            token = self._loading[user_id] = object()
+        try:
+            user = load(user_id)
+        except Exception:
+            with self._lock:
+                if self._loading.get(user_id) is token:
+                    del self._loading[user_id]
+            raise
+        with self._lock:
+            if self._loading.get(user_id) is not token:
+                return dict(user) if user is not None else None
+            del self._loading[user_id]
+            if user is None:
+                return None
+            self._entries[user_id] = (user, now + self.ttl)
+            self._entries.move_to_end(user_id)
+            if user.get('username'):
+                self._ids_by_username[user['username']] = user_id
+            while len(self._entries) > self.max_entries:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._ids_by_username.pop(evicted.get('username'), None)
+        return dict(user)
+
+    def invalidate(self, user_id=None, username=None):
+        """
+        Drop a user by id or by username (referral credits are keyed by username).
+        Loads of that user in flight are returned but not cached.
+        """
+        with self._lock:
+            self.invalidations += 1
+            if user_id is None and username is not None:
+                user_id = self._ids_by_username.get(username)
+                if user_id is None:
+                    self._loading.clear() # Not cached: any load in flight may be this user
+            self._loading.pop(user_id, None)
+            entry = self._entries.pop(user_id, None)
+            if entry:
+                self._ids_by_username.pop(entry[0].get('username'), None)
+
+    def clear(self):
+        with self._lock:
+            self._loading.clear()
+            self._entries.clear()
+            self._ids_by_username.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "invalidations": self.invalidations
+            }
@@ -0,0 +1,120 @@
+"""
+Write-behind buffer: callers put() documents and return immediately, a
+background thread flushes them to the database in batches.
+
+Used for records nobody reads on the request path (the coin ledger, chat
+turns). A failed batch is retried with exponential backoff
+(WRITE_BEHIND_BACKOFF .. WRITE_BEHIND_BACKOFF_MAX seconds) up to
+WRITE_BEHIND_MAX_RETRIES times before it is dropped and counted, so flush
+functions must be idempotent. Pending items are flushed at interpreter exit.
+stats() reports queue depth and lag for monitoring.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", 8))
+WRITE_BEHIND_BACKOFF = float(os.getenv("WRITE_BEHIND_BACKOFF", 0.5))
+WRITE_BEHIND_BACKOFF_MAX = float(os.getenv("WRITE_BEHIND_BACKOFF_MAX", 30))
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = float(os.getenv("WRITE_BEHIND_SHUTDOWN_TIMEOUT", 10))
+
+class WriteBehindBuffer:
+    def __init__(self, name, flush, max_batch=500, interval=0.5, max_retries=WRITE_BEHIND_MAX_RETRIES):
+        """
+        flush(items) writes one batch; it is only ever called from the
+        buffer's own thread (or from close() at exit).
+        """
+        self.name = name
+        self.flush = flush
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue() # (enqueued_at, item)
+        self._lock = threading.Lock()
+        self._closing = False
+        self.written = 0
+        self.batches = 0
+        self.retries = 0
+        self.dropped = 0
+        self.last_lag = 0.0 # Seconds the oldest item of the last batch waited
+        self._thread = threading.Thread(target=self._run, name=f"write-behind-{name}", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, item):
+        self._queue.put((time.time(), item))
+
+    def _drain(self, block):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.interval) if block else self._queue.get_nowait())
+            while len(batch) < self.max_batch:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write(self, batch, deadline=None):
+        """Retries with backoff; gives up after max_retries (or the deadline)."""
+        items = [item for _, item in batch]
+        delay = WRITE_BEHIND_BACKOFF
+        attempt = 0
+        while True:
+            try:
+                self.flush(items)
+                break
+            except Exception as e:
+                attempt += 1
+                out_of_time = deadline is not None and time.time() + delay > deadline
+                if attempt > self.max_retries or out_of_time:
+                    logger.error(f"❌ Write-behind '{self.name}' dropped {len(items)} items after {attempt} attempts: {e}")
+                    with self._lock:
+                        self.dropped += len(items)
+                    return
+                logger.warning(f"⚠️ Write-behind '{self.name}' flush failed (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+                with self._lock:
+                    self.retries += 1
+                time.sleep(delay)
+                delay = min(delay * 2, WRITE_BEHIND_BACKOFF_MAX)
+        with self._lock:
+            self.written += len(items)
+            self.batches += 1
+            self.last_lag = time.time() - batch[0][0]
+
+    def _run(self):
+        while not self._closing:
+            batch = self._drain(block=True)
+            if batch:
+                self._write(batch)
+
+    def close(self, timeout=WRITE_BEHIND_SHUTDOWN_TIMEOUT):
+        """Flush whatever is still queued (called at exit)."""
+        self._closing = True
+        deadline = time.time() + timeout
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout) # Let an in-flight batch finish
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                return
+            self._write(batch, deadline)
+
+    def stats(self):
+        with self._queue.mutex:
+            depth = len(self._queue.queue)
+            oldest = self._queue.queue[0][0] if depth else None
+        with self._lock:
+            return {
+                "depth": depth,
+                "oldest_age": round(time.time() - oldest, 3) if oldest else 0.0,
+                "last_lag": round(self.last_lag, 3),
+                "written": self.written,
+                "batches": self.batches,
+                "retries": self.retries,
+                "dropped": self.dropped
+            }